@@ -0,0 +1,434 @@
+# -*- coding:utf-8 -*-
+'''
+Adversarial training steps of the generator and the discriminator.
+
+The differentiable parts of the steps (generator_loss, discriminator_loss) are
+free of data-dependent Python loops so that they can be wrapped by CompiledStep
+(torch.compile with the CPU inductor backend). Sampling and rewards stay eager.
+'''
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+import utils
+from helpers import convert_to_one_hot, cpu_autocast
+from loss import GANLoss
+from profiling import span
+
+
+class CompiledStep(object):
+    """torch.compile wrapper which falls back to eager mode
+
+    Falls back when torch.compile is not available or when compiling / running
+    the compiled function fails. compile_time is the duration of the first call.
+    """
+    def __init__(self, fn, enabled=True, backend='inductor', **compile_kwargs):
+        self.eager_fn = fn
+        self.fn = fn
+        self.compile_time = None
+        if enabled:
+            if hasattr(torch, 'compile'):
+                # nn.LSTM is a graph break unless Dynamo is allowed to trace it
+                if hasattr(torch._dynamo.config, 'allow_rnn'):
+                    torch._dynamo.config.allow_rnn = True
+                self.fn = torch.compile(fn, backend=backend, **compile_kwargs)
+            else:
+                utils.eprint('torch.compile is not available, running {} in eager mode'.format(fn.__name__))
+
+    @property
+    def compiled(self):
+        return self.fn is not self.eager_fn
+
+    def __call__(self, *args, **kwargs):
+        if not self.compiled:
+            return self.fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            # the traced oneDNN LSTM kernel fails when the LSTM input does not require grad
+            with torch.backends.mkldnn.flags(enabled=False):
+                out = self.fn(*args, **kwargs)
+        except Exception as e:
+            utils.eprint('torch.compile failed for {} ({}), falling back to eager mode'.format(self.eager_fn.__name__, e))
+            self.fn = self.eager_fn
+            return self.fn(*args, **kwargs)
+        if self.compile_time is None:
+            self.compile_time = time.perf_counter() - start
+        return out
+
+
+def generator_inputs(samples):
+    """
+        Input of the generator for given samples: zeros before the samples and the last column deleted.
+        samples dims: (batch_size, seq_len)
+    """
+    zeros = torch.zeros((samples.size(0), 1)).type(torch.LongTensor)
+    if samples.is_cuda:
+        zeros = zeros.cuda()
+    return torch.cat([zeros, samples.data], dim=1)[:, :-1].contiguous()
+
+def generator_loss(generator, discriminator, c_phi_hat, samples, rewards, GD, temperature, eta, bf16=False, cuda=False):
+    """
+        Surrogate loss whose gradient w.r.t. the generator is the REINFORCE / REBAR / RELAX estimate (3.a to 3.h).
+        samples dims: (batch_size, seq_len), rewards dims: (batch_size)
+        returns the loss, log-probabilities (batch_size, seq_len, vocab_size), c_phi(z) and c_phi(z_tilde) (batch_size, 2)
+        (None for REINFORCE). For REINFORCE with an adaptive softmax generator, only the log-probabilities of the
+        samples (batch_size, seq_len) are computed.
+    """
+    batch_size, seq_len = samples.size(0), samples.size(1)
+    if GD == "REINFORCE" and getattr(generator, 'adaptive', None) is not None:
+        with cpu_autocast(bf16):
+            log_p = generator.target_log_prob(generator_inputs(samples), samples).float()
+        loss = -torch.sum(log_p * rewards.view(-1, 1)) / batch_size
+        return loss, log_p, None, None
+    with cpu_autocast(bf16):
+        prob = generator.forward(generator_inputs(samples)).float()
+    # 3.a
+    theta_prime = utils.g_output_prob(prob)
+    if GD == "REINFORCE":
+        # no control variate
+        weights = rewards.view(-1, 1).expand(batch_size, seq_len).contiguous().view(-1)
+        loss = GANLoss().forward_reinforce(prob, samples.contiguous().view(-1), weights) / batch_size
+        return loss, prob.view((batch_size, seq_len, -1)), None, None
+    # 3.e and f
+    with span('c_phi_out'), cpu_autocast(bf16):
+        c_phi_z_ori, c_phi_z_tilde_ori = utils.c_phi_out(GD, c_phi_hat, theta_prime, discriminator, temperature=temperature,
+                                                         eta=eta, cuda=cuda, seq_len=seq_len)
+    c_phi_z_ori = torch.exp(c_phi_z_ori.float())
+    c_phi_z_tilde_ori = torch.exp(c_phi_z_tilde_ori.float())
+    # 3.g
+    weights = rewards - c_phi_z_tilde_ori[:, 1]
+    weights = weights.detach().view(-1, 1).expand(batch_size, seq_len).contiguous().view(-1)
+    loss = GANLoss().forward_reinforce(prob, samples.contiguous().view(-1), weights) / batch_size
+    # 3.h - the last two terms of the RELAX equation
+    loss = loss + torch.sum(c_phi_z_ori[:, 1])/batch_size - torch.sum(c_phi_z_tilde_ori[:, 1])/batch_size
+
+    return loss, prob.view((batch_size, seq_len, -1)), c_phi_z_ori, c_phi_z_tilde_ori
+
+def sequence_log_prob(prob, samples):
+    """
+        Log-probability of every sequence.
+        prob dims: (batch_size, seq_len, vocab_size), or (batch_size, seq_len) for the log-probabilities of the samples
+        samples dims: (batch_size, seq_len)
+        returns dims: (batch_size)
+    """
+    if prob.dim() == 2:
+        return prob.sum(1)
+    return prob.gather(2, samples.unsqueeze(2)).squeeze(2).sum(1)
+
+def off_policy_loss(generator, off_policy, truncation=1.0):
+    """
+        Sum of the importance-weighted REINFORCE losses of the batches kept in off_policy (an OffPolicyBuffer),
+        each normalised by its batch size. The control variates are not applied to these batches.
+    """
+    loss = 0
+    gen_gan_loss = GANLoss()
+    for samples, behaviour_log_prob, rewards in off_policy:
+        batch_size, seq_len = samples.size()
+        prob = generator.forward(generator_inputs(samples))
+        log_ratio = sequence_log_prob(prob.view((batch_size, seq_len, -1)), samples) - behaviour_log_prob
+        expand = lambda x: x.view(-1, 1).expand(batch_size, seq_len).contiguous().view(-1)
+        loss = loss + gen_gan_loss.forward_off_policy(prob, samples.contiguous().view(-1), expand(rewards),
+                                                      expand(log_ratio), truncation) / batch_size
+    return loss
+
+def estimator_grads(generator, samples, new_prob, rewards, c_phi_z_ori, c_phi_z_tilde_ori, GD, per_sample=True, create_graph=False):
+    """
+        Gradient estimate of every term in the batch (3.i and 3.j), or of the whole batch if not per_sample:
+            -(f(b) - c_phi(z_tilde)) d log p(b) + d c_phi(z) - d c_phi(z_tilde)
+        With create_graph the gradients are differentiable w.r.t. the control variate (double-backward).
+        returns a list (batch_size, or 1 if not per_sample) of lists of gradients, one per parameter of the generator
+    """
+    batch_size = samples.size(0)
+    params = list(generator.parameters())
+    log_prob = sequence_log_prob(new_prob, samples)
+    if GD == "REINFORCE":
+        coef, c_diff, create_graph = rewards, None, False
+    else:
+        coef = rewards - c_phi_z_tilde_ori[:, 1]
+        c_diff = c_phi_z_ori[:, 1] - c_phi_z_tilde_ori[:, 1]
+    if not create_graph:
+        coef = coef.detach()
+    if per_sample:
+        terms = [(log_prob[j], coef[j], None if c_diff is None else c_diff[j]) for j in range(batch_size)]
+    else:
+        terms = [(log_prob, coef / batch_size, None if c_diff is None else c_diff.sum() / batch_size)]
+
+    all_grads = []
+    for log_p, w, c in terms:
+        outputs, grad_outputs = [log_p], [-w]
+        if c is not None:
+            outputs.append(c)
+            grad_outputs.append(torch.ones_like(c))
+        grads = torch.autograd.grad(outputs, params, grad_outputs=grad_outputs, retain_graph=True,
+                                    create_graph=create_graph, allow_unused=True)
+        all_grads.append([torch.zeros_like(p) if g is None else g for p, g in zip(params, grads)])
+
+    return all_grads
+
+def split_batch(x, micro_batch_size=None):
+    """Chunks of at most micro_batch_size rows of x (x itself if micro_batch_size is None)"""
+    if micro_batch_size is None or micro_batch_size >= x.size(0):
+        return [x]
+    return list(torch.split(x, micro_batch_size))
+
+def generator_step(generator, discriminator, c_phi_hat, rollout, optimizer, GD, batch_size, seq_len, vocab_size,
+                   temperature, eta, loss_fn=generator_loss, reward_discriminator=None, samples=None,
+                   check_variance=False, variance_fn=None, per_sample=True, reduce_grads=None,
+                   off_policy=None, truncation=1.0, micro_batch_size=None, bf16=False, cuda=False):
+    """
+        One adversarial step of the generator.
+        With check_variance, the gradient estimates of every sample (or of the batch, if not per_sample) are computed
+        and the generator gradient is their average. variance_fn(grads) is then called before the optimizer step, for
+        REBAR / RELAX the gradients are differentiable w.r.t. the control variate.
+        reduce_grads is called between the backward pass and the optimizer step (e.g. to all-reduce the gradients).
+        off_policy (an OffPolicyBuffer) adds its batches to the estimate with truncated importance ratios,
+        the loss is averaged over the fresh and the replayed batches. The fresh batch is then added to it.
+        With micro_batch_size, the rewards, the loss and its backward pass are computed micro-batch by micro-batch and
+        the gradients accumulated (weighted by the share of the batch) before the single optimizer step. With
+        check_variance and variance_fn, variance_fn has to be a ControlVariateUpdate; if not per_sample, every
+        micro-batch then counts as one estimate.
+        returns the samples, their rewards and, if check_variance, the output of variance_fn (or the gradients)
+    """
+    if samples is None:
+        with span('sample'):
+            samples = generator.sample(batch_size, seq_len)
+    batch_size = samples.size(0)
+    chunks = split_batch(samples, micro_batch_size)
+    accumulate = len(chunks) > 1 and check_variance and variance_fn is not None
+    if accumulate:
+        if not hasattr(variance_fn, 'accumulate'):
+            raise ValueError('Micro-batches with check_variance need a ControlVariateUpdate as variance_fn')
+        variance_fn.zero_grad()
+    scale = 1.
+    if off_policy is not None and len(off_policy) > 0:
+        scale = 1. / (1 + len(off_policy))
+    params = list(generator.parameters())
+    optimizer.zero_grad()
+    all_rewards, all_log_prob, all_grads = [], [], []
+    for chunk in chunks:
+        weight = chunk.size(0) / batch_size
+        # Calculate the reward
+        with span('reward'):
+            rewards = rollout.get_reward(chunk, reward_discriminator or discriminator, vocab_size, cuda)
+            rewards = torch.exp(torch.Tensor(rewards)).contiguous().view((-1,))
+        if cuda:
+            rewards = rewards.cuda()
+        with span('g_loss'):
+            loss, new_prob, c_phi_z_ori, c_phi_z_tilde_ori = loss_fn(generator, discriminator, c_phi_hat, chunk, rewards,
+                                                                     GD, temperature, eta, bf16=bf16, cuda=cuda)
+        if check_variance:
+            with span('estimator_grads'):
+                grads = estimator_grads(generator, chunk, new_prob, rewards, c_phi_z_ori, c_phi_z_tilde_ori, GD,
+                                        per_sample=per_sample, create_graph=variance_fn is not None)
+            # the generator gradient is the average of the estimates
+            for i, p in enumerate(params):
+                g = weight * scale * sum(g[i].detach() for g in grads) / len(grads)
+                p.grad = g if p.grad is None else p.grad + g
+            if accumulate:
+                # frees the graph of the micro-batch
+                with span('variance'):
+                    variance_fn.accumulate(grads, weight)
+            else:
+                all_grads.extend(grads)
+        else:
+            with span('g_backward'):
+                (loss * (weight * scale)).backward()
+        all_rewards.append(rewards)
+        if off_policy is not None:
+            all_log_prob.append(sequence_log_prob(new_prob.detach(), chunk))
+    rewards = torch.cat(all_rewards)
+    if scale < 1:
+        (off_policy_loss(generator, off_policy, truncation) * scale).backward()
+    grads = all_grads if check_variance else None
+    with span('variance'):
+        if accumulate:
+            grads = variance_fn.step()
+        elif check_variance and variance_fn is not None:
+            # before the optimizer step: the graph still refers to the current parameters
+            grads = variance_fn(grads)
+    if reduce_grads is not None:
+        reduce_grads()
+    with span('g_update'):
+        optimizer.step()
+    if off_policy is not None:
+        off_policy.add(samples, torch.cat(all_log_prob), rewards)
+
+    return samples, rewards, grads
+
+class ControlVariateUpdate(object):
+    """Update of the control variate, descending the second moment of the gradient estimates
+    (differentiable w.r.t. the control variate, see estimator_grads).
+
+    Called with the estimates of a whole batch, it is one update. With micro-batches: zero_grad, then accumulate
+    the estimates of every micro-batch with its share of the batch, then step; the moments of the gradients
+    of the monitored parameter (see loss.VarianceLoss) are summed over the micro-batches.
+    reduce_moments maps the per-batch moments of the gradients to their sums over all processes.
+    """
+    def __init__(self, c_phi_hat_loss, c_phi_hat_optm, reduce_grads=None, reduce_moments=None, cuda=False):
+        self.c_phi_hat_loss = c_phi_hat_loss
+        self.c_phi_hat_optm = c_phi_hat_optm
+        self.reduce_grads = reduce_grads
+        self.reduce_moments = reduce_moments
+        self.cuda = cuda
+        self.moments = None
+
+    def zero_grad(self):
+        self.c_phi_hat_optm.zero_grad()
+        self.moments = None
+
+    def accumulate(self, grads, weight=1.):
+        moments = self.c_phi_hat_loss.moments(grads, self.cuda)
+        if self.moments is None:
+            self.moments = moments
+        else:
+            self.moments = tuple(a + b for a, b in zip(self.moments, moments))
+        var_loss = self.c_phi_hat_loss.forward(grads, self.cuda)
+        if var_loss.requires_grad:
+            params = [p for group in self.c_phi_hat_optm.param_groups for p in group['params']]
+            (var_loss * weight).backward(inputs=params)
+
+    def step(self):
+        """returns the variance of the gradient of the monitored parameter of the generator"""
+        moments = self.moments
+        if self.reduce_moments is not None:
+            moments = self.reduce_moments(moments)
+        true_variance = self.c_phi_hat_loss.variance(moments)
+        if self.reduce_grads is not None:
+            self.reduce_grads()
+        self.c_phi_hat_optm.step()
+        self.moments = None
+
+        return true_variance
+
+    def __call__(self, grads):
+        self.zero_grad()
+        self.accumulate(grads)
+        return self.step()
+
+def variance_step(c_phi_hat_loss, c_phi_hat_optm, grads, reduce_grads=None, reduce_moments=None, cuda=False):
+    """
+        Update of the control variate on the estimates of a whole batch (see ControlVariateUpdate).
+        returns the variance of the gradient of the last layer of the generator
+    """
+    return ControlVariateUpdate(c_phi_hat_loss, c_phi_hat_optm, reduce_grads, reduce_moments, cuda)(grads)
+
+def flatten_grads(grads):
+    """list of per-sample lists of gradients -> (num_samples, num_parameters)"""
+    return torch.stack([torch.cat([g.detach().reshape(-1) for g in sample]) for sample in grads])
+
+def reference_gradient(generator, discriminator, rollout, batch_size, seq_len, vocab_size, num_batches, cuda=False):
+    """
+        High-sample REINFORCE estimate of the gradient (num_batches batches of batch_size samples).
+        The samples are drawn from a fork of the RNG, the random stream of the training is left as it is.
+        returns dims: (num_parameters)
+    """
+    params = list(generator.parameters())
+    total = 0
+    with torch.random.fork_rng(devices=[torch.cuda.current_device()] if cuda else []):
+        for _ in range(num_batches):
+            samples = generator.sample(batch_size, seq_len)
+            rewards = torch.exp(torch.Tensor(rollout.get_reward(samples, discriminator, vocab_size, cuda))).view(-1)
+            if cuda:
+                rewards = rewards.cuda()
+            loss, _, _, _ = generator_loss(generator, discriminator, None, samples, rewards, "REINFORCE", None, None, cuda=cuda)
+            grads = torch.autograd.grad(loss, params, allow_unused=True)
+            total = total + torch.cat([(torch.zeros_like(p) if g is None else g).reshape(-1) for p, g in zip(params, grads)])
+    return total / num_batches
+
+def compare_estimators(generator, discriminator, c_phi_hat, rollout, optimizer, GD, batch_size, seq_len, vocab_size,
+                       temperature, eta, reference=None, estimators=("REINFORCE", "REBAR", "RELAX"), variance_fn=None,
+                       reward_discriminator=None, cuda=False):
+    """
+        One generator step in which every estimator is computed from the same samples, rewards and generator forward
+        pass, and from the same relaxation noise (the RNG state is restored before each c_phi_out). Only GD drives the
+        update, and the RNG is left where the noise of GD leaves it: GD draws what generator_step draws for it.
+        reference dims: (num_parameters), e.g. from reference_gradient
+        returns {estimator: (variance, cosine)}: the trace of the covariance of the per-sample estimates and the
+        cosine similarity of their mean to the reference (None without reference), and the output of variance_fn
+    """
+    samples = generator.sample(batch_size, seq_len)
+    rewards = torch.exp(torch.Tensor(rollout.get_reward(samples, reward_discriminator or discriminator, vocab_size, cuda))).view(-1)
+    if cuda:
+        rewards = rewards.cuda()
+    prob = generator.forward(generator_inputs(samples))
+    theta_prime = utils.g_output_prob(prob)
+    prob = prob.view((batch_size, seq_len, -1))
+    noise_state = torch.get_rng_state()
+    driver_state = noise_state  # REINFORCE draws no relaxation noise
+
+    stats, driver = {}, None
+    for estimator in estimators:
+        c_phi_z_ori = c_phi_z_tilde_ori = None
+        if estimator != "REINFORCE":
+            torch.set_rng_state(noise_state)
+            c_phi_z_ori, c_phi_z_tilde_ori = utils.c_phi_out(estimator, c_phi_hat, theta_prime, discriminator,
+                                                             temperature=temperature, eta=eta, cuda=cuda, seq_len=seq_len)
+            if estimator == GD:
+                driver_state = torch.get_rng_state()
+            c_phi_z_ori, c_phi_z_tilde_ori = torch.exp(c_phi_z_ori), torch.exp(c_phi_z_tilde_ori)
+        grads = estimator_grads(generator, samples, prob, rewards, c_phi_z_ori, c_phi_z_tilde_ori, estimator,
+                                per_sample=True, create_graph=estimator == GD and variance_fn is not None)
+        flat = flatten_grads(grads)
+        mean = flat.mean(0)
+        cosine = None
+        if reference is not None:
+            cosine = F.cosine_similarity(mean, reference, dim=0).item()
+        stats[estimator] = (flat.var(0, unbiased=False).sum().item(), cosine)
+        if estimator == GD:
+            driver = grads
+    torch.set_rng_state(driver_state)
+
+    optimizer.zero_grad()
+    for i, p in enumerate(generator.parameters()):
+        p.grad = sum(g[i].detach() for g in driver) / len(driver)
+    out = variance_fn(driver) if variance_fn is not None else None
+    optimizer.step()
+
+    return stats, out
+
+def discriminator_loss(discriminator, real_data, fake_data, bf16=False, real_lengths=None):
+    """
+        real_data, fake_data dims: (batch_size, seq_len, vocab_size)
+        real_lengths dims: (batch_size), lengths of the real sequences if real_data is padded
+    """
+    with cpu_autocast(bf16):
+        if real_lengths is None:
+            real_pred = discriminator(real_data)
+        else:
+            real_pred = discriminator(real_data, real_lengths)
+        real_pred = torch.exp(real_pred[:, :-1].float())
+        fake_pred = torch.exp(discriminator(fake_data)[:, :-1].float())
+    D_real_loss = F.binary_cross_entropy(real_pred, torch.ones_like(real_pred))
+    D_fake_loss = F.binary_cross_entropy(fake_pred, torch.zeros_like(fake_pred))
+
+    return D_real_loss + D_fake_loss
+
+def discriminator_step(discriminator, optimizer, data, fake, vocab_size, loss_fn=discriminator_loss, reduce_grads=None,
+                       micro_batch_size=None, data_lengths=None, bf16=False, cuda=False):
+    """
+        One step of the discriminator on a batch of real data and a batch of generated samples.
+        With micro_batch_size the losses of the micro-batches are accumulated, weighted by their share of the batch.
+        data, fake dims: (batch_size, seq_len)
+        data_lengths dims: (batch_size), lengths of the real sequences if data is padded (see DataLoader.lengths)
+    """
+    optimizer.zero_grad()
+    D_loss = 0
+    real_chunks = split_batch(data, micro_batch_size)
+    length_chunks = [None] * len(real_chunks) if data_lengths is None else split_batch(data_lengths, micro_batch_size)
+    for real_chunk, fake_chunk, lengths in zip(real_chunks, split_batch(fake, micro_batch_size), length_chunks):
+        if getattr(discriminator, 'token_input', False):
+            # embedded by the discriminator
+            real_data, fake_data = (real_chunk.cuda(), fake_chunk.cuda()) if cuda else (real_chunk, fake_chunk)
+        else:
+            real_data = convert_to_one_hot(real_chunk, vocab_size, cuda)
+            fake_data = convert_to_one_hot(fake_chunk, vocab_size, cuda)
+        loss = loss_fn(discriminator, real_data, fake_data, bf16=bf16, real_lengths=lengths) * (real_chunk.size(0) / data.size(0))
+        loss.backward()
+        D_loss = D_loss + loss.detach()
+    if reduce_grads is not None:
+        reduce_grads()
+    optimizer.step()
+
+    return D_loss
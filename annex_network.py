@@ -8,7 +8,9 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from helpers import checkpointed_lstm
 
 
 
@@ -17,17 +19,20 @@ class AnnexNetwork(nn.Module):
     """A CNN for text classification
 
     architecture: Embedding >> Convolution >> Max-pooling >> Softmax
+    With embed_inputs (large vocabularies) the relaxed inputs are projected to emb_dim (soft-embedding
+    product) before the convolutions, otherwise the filters span the whole vocabulary.
     """
 
-    def __init__(self, num_classes, vocab_size, emb_dim, filter_sizes, num_filters, dropout, batch_size, g_sequence_len):
+    def __init__(self, num_classes, vocab_size, emb_dim, filter_sizes, num_filters, dropout, g_sequence_len, embed_inputs=False):
         super(AnnexNetwork, self).__init__()
-        self.convs = nn.ModuleList([nn.Conv2d(1, n, (f, vocab_size)) for (n, f) in zip(num_filters, filter_sizes)])
+        self.emb = nn.Linear(vocab_size, emb_dim, bias=False) if embed_inputs else None
+        width = emb_dim if embed_inputs else vocab_size
+        self.convs = nn.ModuleList([nn.Conv2d(1, n, (f, width)) for (n, f) in zip(num_filters, filter_sizes)])
         self.highway = nn.Linear(sum(num_filters), sum(num_filters))
         self.dropout = nn.Dropout(p=dropout)
         self.lin = nn.Linear(sum(num_filters), num_classes)
-        self.softmax = nn.LogSoftmax()
+        self.softmax = nn.LogSoftmax(dim=1)
         self.vocab_size = vocab_size
-        self.batch_size = batch_size
         self.g_sequence_len = g_sequence_len
         self.init_parameters()
     
@@ -36,7 +41,9 @@ class AnnexNetwork(nn.Module):
         Args:
             x: (batch_size*g_sequence_len, vocab_size)
         """
-        emb = x.view(self.batch_size, 1, self.g_sequence_len, self.vocab_size) # batch_size * 1 * seq_len * vocab_size
+        if self.emb is not None:
+            x = self.emb(x)
+        emb = x.view(-1, 1, self.g_sequence_len, x.size(-1)) # batch_size * 1 * seq_len * vocab_size (or emb_dim)
         convs = [F.relu(conv(emb)).squeeze(3) for conv in self.convs]  # [batch_size * num_filter * length]
         pools = [F.max_pool1d(conv, conv.size(2)).squeeze(2) for conv in convs] # [batch_size * num_filter]
         pred = torch.cat(pools, 1)  # batch_size * num_filters_sum
@@ -54,26 +61,39 @@ class LSTMAnnexNetwork(nn.Module):
     """
         Many to one LSTM
     """
-    def __init__(self, num_classes, vocab_size, hidden_dim, batch_size, g_sequence_len, use_cuda=False):
+    def __init__(self, num_classes, vocab_size, hidden_dim, g_sequence_len, use_cuda=False, checkpoint_segment=None):
         super(LSTMAnnexNetwork, self).__init__()
         self.vocab_size = vocab_size
         self.hidden_dim = hidden_dim
         self.use_cuda = use_cuda
+        # steps per activation-checkpointed LSTM segment (see helpers.checkpointed_lstm)
+        self.checkpoint_segment = checkpoint_segment
         self.g_sequence_len = g_sequence_len
-        self.batch_size = batch_size
         self.lstm = nn.LSTM(vocab_size, hidden_dim, batch_first=True)
         self.lin = nn.Linear(hidden_dim, num_classes)
-        self.softmax = nn.LogSoftmax()
+        self.softmax = nn.LogSoftmax(dim=1)
         self.init_parameters()
     """
         x is output of Generator
         x dimensions: (batch_size, seq_len, vocab_size)
 
     """
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         # x dims (batch_size * seq_len , vocab_size)
-        x = x.view(self.batch_size, self.g_sequence_len, self.vocab_size) # (batch-size, seq_len, vocab_size)
+        # lengths (batch_size): lengths of the sequences if x is padded
+        if lengths is not None:
+            x = x.view(lengths.size(0), -1, self.vocab_size)
+            h0, c0 = self.init_hidden(x.size(0))
+            # the last valid output of every sequence is its final hidden state
+            packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            _, (h, c) = self.lstm(packed, (h0, c0))
+            return self.softmax(self.lin(h[-1]))
+        x = x.view(-1, self.g_sequence_len, self.vocab_size) # (batch-size, seq_len, vocab_size)
         h0, c0 = self.init_hidden(x.size(0))
+        if self.checkpoint_segment is not None:
+            # only the final state is kept, the outputs of the segments are not stored
+            _, (h, c) = checkpointed_lstm(self.lstm, x, (h0, c0), self.checkpoint_segment)
+            return self.softmax(self.lin(h[-1]))
         output, (h, c) = self.lstm(x, (h0, c0))  # output dim: (batch_size, seq_length, hidden_dim)
 
         seq_len = output.size()[1]
@@ -84,8 +104,8 @@ class LSTMAnnexNetwork(nn.Module):
 
     def init_hidden(self, batch_size):
         # noise distribution fed to G
-        h = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
-        c = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
+        h = torch.zeros((1, batch_size, self.hidden_dim))
+        c = torch.zeros((1, batch_size, self.hidden_dim))
         if self.use_cuda:
             h, c = h.cuda(), c.cuda()
         return h, c
@@ -93,3 +113,17 @@ class LSTMAnnexNetwork(nn.Module):
     def init_parameters(self):
         for param in self.parameters():
             param.data.normal_(0, 0.02)
+
+class RelaxationParameters(nn.Module):
+    """
+        Learnable REBAR eta and relaxation temperature (through its log, so that it stays positive),
+        trained with the control variate on the variance of the gradient estimates
+    """
+    def __init__(self, eta=1., temperature=1.):
+        super(RelaxationParameters, self).__init__()
+        self.eta = nn.Parameter(torch.Tensor([eta]))
+        self.log_temperature = nn.Parameter(torch.Tensor([np.log(temperature)]))
+
+    @property
+    def temperature(self):
+        return torch.exp(self.log_temperature)
@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+'''
+fp32 vs CPU bfloat16 autocast for the adversarial step of main.main.
+
+For every (batch size, precision) pair a fresh process runs one adversarial
+step (generator step as in main.main without the CHECK_VARIANCE diagnostics,
+followed by one discriminator step) and reports the mean step time and the
+peak RSS. Score curves are then recorded for both precisions at RunConfig.BATCH_SIZE
+and saved to charts/bf16_score_seq{SEQ_LEN}.png.
+
+$ python -m benchmarks.bf16_autocast --gd RELAX --batch_sizes 128 1024
+'''
+
+import os
+import time
+import resource
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from utils import get_data_goodness_score
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from data_loader import DataLoader
+from adversarial import generator_step, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def build(batch_size, seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    return generator, discriminator, c_phi_hat
+
+def adversarial_step(gd, models, optimizers, real, batch_size, bf16):
+    generator, discriminator, c_phi_hat = models
+    gen_optm, dis_optm = optimizers
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, gd, batch_size, cfg.g_sequence_len,
+                   cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, bf16=bf16)
+    fake = generator.sample(real.size(0), cfg.g_sequence_len)
+    discriminator_step(discriminator, dis_optm, real, fake, cfg.VOCAB_SIZE, bf16=bf16)
+
+def real_batches(batch_size):
+    data_iter = DataLoader(cfg.POSITIVE_FILE, batch_size)
+    while True:
+        for data, _ in data_iter:
+            if data.size(0) == batch_size:
+                yield data
+        data_iter.reset()
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+def time_step(gd, batch_size, bf16, steps, threads, seed, queue):
+    torch.set_num_threads(threads)
+    models = build(batch_size, seed)
+    optimizers = (optim.Adam(models[0].parameters()), optim.Adam(models[1].parameters()))
+    real = real_batches(batch_size)
+    adversarial_step(gd, models, optimizers, next(real), batch_size, bf16) # warm-up
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    for _ in range(steps):
+        adversarial_step(gd, models, optimizers, next(real), batch_size, bf16)
+    step_time = (time.perf_counter() - start) / steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((step_time, peak, peak - rss_before))
+
+def score_curve(gd, batch_size, bf16, batches, seed):
+    models = build(batch_size, seed)
+    optimizers = (optim.Adam(models[0].parameters()), optim.Adam(models[1].parameters()))
+    real = real_batches(batch_size)
+    eval_iter = DataLoader(cfg.EVAL_FILE, batch_size)
+    scores = []
+    for _ in range(batches):
+        adversarial_step(gd, models, optimizers, next(real), batch_size, bf16)
+        samples = models[0].sample(batch_size, cfg.g_sequence_len)
+        scores.append(get_data_goodness_score(eval_iter.convert_to_char(samples), cfg.SPACES))
+    return scores
+
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    print('GD = {}, SEQ_LEN = {}, threads = {}, bf16 supported = {}'.format(
+        opt.gd, cfg.SEQ_LEN, opt.threads, torch.backends.mkldnn.is_available()))
+    print('{:>10}{:>8}{:>16}{:>16}{:>16}'.format('batch', 'dtype', 'step [ms]', 'peak RSS [MB]', 'step RSS [MB]'))
+    for batch_size in opt.batch_sizes:
+        times = {}
+        for bf16 in (False, True):
+            queue = ctx.Queue()
+            p = ctx.Process(target=time_step, args=(opt.gd, batch_size, bf16, opt.steps, opt.threads, opt.seed, queue))
+            p.start()
+            step_time, peak, delta = queue.get()
+            p.join()
+            times[bf16] = step_time
+            print('{:>10}{:>8}{:>16.1f}{:>16.1f}{:>16.1f}'.format(batch_size, 'bf16' if bf16 else 'fp32', 1000 * step_time, peak, delta))
+        print('{:>10}{:>8}{:>16}'.format('', 'speedup', 'x{:.2f}'.format(times[False] / times[True])))
+
+    if opt.score_batches > 0:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        for bf16 in (False, True):
+            scores = score_curve(opt.gd, cfg.BATCH_SIZE, bf16, opt.score_batches, opt.seed)
+            print('{} final goodness score: {:.4f}'.format('bf16' if bf16 else 'fp32', np.mean(scores[-10:])))
+            plt.plot(scores, label='bf16 autocast' if bf16 else 'fp32')
+        plt.ylim((0, 13))
+        plt.legend()
+        plt.title('{} goodness score, SEQ_LEN = {}'.format(opt.gd, cfg.SEQ_LEN))
+        path = os.path.join('charts', 'bf16_score_seq{}.png'.format(cfg.SEQ_LEN))
+        plt.savefig(path)
+        print('score curves saved to {}'.format(path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='bfloat16 autocast benchmark')
+    parser.add_argument('--gd', default='RELAX', choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 1024])
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--score_batches', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
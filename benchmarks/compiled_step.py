@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+'''
+Eager vs torch.compile (CPU inductor) adversarial steps, per gradient estimator.
+
+One step is adversarial.generator_step followed by adversarial.discriminator_step
+on one real batch, with the default settings (SEQ_LEN, BATCH_SIZE, ...) of config.RunConfig.
+
+$ python -m benchmarks.compiled_step --gd REINFORCE REBAR RELAX
+'''
+
+import time
+import argparse
+
+import torch
+import torch.optim as optim
+
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from data_loader import DataLoader
+from adversarial import CompiledStep, generator_loss, generator_step, discriminator_loss, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def build(seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    return generator, discriminator, c_phi_hat
+
+def run_mode(gd, compile, steps, seed, real):
+    generator, discriminator, c_phi_hat = build(seed)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_optm = optim.Adam(generator.parameters())
+    dis_optm = optim.Adam(discriminator.parameters())
+    gen_loss_fn = CompiledStep(generator_loss, compile)
+    dis_loss_fn = CompiledStep(discriminator_loss, compile)
+
+    def step():
+        generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, gd, cfg.BATCH_SIZE, cfg.g_sequence_len,
+                       cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, loss_fn=gen_loss_fn)
+        fake = generator.sample(real.size(0), cfg.g_sequence_len)
+        discriminator_step(discriminator, dis_optm, real, fake, cfg.VOCAB_SIZE, loss_fn=dis_loss_fn)
+
+    start = time.perf_counter()
+    step()
+    first = time.perf_counter() - start
+    step() # second call, recompilations for the backward graphs happen here
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    steady = (time.perf_counter() - start) / steps
+    fallback = compile and not (gen_loss_fn.compiled and dis_loss_fn.compiled)
+
+    return first, steady, fallback
+
+
+def run(opt):
+    torch.set_num_threads(opt.threads)
+    data_iter = DataLoader(cfg.POSITIVE_FILE, cfg.BATCH_SIZE)
+    real, _ = next(data_iter)
+    print('SEQ_LEN = {}, BATCH_SIZE = {}, threads = {}'.format(cfg.SEQ_LEN, cfg.BATCH_SIZE, opt.threads))
+    print('{:<12}{:>14}{:>16}{:>18}{:>10}'.format('GD', 'eager [ms]', 'compiled [ms]', 'compile time [s]', 'speedup'))
+    for gd in opt.gd:
+        eager_first, eager, _ = run_mode(gd, False, opt.steps, opt.seed, real)
+        compiled_first, compiled, fallback = run_mode(gd, True, opt.steps, opt.seed, real)
+        print('{:<12}{:>14.2f}{:>16.2f}{:>18.2f}{:>10}'.format(
+            gd, 1000 * eager, 1000 * compiled, compiled_first - eager_first,
+            'x{:.2f}'.format(eager / compiled) + (' (eager fallback)' if fallback else '')))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='torch.compile adversarial step benchmark')
+    parser.add_argument('--gd', nargs='+', default=['REINFORCE', 'REBAR', 'RELAX'], choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
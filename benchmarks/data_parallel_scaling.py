@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+'''
+Strong scaling of data_parallel.py on one machine.
+
+The global batch (RunConfig.BATCH_SIZE) is split over 1, 2, 4, 8 and 16 gloo ranks,
+each rank using cores // world_size threads. Reports the mean time of an
+adversarial batch (G step + D epoch) after the warm-up batches, the speedup
+against the smallest world size (one rank by default) and the parallel efficiency.
+
+$ python -m benchmarks.data_parallel_scaling --gd RELAX --world_sizes 1 2 4 8 16
+'''
+
+import os
+import argparse
+
+import numpy as np
+import torch.multiprocessing as mp
+
+import data_parallel
+from config import RunConfig
+
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    cores = os.cpu_count() or 1
+    cfg = RunConfig(GD=opt.gd, TOTAL_BATCH=opt.batches + opt.warmup, CHECK_VARIANCE=False)
+    print('GD = {}, SEQ_LEN = {}, BATCH_SIZE = {}, cores = {}'.format(opt.gd, cfg.SEQ_LEN, cfg.BATCH_SIZE, cores))
+    print('{:>8}{:>8}{:>16}{:>10}{:>12}{:>14}'.format('ranks', 'shard', 'batch [s]', 'speedup', 'efficiency', 'param diff'))
+    reference = None
+    for world_size in opt.world_sizes:
+        if cfg.BATCH_SIZE % world_size != 0:
+            print('{:>8}  skipped, BATCH_SIZE is not divisible by the world size'.format(world_size))
+            continue
+        args = data_parallel.get_parser().parse_args([
+            '--world_size', str(world_size), '--d_batches', str(opt.d_batches), '--port', str(opt.port + world_size), '--no_eval'])
+        args.threads = opt.threads or max(1, cores // world_size)
+        queue = ctx.Queue()
+        data_parallel.launch(world_size, args, cfg, queue)
+        result = queue.get()
+        batch_time = np.mean(result['step_times'][opt.warmup:])
+        if reference is None:
+            # speedups are relative to the smallest world size
+            reference = (world_size, batch_time)
+        speedup = reference[1] / batch_time
+        print('{:>8}{:>8}{:>16.3f}{:>10}{:>12.2f}{:>14.2e}'.format(
+            world_size, cfg.BATCH_SIZE // world_size, batch_time, 'x{:.2f}'.format(speedup),
+            speedup * reference[0] / world_size, result['max_param_diff']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Data-parallel scaling benchmark')
+    parser.add_argument('--gd', default='RELAX', choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--d_batches', type=int, default=10, help='real batches per D epoch')
+    parser.add_argument('--threads', type=int, default=None, help='threads per rank (default: cores // world_size)')
+    parser.add_argument('--port', type=int, default=29600)
+    run(parser.parse_args())
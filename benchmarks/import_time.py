@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+'''
+Start-up time of the modules of the repo.
+
+Every target is imported --repeat times in a fresh interpreter and the median
+wall-clock time is reported, with the packages other than torch it loads whose
+cumulative import time is the largest (python -X importtime). The 'sample' target is the start-up
+of a tool which only loads the generator checkpoint and writes samples with
+utils.generate_samples. torch alone is reported as the floor.
+
+$ python -m benchmarks.import_time --targets torch generator utils main sample
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = '''
+import os
+import torch
+from generator import Generator
+from utils import generate_samples
+from config import Config
+generator = Generator(5, 32, 32, False)
+generator.load_state_dict(torch.load("checkpoints/MLE_space_False_length_3_preTrainG_epoch_0_official.pth", map_location="cpu"))
+generate_samples(generator, Config(generated_num=1024), os.devnull)
+'''
+
+def code(target):
+    return SAMPLE if target == 'sample' else 'import {}'.format(target)
+
+def wall_time(target):
+    timed = 'import time\n_start = time.perf_counter()\n{}\nprint(time.perf_counter() - _start)'.format(code(target))
+    out = subprocess.run([sys.executable, '-c', timed], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def heaviest(target, top):
+    """packages other than torch loaded by target, by cumulative import time [s]"""
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code(target)], cwd=ROOT,
+                         capture_output=True, text=True, check=True).stderr
+    packages = {}
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = (field.strip() for field in line[len('import time:'):].split('|'))
+        package = name.split('.')[0]
+        if name == name.lstrip() and package not in ('torch', target):  # not imported by a dependency
+            packages[package] = max(packages.get(package, 0.), int(cumulative) / 1e6)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+def run(opt):
+    print('{:<12}{:>14}'.format('target', 'import [s]'))
+    for target in opt.targets:
+        try:
+            times = [wall_time(target) for _ in range(opt.repeat)]
+        except subprocess.CalledProcessError as e:
+            print('{:<12}{:>14}'.format(target, 'failed'))
+            print('    ' + e.stderr.strip().splitlines()[-1])
+            continue
+        print('{:<12}{:>14.3f}'.format(target, np.median(times)))
+        if opt.top:
+            print('    ' + ', '.join('{} {:.3f}'.format(name, t) for name, t in heaviest(target, opt.top)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--targets', nargs='+', default=['torch', 'generator', 'utils', 'adversarial', 'main', 'sample'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5, help='heaviest packages listed per target, 0 to disable')
+    run(parser.parse_args())
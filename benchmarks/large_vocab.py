@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+'''
+Step time and memory of the large-vocabulary mode across vocabulary sizes.
+
+For every vocabulary size a fresh process runs, from randomly initialised models
+(random real tokens, default SEQ_LEN of config.RunConfig):
+    dense: full softmax output of G, D and c_phi_hat read vocabulary-wide one-hots
+    large: adaptive softmax output of G (cutoffs at --cutoffs fractions of the
+           vocabulary), D and c_phi_hat embed their inputs (EMBED_INPUTS)
+and reports the mean time of one sample call, of one generator_step followed by
+one discriminator_step, of one MLE step and the growth of the peak RSS.
+
+$ python -m benchmarks.large_vocab --vocab 1000 10000 50000 --gd REINFORCE
+'''
+
+import time
+import resource
+import argparse
+import multiprocessing as mp
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from utils import masked_forward
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from adversarial import generator_step, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+MODES = ('dense', 'large')
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+def build(vocab_size, mode, opt):
+    torch.manual_seed(opt.seed)
+    large = mode == 'large'
+    cutoffs = sorted({int(f * vocab_size) for f in opt.cutoffs if 0 < int(f * vocab_size) < vocab_size})
+    generator = Generator(vocab_size, cfg.g_emb_dim, cfg.g_hidden_dim, False,
+                          adaptive_cutoffs=cutoffs if large else None)
+    discriminator = LSTMDiscriminator(cfg.d_num_class, vocab_size, cfg.d_lstm_hidden_dim, False,
+                                      emb_dim=cfg.d_emb_dim if large else None)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, vocab_size, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len, embed_inputs=large)
+    return generator, discriminator, c_phi_hat
+
+def time_steps(vocab_size, mode, opt, queue):
+    torch.set_num_threads(opt.threads)
+    seq_len = cfg.g_sequence_len
+    generator, discriminator, c_phi_hat = build(vocab_size, mode, opt)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_optm = optim.Adam(generator.parameters())
+    dis_optm = optim.Adam(discriminator.parameters())
+    criterion = nn.NLLLoss(reduction='sum')
+
+    def sample():
+        with torch.no_grad():
+            generator.sample(opt.batch_size, seq_len)
+
+    def adversarial():
+        generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, opt.gd, opt.batch_size, seq_len,
+                       vocab_size, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA)
+        real = torch.randint(vocab_size, (opt.batch_size, seq_len))
+        fake = generator.sample(opt.batch_size, seq_len)
+        discriminator_step(discriminator, dis_optm, real, fake, vocab_size)
+
+    def mle():
+        tokens = torch.randint(vocab_size, (opt.batch_size, seq_len + 1))
+        pred, target, _ = masked_forward(generator, tokens[:, :-1], tokens[:, 1:], None, criterion)
+        loss = criterion(pred, target)
+        gen_optm.zero_grad()
+        loss.backward()
+        gen_optm.step()
+
+    results = []
+    rss_before = None
+    for step in (sample, adversarial, mle):
+        step() # warm-up
+        if rss_before is None:
+            rss_before = rss_mb()
+        start = time.perf_counter()
+        for _ in range(opt.steps):
+            step()
+        results.append((time.perf_counter() - start) / opt.steps)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(results + [peak - rss_before])
+
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    print('GD = {}, SEQ_LEN = {}, batch = {}, cutoffs = {}, threads = {}'.format(
+        opt.gd, cfg.SEQ_LEN, opt.batch_size, opt.cutoffs, opt.threads))
+    print('{:>8}{:>8}{:>14}{:>14}{:>12}{:>10}'.format('vocab', 'mode', 'sample [ms]', 'G+D [ms]', 'MLE [ms]', 'RSS [MB]'))
+    for vocab_size in opt.vocab:
+        for mode in MODES:
+            queue = ctx.Queue()
+            p = ctx.Process(target=time_steps, args=(vocab_size, mode, opt, queue))
+            p.start()
+            sample_time, adversarial_time, mle_time, delta = queue.get()
+            p.join()
+            print('{:>8}{:>8}{:>14.1f}{:>14.1f}{:>12.1f}{:>10.1f}'.format(
+                vocab_size, mode, 1000 * sample_time, 1000 * adversarial_time, 1000 * mle_time, delta))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Large-vocabulary mode benchmark')
+    parser.add_argument('--gd', default='REINFORCE', choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--vocab', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--cutoffs', type=float, nargs='+', default=[0.05, 0.25],
+                        help='adaptive softmax cutoffs as fractions of the vocabulary size')
+    parser.add_argument('--batch_size', type=int, default=cfg.BATCH_SIZE)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
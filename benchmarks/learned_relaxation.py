@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+'''
+Fixed vs learnt eta / relaxation temperature for REBAR and RELAX.
+
+Adversarial training (generator_step with CHECK_VARIANCE, then d_batches
+discriminator steps) runs from the official checkpoint with DEFAULT_ETA and
+DEFAULT_TEMPERATURE fixed, and with both learnt on the variance of the gradient
+(RelaxationParameters), until the goodness score of eval_num samples reaches the
+target or max_steps is hit. Reports the number of steps, the mean measured
+variance and the eta / temperature trajectories.
+
+$ python -m benchmarks.learned_relaxation --gd REBAR RELAX --target 0.6
+'''
+
+import argparse
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from utils import get_data_goodness_score
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork, RelaxationParameters
+from rollout import Rollout
+from data_loader import DataLoader
+from loss import VarianceLoss
+from adversarial import generator_step, variance_step, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def build(seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    return generator, discriminator, c_phi_hat
+
+def goodness(generator, num, loader):
+    with torch.no_grad():
+        samples = generator.sample(num, cfg.g_sequence_len)
+    return get_data_goodness_score(loader.convert_to_char(samples), cfg.SPACES)
+
+def steps_to_target(gd, learn, opt):
+    generator, discriminator, c_phi_hat = build(opt.seed)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_optm = optim.Adam(generator.parameters())
+    dis_optm = optim.Adam(discriminator.parameters())
+    c_phi_hat_loss = VarianceLoss()
+    c_phi_hat_optm = optim.Adam(c_phi_hat.parameters())
+    relaxation = RelaxationParameters(cfg.DEFAULT_ETA, cfg.DEFAULT_TEMPERATURE)
+    if learn:
+        c_phi_hat_optm.add_param_group({'params': relaxation.parameters(), 'lr': opt.lr})
+    update_c_phi_hat = lambda grads: variance_step(c_phi_hat_loss, c_phi_hat_optm, grads)
+    data_iter = DataLoader(cfg.POSITIVE_FILE, cfg.BATCH_SIZE)
+    eval_loader = DataLoader(cfg.EVAL_FILE, cfg.BATCH_SIZE)
+
+    variances, trajectory, score = [], [], goodness(generator, opt.eval_num, eval_loader)
+    for step in range(1, opt.max_steps + 1):
+        _, _, true_variance = generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, gd, cfg.BATCH_SIZE,
+                                             cfg.g_sequence_len, cfg.VOCAB_SIZE, relaxation.temperature, relaxation.eta,
+                                             check_variance=True, variance_fn=update_c_phi_hat, per_sample=opt.per_sample)
+        variances.append(true_variance.mean().item())
+        trajectory.append((relaxation.eta.item(), relaxation.temperature.item()))
+        for _ in range(opt.d_batches):
+            try:
+                data, _ = next(data_iter)
+            except StopIteration:
+                data_iter.reset()
+                data, _ = next(data_iter)
+            fake = generator.sample(data.size(0), cfg.g_sequence_len)
+            discriminator_step(discriminator, dis_optm, data, fake, cfg.VOCAB_SIZE)
+        if step % opt.eval_every == 0:
+            score = goodness(generator, opt.eval_num, eval_loader)
+            if score >= opt.target:
+                return step, score, variances, trajectory, True
+    return opt.max_steps, score, variances, trajectory, False
+
+
+def run(opt):
+    torch.set_num_threads(opt.threads)
+    print('SEQ_LEN = {}, BATCH_SIZE = {}, target goodness = {}, variance objective = {}'.format(
+        cfg.SEQ_LEN, cfg.BATCH_SIZE, opt.target, 'per-sample' if opt.per_sample else 'single-sample'))
+    print('{:<12}{:<10}{:>8}{:>12}{:>14}{:>10}{:>14}'.format('GD', 'eta/temp', 'steps', 'goodness', 'mean var', 'eta', 'temperature'))
+    for gd in opt.gd:
+        for learn in (False, True):
+            steps, score, variances, trajectory, reached = steps_to_target(gd, learn, opt)
+            eta, temperature = trajectory[-1]
+            print('{:<12}{:<10}{:>8}{:>12.4f}{:>14.3e}{:>10.4f}{:>14.4f}{}'.format(
+                gd, 'learnt' if learn else 'fixed', steps, score, np.mean(variances), eta, temperature,
+                '' if reached else ' (target not reached)'))
+            if learn and opt.trajectory:
+                for step in range(0, len(trajectory), opt.eval_every):
+                    print('    step {:>5}: eta {:.4f}, temperature {:.4f}, variance {:.3e}'.format(
+                        step + 1, trajectory[step][0], trajectory[step][1], variances[step]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Learnt REBAR / RELAX eta and temperature benchmark')
+    parser.add_argument('--gd', nargs='+', default=['REBAR', 'RELAX'], choices=['REBAR', 'RELAX'])
+    parser.add_argument('--per_sample', action='store_true', help='per-sample variance objective (default: single-sample)')
+    parser.add_argument('--lr', type=float, default=cfg.RELAXATION_LR)
+    parser.add_argument('--target', type=float, default=0.6)
+    parser.add_argument('--max_steps', type=int, default=200)
+    parser.add_argument('--d_batches', type=int, default=5, help='discriminator steps per generator step')
+    parser.add_argument('--eval_every', type=int, default=5)
+    parser.add_argument('--eval_num', type=int, default=2000)
+    parser.add_argument('--trajectory', action='store_true', help='print the eta / temperature trajectories')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+'''
+Memory and time of the long-sequence mode across sequence lengths.
+
+For every length a fresh process runs, from randomly initialised models (the
+filter sizes of c_phi_hat come from helpers.conv_filters):
+    adversarial: one generator_step and one discriminator_step on random real
+                 tokens, without and with activation checkpointing of the G and
+                 D LSTMs (--segment steps per segment)
+    mle:         one MLE pre-training step of G on the whole sequences and with
+                 truncated backpropagation through time (--bptt steps per window)
+and reports the mean step time and the growth of the peak RSS over the warm-up.
+
+$ python -m benchmarks.long_sequence --lengths 15 64 128 256 --gd RELAX
+'''
+
+import time
+import resource
+import argparse
+import multiprocessing as mp
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from utils import masked_forward, truncated_bptt_step
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from helpers import conv_filters
+from adversarial import generator_step, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+CONFIGS = (('adversarial', 'plain'), ('adversarial', 'checkpoint'), ('mle', 'full'), ('mle', 'bptt'))
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+def build(seq_len, segment, seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False, checkpoint_segment=segment)
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False, checkpoint_segment=segment)
+    filter_sizes, num_filters = conv_filters(seq_len, odd=True)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, filter_sizes, num_filters, cfg.d_dropout, seq_len)
+    return generator, discriminator, c_phi_hat
+
+def make_step(kind, mode, seq_len, opt):
+    generator, discriminator, c_phi_hat = build(seq_len, opt.segment if mode == 'checkpoint' else None, opt.seed)
+    gen_optm = optim.Adam(generator.parameters())
+    if kind == 'adversarial':
+        rollout = Rollout(generator, cfg.UPDATE_RATE)
+        dis_optm = optim.Adam(discriminator.parameters())
+
+        def step():
+            generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, opt.gd, opt.batch_size, seq_len,
+                           cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, check_variance=opt.check_variance,
+                           per_sample=False)
+            real = torch.randint(cfg.VOCAB_SIZE, (opt.batch_size, seq_len))
+            fake = generator.sample(opt.batch_size, seq_len)
+            discriminator_step(discriminator, dis_optm, real, fake, cfg.VOCAB_SIZE)
+        return step
+
+    criterion = nn.NLLLoss(reduction='sum')
+
+    def step():
+        tokens = torch.randint(cfg.VOCAB_SIZE, (opt.batch_size, seq_len + 1))
+        data, target = tokens[:, :-1], tokens[:, 1:]
+        if mode == 'bptt':
+            truncated_bptt_step(generator, data, target, None, criterion, gen_optm, opt.bptt)
+        else:
+            pred, target, _ = masked_forward(generator, data, target, None, criterion)
+            loss = criterion(pred, target)
+            gen_optm.zero_grad()
+            loss.backward()
+            gen_optm.step()
+    return step
+
+def time_step(kind, mode, seq_len, opt, queue):
+    torch.set_num_threads(opt.threads)
+    step = make_step(kind, mode, seq_len, opt)
+    step() # warm-up
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    for _ in range(opt.steps):
+        step()
+    step_time = (time.perf_counter() - start) / opt.steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((step_time, peak - rss_before))
+
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    print('GD = {}, batch = {}, check_variance = {}, segment = {}, bptt = {}, threads = {}'.format(
+        opt.gd, opt.batch_size, opt.check_variance, opt.segment, opt.bptt, opt.threads))
+    print('{:>8}{:>14}{:>12}{:>14}{:>16}'.format('SEQ_LEN', 'step', 'mode', 'step [ms]', 'step RSS [MB]'))
+    for seq_len in opt.lengths:
+        for kind, mode in CONFIGS:
+            queue = ctx.Queue()
+            p = ctx.Process(target=time_step, args=(kind, mode, seq_len, opt, queue))
+            p.start()
+            step_time, delta = queue.get()
+            p.join()
+            print('{:>8}{:>14}{:>12}{:>14.1f}{:>16.1f}'.format(seq_len, kind, mode, 1000 * step_time, delta))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Long-sequence mode benchmark')
+    parser.add_argument('--gd', default='RELAX', choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[15, 64, 128, 256])
+    parser.add_argument('--batch_size', type=int, default=cfg.BATCH_SIZE)
+    parser.add_argument('--check_variance', action='store_true', help='per-batch estimate with the double-backward graph')
+    parser.add_argument('--segment', type=int, default=16, help='LSTM steps per checkpointed segment')
+    parser.add_argument('--bptt', type=int, default=32, help='truncated backpropagation window of the MLE step')
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
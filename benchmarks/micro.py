@@ -0,0 +1,230 @@
+# -*- coding:utf-8 -*-
+'''
+Microbenchmarks of the hot functions of the repo.
+
+Every case is timed for each SEQ_LEN x batch size x thread count of the grid,
+on inputs built from a fixed seed (the RNG is reseeded before every round, so
+the rounds do the same work). A round runs the function as many times as fit in
+--min_time, the time per call of --repeat rounds is reported (median and min).
+
+The results are written to --out (JSON). With --baseline, the median of every
+configuration is compared to the one of that file (a previous --out, e.g. of
+the parent commit) and the configurations slower by more than --threshold are
+reported as regressions; the exit status is then 1.
+
+$ python -m benchmarks.micro --out runs/micro.json
+$ python -m benchmarks.micro --cases sample c_phi_out_RELAX --seq_lens 15 --baseline runs/micro.json
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+
+import numpy as np
+import torch
+
+import utils
+from helpers import convert_to_one_hot, conv_filters
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from loss import GANLoss, VarianceLoss
+from eval.BLEU_score import BLEU_score
+from config import Config
+
+VOCAB_SIZE = 5
+CHARS = 'x+-*/'
+
+# every case builds, from (seq_len, batch_size), the function to time, or None if it does not apply
+
+def generator(seq_len, batch_size):
+    return Generator(VOCAB_SIZE, 32, 32, False)
+
+def theta_prime(seq_len, batch_size):
+    """output distribution of G, dims: (batch_size * seq_len, vocab_size)"""
+    return torch.softmax(torch.randn(batch_size * seq_len, VOCAB_SIZE), 1)
+
+def strings(seq_len, batch_size):
+    return [''.join(random.choice(CHARS) for _ in range(seq_len)) for _ in range(batch_size)]
+
+def case_sample(seq_len, batch_size):
+    g = generator(seq_len, batch_size)
+    return lambda: g.sample(batch_size, seq_len)
+
+def case_convert_to_one_hot(seq_len, batch_size):
+    data = torch.randint(VOCAB_SIZE, (batch_size, seq_len))
+    return lambda: convert_to_one_hot(data, VOCAB_SIZE, False)
+
+def case_sample_one_hot(seq_len, batch_size):
+    theta = theta_prime(seq_len, batch_size)
+    return lambda: utils.sample_one_hot(theta, seq_len, VOCAB_SIZE, False)
+
+def case_categorical_re_param(seq_len, batch_size):
+    theta = theta_prime(seq_len, batch_size)
+    b = theta.multinomial(1).view(-1)
+    return lambda: utils.categorical_re_param(theta, VOCAB_SIZE, b)
+
+def c_phi_out_case(GD):
+    def case(seq_len, batch_size):
+        discriminator = LSTMDiscriminator(2, VOCAB_SIZE, 32, False)
+        filter_sizes, num_filters = conv_filters(seq_len, odd=True)
+        c_phi_hat = AnnexNetwork(2, VOCAB_SIZE, 64, filter_sizes, num_filters, 0.75, seq_len)
+        theta = theta_prime(seq_len, batch_size).requires_grad_()
+        return lambda: utils.c_phi_out(GD, c_phi_hat, theta, discriminator, seq_len, temperature=1., eta=1.)
+    return case
+
+def generator_output(seq_len, batch_size):
+    """G, samples, its log-probabilities (batch_size, seq_len, vocab_size) with their graph, rewards"""
+    g = generator(seq_len, batch_size)
+    samples = g.sample(batch_size, seq_len)
+    inputs = torch.cat([torch.zeros(batch_size, 1).long(), samples[:, :-1]], 1)
+    prob = g.forward(inputs).view(batch_size, seq_len, VOCAB_SIZE)
+    return g, samples, prob, torch.rand(batch_size)
+
+def case_forward_reward(seq_len, batch_size):
+    _, samples, prob, rewards = generator_output(seq_len, batch_size)
+    return lambda: GANLoss().forward_reward(0, samples, prob, rewards, batch_size, seq_len, VOCAB_SIZE)
+
+def case_forward_reward_grads(seq_len, batch_size):
+    g, samples, prob, rewards = generator_output(seq_len, batch_size)
+    return lambda: GANLoss().forward_reward_grads(samples, prob, rewards, g, batch_size, seq_len, VOCAB_SIZE)
+
+def per_sample_grads(seq_len, batch_size):
+    return [[torch.randn(p.size()) for p in generator(seq_len, batch_size).parameters()] for _ in range(batch_size)]
+
+def case_variance_loss(seq_len, batch_size):
+    grads = per_sample_grads(seq_len, batch_size)
+    return lambda: VarianceLoss().forward(grads)
+
+def case_variance(seq_len, batch_size):
+    grads = per_sample_grads(seq_len, batch_size)
+    return lambda: VarianceLoss().forward_variance(grads)
+
+def case_goodness_score(seq_len, batch_size):
+    data = strings(seq_len, batch_size)
+    return lambda: utils.get_data_goodness_score(data)
+
+def case_data_freq(seq_len, batch_size):
+    if seq_len not in (3, 15):
+        return None  # no ground truth frequencies
+    data = strings(seq_len, batch_size)
+    config = Config(seq_len=seq_len, vocab_size=VOCAB_SIZE, batch_size=batch_size)
+    return lambda: utils.get_data_freq(data, config)
+
+def case_char_freq(seq_len, batch_size):
+    data = strings(seq_len, batch_size)
+    return lambda: utils.get_char_freq(data, False)
+
+def case_BLEU_score(seq_len, batch_size):
+    # every string of the batch against two references, 3-grams
+    candidates = [' '.join(s) for s in strings(seq_len, batch_size)]
+    references = [' '.join(s) for s in strings(seq_len, 2)]
+    return lambda: [BLEU_score(candidate, references, 3) for candidate in candidates]
+
+CASES = {
+    'sample': case_sample,
+    'convert_to_one_hot': case_convert_to_one_hot,
+    'sample_one_hot': case_sample_one_hot,
+    'categorical_re_param': case_categorical_re_param,
+    'c_phi_out_REBAR': c_phi_out_case('REBAR'),
+    'c_phi_out_RELAX': c_phi_out_case('RELAX'),
+    'forward_reward': case_forward_reward,
+    'forward_reward_grads': case_forward_reward_grads,
+    'variance_loss': case_variance_loss,
+    'variance': case_variance,
+    'goodness_score': case_goodness_score,
+    'data_freq': case_data_freq,
+    'char_freq': case_char_freq,
+    'BLEU_score': case_BLEU_score,
+}
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def measure(fn, seed, min_time, repeat):
+    """times per call of repeat rounds, and the number of calls per round"""
+    seed_all(seed)
+    fn()  # warm-up (lazy imports and allocations)
+    start = time.perf_counter()
+    fn()
+    calls = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+    times = []
+    for _ in range(repeat):
+        seed_all(seed)
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        times.append((time.perf_counter() - start) / calls)
+    return times, calls
+
+def key(result):
+    return result['case'], result['seq_len'], result['batch_size'], result['threads']
+
+def run(opt):
+    baseline = {}
+    if opt.baseline is not None:
+        with open(opt.baseline) as f:
+            baseline = {key(r): r for r in json.load(f)['results']}
+
+    print('{:<22}{:>8}{:>8}{:>8}{:>14}{:>14}{:>8}{:>12}'.format(
+        'case', 'seq_len', 'batch', 'threads', 'median [ms]', 'min [ms]', 'calls', 'vs baseline'))
+    results, regressions = [], []
+    for name in opt.cases:
+        for seq_len in opt.seq_lens:
+            for batch_size in opt.batch_sizes:
+                seed_all(opt.seed)
+                fn = CASES[name](seq_len, batch_size)
+                if fn is None:
+                    continue
+                for threads in opt.threads:
+                    torch.set_num_threads(threads)
+                    times, calls = measure(fn, opt.seed, opt.min_time, opt.repeat)
+                    result = dict(case=name, seq_len=seq_len, batch_size=batch_size, threads=threads,
+                                  median=float(np.median(times)), min=float(np.min(times)), calls=calls, times=times)
+                    results.append(result)
+                    ratio = ''
+                    if key(result) in baseline:
+                        result['baseline_ratio'] = result['median'] / baseline[key(result)]['median']
+                        ratio = '{:.2f}x'.format(result['baseline_ratio'])
+                        if result['baseline_ratio'] > 1 + opt.threshold:
+                            regressions.append(result)
+                            ratio += ' !'
+                    print('{:<22}{:>8}{:>8}{:>8}{:>14.4f}{:>14.4f}{:>8}{:>12}'.format(
+                        name, seq_len, batch_size, threads, result['median'] * 1e3, result['min'] * 1e3, calls, ratio))
+
+    meta = dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(), torch=torch.__version__,
+                machine=platform.machine(), processor=platform.processor(), cpu_count=os.cpu_count(), seed=opt.seed,
+                min_time=opt.min_time, repeat=opt.repeat)
+    os.makedirs(os.path.dirname(opt.out) or '.', exist_ok=True)
+    with open(opt.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('Results: {}'.format(opt.out))
+    if regressions:
+        print('{} regressions (median slower than the baseline by more than {:.0%}):'.format(len(regressions), opt.threshold))
+        for r in regressions:
+            print('    {} seq_len={} batch={} threads={}: {:.2f}x'.format(r['case'], r['seq_len'], r['batch_size'], r['threads'],
+                                                                          r['baseline_ratio']))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the hot functions')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[3, 15, 64])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128, 1024])
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, torch.get_num_threads()}))
+    parser.add_argument('--seed', type=int, default=88)
+    parser.add_argument('--min_time', type=float, default=0.1, help='seconds per round')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per configuration')
+    parser.add_argument('--out', default=os.path.join('runs', 'micro.json'))
+    parser.add_argument('--baseline', default=None, help='results of a previous run to compare to')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slow-down reported as a regression')
+    run(parser.parse_args())
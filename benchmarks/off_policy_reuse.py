@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+'''
+Wall-clock to a target goodness score with and without off-policy sample reuse.
+
+For every GD, adversarial training (generator_step, then d_batches discriminator
+steps) runs from the official checkpoint with OFF_POLICY_K = 0 and with the
+given K, until the goodness score of eval_num samples reaches the target or
+max_batches is hit. The evaluation time is not counted.
+
+$ python -m benchmarks.off_policy_reuse --gd REINFORCE RELAX --K 4 --target 0.8
+'''
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from utils import get_data_goodness_score
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from data_loader import DataLoader
+from replay_buffer import OffPolicyBuffer
+from adversarial import generator_step, discriminator_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def build(seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    return generator, discriminator, c_phi_hat
+
+def goodness(generator, num, loader):
+    with torch.no_grad():
+        samples = generator.sample(num, cfg.g_sequence_len)
+    return get_data_goodness_score(loader.convert_to_char(samples), cfg.SPACES)
+
+def time_to_target(gd, K, opt, seed):
+    generator, discriminator, c_phi_hat = build(seed)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_optm = optim.Adam(generator.parameters())
+    dis_optm = optim.Adam(discriminator.parameters())
+    off_policy = OffPolicyBuffer(K) if K > 0 else None
+    data_iter = DataLoader(cfg.POSITIVE_FILE, cfg.BATCH_SIZE)
+    eval_loader = DataLoader(cfg.EVAL_FILE, cfg.BATCH_SIZE)
+
+    elapsed, score = 0., goodness(generator, opt.eval_num, eval_loader)
+    for batch in range(1, opt.max_batches + 1):
+        start = time.perf_counter()
+        generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, gd, cfg.BATCH_SIZE, cfg.g_sequence_len,
+                       cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, off_policy=off_policy, truncation=opt.truncation)
+        for _ in range(opt.d_batches):
+            try:
+                data, _ = next(data_iter)
+            except StopIteration:
+                data_iter.reset()
+                data, _ = next(data_iter)
+            fake = generator.sample(data.size(0), cfg.g_sequence_len)
+            discriminator_step(discriminator, dis_optm, data, fake, cfg.VOCAB_SIZE)
+        elapsed += time.perf_counter() - start
+        if batch % opt.eval_every == 0:
+            score = goodness(generator, opt.eval_num, eval_loader)
+            if score >= opt.target:
+                return elapsed, batch, score, True
+    return elapsed, opt.max_batches, score, False
+
+
+def run(opt):
+    torch.set_num_threads(opt.threads)
+    print('SEQ_LEN = {}, BATCH_SIZE = {}, target goodness = {}, truncation = {}'.format(
+        cfg.SEQ_LEN, cfg.BATCH_SIZE, opt.target, opt.truncation))
+    print('{:<12}{:>4}{:>14}{:>10}{:>18}{:>12}'.format('GD', 'K', 'wall [s]', 'batches', 'sampled seqs', 'goodness'))
+    for gd in opt.gd:
+        for K in (0, opt.K):
+            results = [time_to_target(gd, K, opt, opt.seed + r) for r in range(opt.repeat)]
+            elapsed, batches, score, reached = (np.mean([r[i] for r in results]) for i in range(4))
+            print('{:<12}{:>4}{:>14.2f}{:>10.1f}{:>18.0f}{:>12.4f}{}'.format(
+                gd, K, elapsed, batches, batches * cfg.BATCH_SIZE, score,
+                '' if reached == 1 else ' (target not reached in {:.0%} of the runs)'.format(1 - reached)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Off-policy sample reuse benchmark')
+    parser.add_argument('--gd', nargs='+', default=['REINFORCE', 'REBAR', 'RELAX'], choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--K', type=int, default=4)
+    parser.add_argument('--truncation', type=float, default=1.0)
+    parser.add_argument('--target', type=float, default=0.8)
+    parser.add_argument('--max_batches', type=int, default=200)
+    parser.add_argument('--d_batches', type=int, default=5, help='discriminator steps per adversarial batch')
+    parser.add_argument('--eval_every', type=int, default=5)
+    parser.add_argument('--eval_num', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+'''
+fp32 vs dynamic int8 inference for sampling, evaluation and rewards.
+
+Uses the default SEQ_LEN / SPACES / weights_path of config.RunConfig.
+
+$ python -m benchmarks.quantized_inference
+'''
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.autograd import Variable
+
+from utils import get_data_goodness_score, get_data_freq, get_char_freq
+from helpers import convert_to_one_hot
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from rollout import Rollout
+from data_loader import DataLoader
+from quantized import QuantizedInference
+from config import Config
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def sample_all(generator, num, batch_size, seq_len):
+    samples = []
+    for _ in range(int(np.ceil(num / batch_size))):
+        samples.append(generator.sample(batch_size, seq_len).data)
+    return torch.cat(samples, 0)[:num]
+
+def score(samples, seq_len, spaces):
+    loader = DataLoader(cfg.EVAL_FILE, cfg.BATCH_SIZE)
+    strings = loader.convert_to_char(samples)
+    goodness = get_data_goodness_score(strings, spaces)
+    kl = get_data_freq(strings, Config(seq_len=seq_len, vocab_size=cfg.VOCAB_SIZE)) if not spaces else -1
+    return goodness, kl, get_char_freq(strings, spaces)
+
+def train_discriminator(discriminator, generator, data_iter, steps, vocab_size, seq_len):
+    # a few adversarial D steps so that the rewards are not those of a random network
+    optimizer = optim.Adam(discriminator.parameters())
+    criterion = nn.BCELoss()
+    for _ in range(steps):
+        try:
+            data, _ = next(data_iter)
+        except StopIteration:
+            data_iter.reset()
+            data, _ = next(data_iter)
+        real = convert_to_one_hot(Variable(data), vocab_size, False)
+        fake = convert_to_one_hot(generator.sample(data.size(0), seq_len), vocab_size, False)
+        real_pred = torch.exp(discriminator(real)[:, :-1])
+        fake_pred = torch.exp(discriminator(fake)[:, :-1])
+        loss = criterion(real_pred, torch.ones_like(real_pred)) + criterion(fake_pred, torch.zeros_like(fake_pred))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+def timed(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def run(opt):
+    torch.manual_seed(opt.seed)
+    np.random.seed(opt.seed)
+    torch.set_num_threads(opt.threads)
+    seq_len = cfg.g_sequence_len
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    train_discriminator(discriminator, generator, DataLoader(cfg.POSITIVE_FILE, opt.batch_size), opt.d_steps, cfg.VOCAB_SIZE, seq_len)
+
+    start = time.perf_counter()
+    quantized = QuantizedInference(generator, discriminator)
+    quantized.refresh()
+    refresh_time = time.perf_counter() - start
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+
+    report = {}
+    with torch.no_grad():
+        for name, g, d in (('fp32', generator, discriminator), ('int8', quantized.generator, quantized.discriminator)):
+            torch.manual_seed(opt.seed)
+            sample_time, samples = timed(lambda: sample_all(g, opt.num, opt.batch_size, seq_len), opt.repeat)
+            goodness, kl, freq = score(samples, seq_len, cfg.SPACES)
+            batch = samples[:opt.batch_size]
+            reward_time, rewards = timed(lambda: rollout.get_reward(batch, d, cfg.VOCAB_SIZE, False), opt.repeat * 10)
+            report[name] = dict(sample_time=sample_time, reward_time=reward_time, goodness=goodness, kl=kl, freq=freq, rewards=rewards)
+
+    fp32, int8 = report['fp32'], report['int8']
+    print('seq_len = {}, num = {}, batch_size = {}, threads = {}'.format(seq_len, opt.num, opt.batch_size, opt.threads))
+    print('quantization (refresh) time: {:.4f}s'.format(refresh_time))
+    print('{:<8}{:>14}{:>14}{:>12}{:>12}'.format('', 'sample [s]', 'reward [ms]', 'goodness', 'KL'))
+    for name in ('fp32', 'int8'):
+        r = report[name]
+        print('{:<8}{:>14.4f}{:>14.3f}{:>12.4f}{:>12.4f}'.format(name, r['sample_time'], 1000 * r['reward_time'], r['goodness'], r['kl']))
+    print('speedup: sampling x{:.2f}, reward x{:.2f}'.format(fp32['sample_time'] / int8['sample_time'], fp32['reward_time'] / int8['reward_time']))
+    print('drift: goodness {:+.4f}, KL {:+.4f}, char distribution L1 {:.4f}'.format(
+        int8['goodness'] - fp32['goodness'], int8['kl'] - fp32['kl'], np.abs(int8['freq'] - fp32['freq']).sum()))
+    print('reward drift (log-prob): mean abs {:.5f}, max abs {:.5f}'.format(
+        np.abs(int8['rewards'] - fp32['rewards']).mean(), np.abs(int8['rewards'] - fp32['rewards']).max()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Quantized inference benchmark')
+    parser.add_argument('--num', type=int, default=cfg.GENERATED_NUM)
+    parser.add_argument('--batch_size', type=int, default=cfg.BATCH_SIZE)
+    parser.add_argument('--d_steps', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+'''
+Variance of the RELAX gradient estimate while c_phi_hat is trained.
+
+Adversarial G steps (as in main.main with CHECK_VARIANCE, D frozen) are run
+with c_phi_hat frozen, trained on the per-sample variance objective and trained
+on the single-sample (batch gradient) objective. Every measure_every steps the
+variance of the per-sample estimates of the last generator layer is measured on
+a fresh batch. The curves are saved to charts/relax_variance_seq{SEQ_LEN}.png.
+
+$ python -m benchmarks.relax_variance --steps 100
+'''
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from loss import VarianceLoss
+from adversarial import generator_loss, estimator_grads, generator_step, variance_step
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+MODES = ('frozen', 'per_sample', 'single')
+
+def build(seed):
+    torch.manual_seed(seed)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    return generator, discriminator, c_phi_hat
+
+def measure(generator, discriminator, c_phi_hat, rollout, gd):
+    """mean variance of the per-sample estimates of the last layer of the generator"""
+    samples = generator.sample(cfg.BATCH_SIZE, cfg.g_sequence_len)
+    rewards = torch.exp(torch.Tensor(rollout.get_reward(samples, discriminator, cfg.VOCAB_SIZE, False))).view(-1)
+    _, prob, c_z, c_z_tilde = generator_loss(generator, discriminator, c_phi_hat, samples, rewards, gd,
+                                             cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA)
+    grads = estimator_grads(generator, samples, prob, rewards, c_z, c_z_tilde, gd, per_sample=True)
+    variance_loss = VarianceLoss()
+    return variance_loss.variance(variance_loss.moments(grads)).mean().item()
+
+def run_mode(mode, opt):
+    generator, discriminator, c_phi_hat = build(opt.seed)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_optm = optim.Adam(generator.parameters())
+    c_phi_hat_loss = VarianceLoss()
+    c_phi_hat_optm = optim.Adam(c_phi_hat.parameters(), lr=opt.lr)
+    variance_fn = None
+    if mode != 'frozen':
+        variance_fn = lambda grads: variance_step(c_phi_hat_loss, c_phi_hat_optm, grads)
+    variances, elapsed = [], 0.
+    for step in range(opt.steps + 1):
+        if step % opt.measure_every == 0:
+            torch.manual_seed(opt.seed + step)
+            variances.append(measure(generator, discriminator, c_phi_hat, rollout, opt.gd))
+        if step == opt.steps:
+            break
+        start = time.perf_counter()
+        generator_step(generator, discriminator, c_phi_hat, rollout, gen_optm, opt.gd, cfg.BATCH_SIZE, cfg.g_sequence_len,
+                       cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, check_variance=True,
+                       variance_fn=variance_fn, per_sample=mode == 'per_sample')
+        elapsed += time.perf_counter() - start
+    return variances, elapsed / opt.steps
+
+
+def run(opt):
+    torch.set_num_threads(opt.threads)
+    print('GD = {}, SEQ_LEN = {}, BATCH_SIZE = {}, steps = {}'.format(opt.gd, cfg.SEQ_LEN, cfg.BATCH_SIZE, opt.steps))
+    print('{:<12}{:>14}{:>14}{:>14}{:>10}'.format('c_phi_hat', 'step [ms]', 'first var', 'last var', 'ratio'))
+    curves = {}
+    for mode in opt.modes:
+        variances, step_time = run_mode(mode, opt)
+        curves[mode] = variances
+        first, last = np.mean(variances[:opt.window]), np.mean(variances[-opt.window:])
+        print('{:<12}{:>14.1f}{:>14.3e}{:>14.3e}{:>10.2f}'.format(mode, 1000 * step_time, first, last, last / first))
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    for mode, variances in curves.items():
+        plt.plot(np.arange(len(variances)) * opt.measure_every, variances, label=mode)
+    plt.yscale('log')
+    plt.xlabel('generator step')
+    plt.legend()
+    plt.title('{} gradient variance, SEQ_LEN = {}'.format(opt.gd, cfg.SEQ_LEN))
+    path = os.path.join('charts', 'relax_variance_seq{}.png'.format(cfg.SEQ_LEN))
+    plt.savefig(path)
+    print('variance curves saved to {}'.format(path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='RELAX control variate training benchmark')
+    parser.add_argument('--gd', default='RELAX', choices=['REBAR', 'RELAX'])
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--measure_every', type=int, default=5)
+    parser.add_argument('--window', type=int, default=3, help='measurements averaged at the start and at the end')
+    parser.add_argument('--lr', type=float, default=1e-3, help='learning rate of c_phi_hat')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=cfg.SEED)
+    run(parser.parse_args())
@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+'''
+Throughput of K stacked replicas (stacked.py) against K separate replicas.
+
+One adversarial batch of a replica is a generator step, the sampling of the
+GENERATED_NUM evaluation sequences and --d_batches discriminator steps on random
+real batches (default RunConfig otherwise, from the pre-trained G). For every K
+a fresh process times --batches batches of
+    separate: K Generator / LSTMDiscriminator / AnnexNetwork triples, one after
+              the other (adversarial.generator_step, discriminator_step)
+    stacked:  one StackedGenerator / StackedLSTMDiscriminator / StackedAnnexNetwork
+and reports the replica-batches per second and the speed-up.
+
+$ python -m benchmarks.stacked_replicas --replicas 1 4 8 --gd RELAX --check_variance
+'''
+
+import os
+import time
+import argparse
+import multiprocessing as mp
+
+import torch
+import torch.optim as optim
+
+import stacked
+from utils import generate_samples
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from loss import VarianceLoss
+from adversarial import generator_step, discriminator_step, ControlVariateUpdate
+from config import RunConfig
+
+cfg = RunConfig()
+
+
+def separate_batches(seeds, opt):
+    replicas = []
+    for seed in seeds:
+        generator, discriminator, c_phi_hat, _ = stacked.build(cfg, [seed])
+        # the same initialisation, unstacked into the plain modules
+        g = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+        g.load_state_dict(generator.replica_state_dict(0))
+        d = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+        d.load_state_dict(discriminator.replica_state_dict(0))
+        c = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                         cfg.d_dropout, cfg.g_sequence_len)
+        c.load_state_dict(c_phi_hat.replica_state_dict(0))
+        replicas.append((g, d, c, Rollout(g, cfg.UPDATE_RATE), optim.Adam(g.parameters()), optim.Adam(d.parameters()),
+                         ControlVariateUpdate(VarianceLoss(), optim.Adam(c.parameters()))))
+
+    def batch():
+        for g, d, c, rollout, gen_optm, dis_optm, update_c_phi_hat in replicas:
+            generator_step(g, d, c, rollout, gen_optm, opt.gd, cfg.BATCH_SIZE, cfg.g_sequence_len, cfg.VOCAB_SIZE,
+                           cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, check_variance=opt.check_variance,
+                           variance_fn=update_c_phi_hat, per_sample=cfg.VARIANCE_PER_SAMPLE)
+            generate_samples(g, cfg, os.devnull)
+            for _ in range(opt.d_batches):
+                real = torch.randint(cfg.VOCAB_SIZE, (cfg.BATCH_SIZE, cfg.g_sequence_len))
+                discriminator_step(d, dis_optm, real, g.sample(cfg.BATCH_SIZE, cfg.g_sequence_len), cfg.VOCAB_SIZE)
+    return batch
+
+def stacked_batches(seeds, opt):
+    generator, discriminator, c_phi_hat, _ = stacked.build(cfg, seeds)
+    gen_optm = optim.Adam(generator.parameters())
+    dis_optm = optim.Adam(discriminator.parameters())
+    update_c_phi_hat = ControlVariateUpdate(VarianceLoss(), optim.Adam(c_phi_hat.parameters()))
+
+    def batch():
+        stacked.generator_step(generator, discriminator, c_phi_hat, gen_optm, opt.gd, cfg.BATCH_SIZE, cfg.g_sequence_len,
+                               cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA, check_variance=opt.check_variance,
+                               variance_fn=update_c_phi_hat, per_sample=cfg.VARIANCE_PER_SAMPLE)
+        for size in [cfg.BATCH_SIZE] * int(cfg.GENERATED_NUM / cfg.BATCH_SIZE) + [cfg.GENERATED_NUM % cfg.BATCH_SIZE]:
+            if size:
+                generator.sample(size, cfg.g_sequence_len)
+        for _ in range(opt.d_batches):
+            real = torch.randint(cfg.VOCAB_SIZE, (len(seeds), cfg.BATCH_SIZE, cfg.g_sequence_len))
+            stacked.discriminator_step(discriminator, dis_optm, real, generator.sample(cfg.BATCH_SIZE, cfg.g_sequence_len),
+                                       cfg.VOCAB_SIZE)
+    return batch
+
+def time_batches(K, mode, opt, queue):
+    torch.set_num_threads(opt.threads)
+    seeds = [cfg.SEED + k for k in range(K)]
+    batch = (stacked_batches if mode == 'stacked' else separate_batches)(seeds, opt)
+    batch()  # warm-up
+    start = time.perf_counter()
+    for _ in range(opt.batches):
+        batch()
+    queue.put(K * opt.batches / (time.perf_counter() - start))
+
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    print('GD = {}, check_variance = {}, SEQ_LEN = {}, batch = {}, D batches = {}, threads = {}'.format(
+        opt.gd, opt.check_variance, cfg.SEQ_LEN, cfg.BATCH_SIZE, opt.d_batches, opt.threads))
+    print('{:>4}{:>22}{:>22}{:>10}'.format('K', 'separate [batch/s]', 'stacked [batch/s]', 'speed-up'))
+    for K in opt.replicas:
+        rates = []
+        for mode in ('separate', 'stacked'):
+            queue = ctx.Queue()
+            p = ctx.Process(target=time_batches, args=(K, mode, opt, queue))
+            p.start()
+            rates.append(queue.get())
+            p.join()
+        print('{:>4}{:>22.3f}{:>22.3f}{:>10.2f}'.format(K, rates[0], rates[1], rates[1] / rates[0]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Stacked replicas benchmark')
+    parser.add_argument('--gd', default='RELAX', choices=['REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--replicas', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--check_variance', action='store_true')
+    parser.add_argument('--d_batches', type=int, default=20)
+    parser.add_argument('--batches', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    run(parser.parse_args())
@@ -0,0 +1,187 @@
+# -*- coding:utf-8 -*-
+'''
+Reference end-to-end workload, per gradient estimator.
+
+For every SEQ_LEN of --seq_lens, GD (MLE, REINFORCE, REBAR, RELAX) and
+CHECK_VARIANCE (off and on, MLE has no variance estimate) a fresh process loads
+the official pre-trained generator of the SEQ_LEN (RunConfig.weights_path) and
+runs --batches training batches after --warmup batches. A batch is built from
+the step functions main.main trains with, not by main.main itself (no metric
+sink, evaluation or checkpoints between the steps):
+    MLE:           one MLE step of G on a real batch (utils.train_epoch_batch)
+    REINFORCE ...: one generator_step, then D_EPOCHS epochs of discriminator_step
+                   over the real data, against fresh samples of G (G.sample)
+The report gives batches/s, samples/s (sequences G is trained on, plus the real
+and generated sequences of the D-steps), the peak RSS of the process, its growth
+over the timed batches, and the goodness and KL scores of GENERATED_NUM samples
+of the final G. A configuration whose process fails or exceeds --timeout is
+reported with its error.
+
+The runs are seeded (--seed) and use --threads threads, the scores are the same
+on every machine for the same torch build. The JSON report (--out) holds the
+commit and the machine, so reports can be diffed between commits and machines.
+
+$ python -m benchmarks.workload --batches 5 --out runs/workload.json
+'''
+
+import os
+import json
+import time
+import queue
+import random
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from utils import generate_samples, train_epoch_batch, get_data_goodness_score, get_data_freq
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from data_loader import DataLoader
+from loss import VarianceLoss
+from adversarial import generator_step, discriminator_step, ControlVariateUpdate
+from config import RunConfig
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+def workload(config, batches, warmup, threads, results):
+    """runs the batches in this process, puts the result record on results"""
+    torch.set_num_threads(threads)
+    random.seed(config.SEED)
+    np.random.seed(config.SEED)
+    torch.manual_seed(config.SEED)
+
+    generator = Generator(config.VOCAB_SIZE, config.g_emb_dim, config.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(config.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(config.d_num_class, config.VOCAB_SIZE, config.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(config.d_num_class, config.VOCAB_SIZE, config.d_emb_dim, config.c_filter_sizes, config.c_num_filters,
+                             config.d_dropout, config.g_sequence_len)
+    gen_data_iter = DataLoader(config.POSITIVE_FILE, config.BATCH_SIZE)
+    rollout = Rollout(generator, config.UPDATE_RATE)
+    gen_optimizer = optim.Adam(generator.parameters())
+    gen_criterion = nn.NLLLoss(reduction='sum')
+    dis_optimizer = optim.Adam(discriminator.parameters())
+    update_c_phi_hat = ControlVariateUpdate(VarianceLoss(), optim.Adam(c_phi_hat.parameters()))
+    batches_per_epoch = int(config.GENERATED_NUM / config.BATCH_SIZE)
+
+    def batch(epoch):
+        """one training batch, returns the number of sequences it trained on"""
+        if config.GD == 'MLE':
+            train_epoch_batch(generator, gen_data_iter, gen_criterion, gen_optimizer, config.PRE_EPOCH_GEN, epoch,
+                              batches_per_epoch)
+            return config.BATCH_SIZE
+        generator_step(generator, discriminator, c_phi_hat, rollout, gen_optimizer, config.GD, config.BATCH_SIZE,
+                       config.g_sequence_len, config.VOCAB_SIZE, config.DEFAULT_TEMPERATURE, config.DEFAULT_ETA,
+                       check_variance=config.CHECK_VARIANCE, variance_fn=update_c_phi_hat,
+                       per_sample=config.VARIANCE_PER_SAMPLE)
+        sequences = config.BATCH_SIZE
+        for _ in range(config.D_EPOCHS):
+            for data, _ in gen_data_iter:
+                samples = generator.sample(data.size(0), config.g_sequence_len)
+                discriminator_step(discriminator, dis_optimizer, data, samples, config.VOCAB_SIZE)
+                sequences += 2 * data.size(0)
+            gen_data_iter.reset()
+        return sequences
+
+    for epoch in range(warmup):
+        batch(epoch)
+    rss_before = rss_mb()
+    sequences = 0
+    start = time.perf_counter()
+    for epoch in range(warmup, warmup + batches):
+        sequences += batch(epoch)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        eval_file = os.path.join(directory, 'eval.data')
+        samples = generate_samples(generator, config, eval_file)
+        generated_string = DataLoader(eval_file, config.BATCH_SIZE).convert_to_char(samples)
+    results.put(dict(batch_time=elapsed / batches, batches_per_s=batches / elapsed, samples_per_s=sequences / elapsed,
+                     peak_rss_mb=peak, rss_growth_mb=peak - rss_before,
+                     goodness=get_data_goodness_score(generated_string, config.SPACES),
+                     kl=float(get_data_freq(generated_string, config))))
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_of(p, results, timeout):
+    """result record of the workload process p, or {'error': ...} if it exits without one or exceeds timeout"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not p.is_alive():
+                try:
+                    # put just before the exit
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return {'error': 'process exited with code {}'.format(p.exitcode)}
+            if time.monotonic() > deadline:
+                p.terminate()
+                return {'error': 'timed out after {:g} s'.format(timeout)}
+
+def run(opt):
+    ctx = mp.get_context('spawn')
+    meta = dict(commit=commit(), time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                torch=torch.__version__, machine=platform.machine(), processor=platform.processor(),
+                cpu_count=os.cpu_count(), threads=opt.threads, batches=opt.batches, warmup=opt.warmup, seed=opt.seed)
+    print('{} batches after {} warm-up, {} threads, seed {}'.format(opt.batches, opt.warmup, opt.threads, opt.seed))
+    print('{:>8}{:>11}{:>10}{:>12}{:>12}{:>13}{:>13}{:>11}{:>9}'.format(
+        'SEQ_LEN', 'GD', 'variance', 'batch/s', 'samples/s', 'peak [MB]', 'growth [MB]', 'goodness', 'KL'))
+    results = []
+    for seq_len in opt.seq_lens:
+        for gd in opt.gd:
+            for check_variance in ([False] if gd == 'MLE' else opt.check_variance):
+                config = RunConfig(SEQ_LEN=seq_len, GD=gd, CHECK_VARIANCE=check_variance, SEED=opt.seed)
+                records = ctx.Queue()
+                p = ctx.Process(target=workload, args=(config, opt.batches, opt.warmup, opt.threads, records))
+                p.start()
+                result = dict(SEQ_LEN=seq_len, GD=gd, CHECK_VARIANCE=check_variance, config_hash=config.hash(),
+                              **result_of(p, records, opt.timeout))
+                p.join()
+                results.append(result)
+                if 'error' in result:
+                    print('{:>8}{:>11}{:>10}  failed: {}'.format(seq_len, gd, 'on' if check_variance else 'off', result['error']))
+                    continue
+                print('{:>8}{:>11}{:>10}{:>12.3f}{:>12.1f}{:>13.1f}{:>13.1f}{:>11.4f}{:>9.4f}'.format(
+                    seq_len, gd, 'on' if check_variance else 'off', result['batches_per_s'], result['samples_per_s'],
+                    result['peak_rss_mb'], result['rss_growth_mb'], result['goodness'], result['kl']))
+
+    os.makedirs(os.path.dirname(opt.out) or '.', exist_ok=True)
+    with open(opt.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('Report: {}'.format(opt.out))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='End-to-end workload per gradient estimator')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[3, 15], choices=[3, 15])
+    parser.add_argument('--gd', nargs='+', default=['MLE', 'REINFORCE', 'REBAR', 'RELAX'],
+                        choices=['MLE', 'REINFORCE', 'REBAR', 'RELAX'])
+    parser.add_argument('--check_variance', type=lambda s: s.lower() in ('true', '1', 'on'), nargs='+', default=[False, True],
+                        help='CHECK_VARIANCE values (off, on)')
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=RunConfig.SEED)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds per configuration')
+    parser.add_argument('--out', default=os.path.join('runs', 'workload.json'))
+    run(parser.parse_args())
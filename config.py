@@ -0,0 +1,381 @@
+# -*- coding:utf-8 -*-
+'''
+Run settings.
+
+RunConfig holds every parameter of a training run (the former constants of
+main.py). A run is defined by the defaults below, a JSON file of fields and
+command line overrides (RunConfig.from_args), and identified by RunConfig.hash,
+which tags its checkpoints and metric records.
+
+Config is the subset the helpers of utils.py need. Tools and worker processes
+which only need a model and a few helpers can build one without the rest of a
+run; a RunConfig can be passed wherever a Config is expected.
+'''
+
+import os
+import json
+import hashlib
+from dataclasses import dataclass, fields, asdict
+from typing import List, Optional, Union, get_args, get_origin
+
+
+class Config(object):
+    """Data and sampling settings of a run
+
+    seq_len: length of the generated sequences (RunConfig.SEQ_LEN)
+    vocab_size: number of tokens (RunConfig.VOCAB_SIZE)
+    batch_size: sampling and pre-training batch size (RunConfig.BATCH_SIZE)
+    generated_num: number of sequences generated per evaluation (RunConfig.GENERATED_NUM)
+    """
+    def __init__(self, seq_len=3, vocab_size=5, batch_size=128, generated_num=10000):
+        self.seq_len = seq_len
+        self.vocab_size = vocab_size
+        self.batch_size = batch_size
+        self.generated_num = generated_num
+
+    def __repr__(self):
+        return 'Config(seq_len={}, vocab_size={}, batch_size={}, generated_num={})'.format(
+            self.seq_len, self.vocab_size, self.batch_size, self.generated_num)
+
+
+# written and read back by the run, not part of its identity
+SCRATCH_FILES = ('NEGATIVE_FILE', 'EVAL_FILE')
+# where and how much the run reports and profiles, not part of its identity either
+LOGGING_FIELDS = ('METRICS_BACKENDS', 'TEXT_SAMPLES', 'TEXT_EVERY', 'PROFILE', 'PROFILE_MEMORY', 'PROFILE_TORCH', 'CAPTURE_BATCH')
+
+GD_CHOICES = ('MLE', 'REINFORCE', 'REBAR', 'RELAX')
+METRICS_BACKEND_CHOICES = ('jsonl', 'console', 'tensorboard')
+# options the estimator comparison does not implement: it computes full-batch, fp32, eager and on-policy estimates
+COMPARE_UNSUPPORTED = ('MICRO_BATCH_SIZE', 'OFF_POLICY_K', 'BF16_AUTOCAST', 'COMPILE')
+
+@dataclass
+class RunConfig(object):
+    """Parameters of a training run
+
+    The fields left to None are derived from the others in __post_init__ (data
+    files, vocabulary, checkpoint, schedule, filter lists). DEBUG selects the short
+    pre-training and adversarial schedules.
+    """
+
+    # BASIC TRAINING PARAMETERS
+    SEED: int = 88
+    DEBUG: bool = True
+    BATCH_SIZE: int = 128
+    MICRO_BATCH_SIZE: Optional[int] = None # if set, the adversarial G and D steps accumulate the gradients of micro-batches of this size (one optimizer step per BATCH_SIZE)
+
+    # DATA
+    GENERATED_NUM: int = 10000
+    SPACES: bool = False # What kind of data do you want to work on?
+    SEQ_LEN: int = 3 # 15 for SPACES = True, 3 or 15 for SPACES = False
+    BUCKET_BY_LENGTH: bool = False # batch the real sequences by length (no padding), otherwise the shorter ones are padded and masked (real sequences can be shorter than SEQ_LEN)
+    POSITIVE_FILE: Optional[str] = None # real data, the math equations of SPACES and SEQ_LEN by default
+    NEGATIVE_FILE: Optional[str] = None
+    EVAL_FILE: Optional[str] = None
+    VOCAB_SIZE: Optional[int] = None # 6 with SPACES, 5 otherwise; above 6 the data are token ids (real.data by default, 5000 tokens of SEQ_LEN 15)
+
+    # PRE-TRAINING
+    # Loading weights currently not supported if SPACES = True
+    MLE: bool = False # If True, do pre-training, otherwise, load weights
+    weights_path: Optional[str] = None # official pre-trained G of SEQ_LEN by default (none for token data)
+    PRE_EPOCH_GEN: Optional[float] = None # 3 (DEBUG) or 120, can be a decimal number
+    PRE_EPOCH_DIS: Optional[int] = None # 0 (DEBUG) or 5
+    PRE_ITER_DIS: Optional[int] = None # 0 (DEBUG) or 3
+
+    # ADVERSARIAL TRAINING
+    GD: str = "REINFORCE" # "MLE" or REINFORCE" or "REBAR" or "RELAX"
+    CHECK_VARIANCE: bool = True
+    COMPARE_ESTIMATORS: bool = False # compute REINFORCE, REBAR and RELAX from the same samples and noise at every G step (GD drives the update)
+    REFERENCE_BATCHES: int = 20 # batches of the REINFORCE reference gradient the estimators are compared to
+    VARIANCE_PER_SAMPLE: bool = True # c_phi_hat descends the variance of the per-sample estimates (one double-backward per sample), otherwise the cheap single-sample estimate from the batch gradient (logged as second_moment, see variance_metric)
+    UPDATE_RATE: float = 0.8
+    TOTAL_EPOCHS: float = 3 # can be a decimal number
+    TOTAL_BATCH: Optional[int] = None # TOTAL_EPOCHS epochs of GENERATED_NUM / BATCH_SIZE batches by default, 0 for GD = MLE
+    G_STEPS: int = 1
+    D_STEPS: Optional[int] = None # 1 (DEBUG) or 4
+    D_EPOCHS: Optional[int] = None # 1 (DEBUG) or 2
+
+    # GENERATOR
+    g_emb_dim: int = 32
+    g_hidden_dim: int = 32
+    CHECKPOINT_SEGMENT: Optional[int] = None # e.g. 16 for SEQ_LEN 64-256: the G and D LSTMs store their activations only every CHECKPOINT_SEGMENT steps and recompute the rest in the backward pass
+    MLE_BPTT: Optional[int] = None # truncated backpropagation through time window of the MLE pre-training of G (None: whole sequences)
+    ADAPTIVE_CUTOFFS: Optional[List[int]] = None # e.g. [2000, 10000] for vocabularies of 10k+ tokens (ids sorted by frequency): adaptive softmax output of G, needs MLE or weights_path of such a G
+    EMBED_INPUTS: bool = False # large vocabularies: D and c_phi_hat embed their inputs (d_emb_dim) instead of reading vocabulary-wide one-hots
+
+    # DISCRIMINATOR
+    d_emb_dim: int = 64
+    d_filter_sizes: Optional[List[int]] = None # helpers.conv_filters(SEQ_LEN) by default: [1, 2, 3] for SEQ_LEN = 3, [1, ..., 10, 15] for 15
+    d_num_filters: Optional[List[int]] = None
+    d_dropout: float = 0.75
+    d_num_class: int = 2
+    d_lstm_hidden_dim: int = 32
+
+    # ANNEX NETWORK
+    c_lstm_hidden_dim: int = 32
+    c_filter_sizes: Optional[List[int]] = None # helpers.conv_filters(SEQ_LEN, odd=True) by default: [1, 3] for SEQ_LEN = 3, [1, 3, 5, 7, 9, 15] for 15
+    c_num_filters: Optional[List[int]] = None
+
+    # OTHER HYPER-PARAMETERS
+    DEFAULT_ETA: float = 1 #for REBAR only. Note: Naive value, in paper they estimate value
+    DEFAULT_TEMPERATURE: float = 1
+    LEARN_RELAXATION: bool = False # learn eta and the log-temperature (from DEFAULT_ETA and DEFAULT_TEMPERATURE) on the variance of the gradient, needs CHECK_VARIANCE
+    RELAXATION_LR: float = 1e-2 # learning rate of eta and the log-temperature
+
+    # MIXED PRECISION
+    BF16_AUTOCAST: bool = False # run the adversarial forward passes of G, D and c_phi_hat under CPU bfloat16 autocast (fp32 master weights)
+
+    # COMPILATION
+    COMPILE: bool = False # torch.compile (CPU inductor) the adversarial G and D losses, falls back to eager mode (CHECK_VARIANCE runs G eagerly)
+
+    # INFERENCE
+    QUANTIZED_INFERENCE: bool = False # int8 dynamic quantized copies of G and D for sampling, evaluation and rewards (CPU only)
+    QUANTIZE_EVERY: int = 1 # refresh the quantized copies every QUANTIZE_EVERY adversarial batches
+
+    # PIPELINING
+    PIPELINE: bool = False # actor processes sample into a shared ring buffer, D and G learners train concurrently (CPU only)
+    PIPELINE_ACTORS: int = 2 # number of sampling processes
+    MAX_STALENESS: int = 2 # samples older than MAX_STALENESS generator updates are not used
+    RING_CAPACITY: int = 16 # sample batches held by the ring buffer
+
+    # STACKED REPLICAS
+    STACKED: bool = False # adversarial phase of stacked.py (per-run noise streams, batched layers): set on the runs of its replicas, main.py runs it as the one-replica stacked run of SEED (not the plain run of SEED)
+
+    # NEGATIVES REPLAY
+    NEGATIVE_REPLAY: bool = False # draw the fakes of the adversarial D-step from a replay buffer instead of sampling G for every real batch
+    REPLAY_CAPACITY: Optional[int] = None # generated sequences held by the buffer, GENERATED_NUM by default
+    REPLAY_REFRESH: float = 0.1 # fraction of the buffer resampled from G at every adversarial batch
+    REPLAY_MAX_AGE: int = 10 # entries sampled more than REPLAY_MAX_AGE adversarial batches ago are evicted
+
+    # OFF-POLICY SAMPLE REUSE
+    OFF_POLICY_K: int = 0 # reuse the last OFF_POLICY_K generator batches with importance weights in the G-step, 0 to disable
+    IS_TRUNCATION: float = 1.0 # importance ratios are truncated at IS_TRUNCATION
+
+    # DISTILLED REWARDS
+    REWARD_DISTILL: bool = False # rewards from a lookup table distilled from D, falls back to D when its error grows
+    DISTILL_EVERY: int = 10 # re-distill every DISTILL_EVERY adversarial batches
+    DISTILL_NGRAM: int = 3 # n-gram size of the table when VOCAB_SIZE ** SEQ_LEN is too large for an exact table
+    DISTILL_TOLERANCE: float = 0.02 # mean absolute reward error above which D is used again
+    DISTILL_CHECK_EVERY: int = 10 # compare the table to D every DISTILL_CHECK_EVERY reward calls
+    DISTILL_CHECK_SIZE: int = 256 # sequences of a fidelity check
+    DISTILL_FIT_STEPS: int = 200 # optimizer steps of the n-gram fit
+
+    # LOGGING
+    METRICS_BACKENDS: Optional[List[str]] = None # ['jsonl', 'console'] by default. 'jsonl' (runs/{hash}/metrics.jsonl and samples.txt), 'console' (text samples on stdout), 'tensorboard' (runs/{hash}/tensorboard), Visdom is added by --visualize
+    TEXT_SAMPLES: int = 8 # generated strings logged per evaluation
+    TEXT_EVERY: int = 1 # log the generated strings of every TEXT_EVERY-th evaluation
+
+    # PROFILING
+    PROFILE: bool = False # time the phases of the adversarial batches: 'profile' metric records, runs/{hash}/trace.json (Chrome trace) and a summary table
+    PROFILE_MEMORY: bool = False # also trace the Python allocations of the phases (tracemalloc, slow)
+    PROFILE_TORCH: Optional[List[int]] = None # e.g. [5] or [5, 6]: torch.profiler over these adversarial batches (first to last), runs/{hash}/torch_trace_5-6.json and .txt
+    CAPTURE_BATCH: Optional[int] = None # save the state of the first G step and D step of this adversarial batch to runs/{hash}/capture_{batch}.pt, see replay.py
+
+    def __post_init__(self):
+        for f in fields(self):
+            setattr(self, f.name, _coerce(f, getattr(self, f.name)))
+        if self.GD not in GD_CHOICES:
+            raise ValueError('GD has to be one of {}, got {}'.format(GD_CHOICES, self.GD))
+        for backend in self.METRICS_BACKENDS or []:
+            if backend not in METRICS_BACKEND_CHOICES:
+                raise ValueError('METRICS_BACKENDS have to be in {}, got {}'.format(METRICS_BACKEND_CHOICES, backend))
+        if self.COMPARE_ESTIMATORS:
+            enabled = [name for name in COMPARE_UNSUPPORTED if getattr(self, name)]
+            if self.CHECK_VARIANCE and not self.VARIANCE_PER_SAMPLE:
+                enabled.append('VARIANCE_PER_SAMPLE = False')  # c_phi_hat is fitted on the per-sample estimates
+            if enabled:
+                raise ValueError('COMPARE_ESTIMATORS does not support {}'.format(', '.join(enabled)))
+
+        if self.VOCAB_SIZE is None:
+            self.VOCAB_SIZE = 6 if self.SPACES else 5
+        if self.POSITIVE_FILE is None:
+            if self.token_data:
+                self.POSITIVE_FILE = 'real.data'
+            elif self.SEQ_LEN == 3:
+                self.POSITIVE_FILE = 'data/math_equation_data_3.txt'
+            elif self.SPACES:
+                self.POSITIVE_FILE = 'data/math_equation_data.txt'
+            else:
+                self.POSITIVE_FILE = 'data/math_equation_data_no_spaces.txt'
+        if self.NEGATIVE_FILE is None:
+            self.NEGATIVE_FILE = 'gene.data' if self.SEQ_LEN == 15 else 'gene_3.data'
+        if self.EVAL_FILE is None:
+            self.EVAL_FILE = 'eval.data' if self.SEQ_LEN == 15 else 'eval_3.data'
+        if self.weights_path is None and not self.token_data:
+            if self.SEQ_LEN == 3:
+                self.weights_path = "checkpoints/MLE_space_False_length_3_preTrainG_epoch_0_official.pth"
+            else:
+                self.weights_path = "checkpoints/MLE_space_False_length_15_preTrainG_epoch_2_official.pth"
+        if self.weights_path is None and not self.MLE:
+            raise ValueError('VOCAB_SIZE {} (token data) needs MLE or weights_path of a generator of that vocabulary'.format(self.VOCAB_SIZE))
+
+        cutoffs = self.ADAPTIVE_CUTOFFS or []
+        if any(not 0 < c < self.VOCAB_SIZE for c in cutoffs) or any(a >= b for a, b in zip(cutoffs, cutoffs[1:])):
+            raise ValueError('ADAPTIVE_CUTOFFS have to be increasing, between 0 and VOCAB_SIZE = {} (exclusive), got {}'.format(
+                self.VOCAB_SIZE, cutoffs))
+        if self.ADAPTIVE_CUTOFFS and not self.MLE and not _adaptive_weights(self.weights_path):
+            raise ValueError('ADAPTIVE_CUTOFFS needs MLE or weights_path of a generator with an adaptive softmax, '
+                             '{} is not one'.format(self.weights_path))
+
+        for name, debug, full in (('PRE_EPOCH_GEN', 3., 120.), ('PRE_EPOCH_DIS', 0, 5), ('PRE_ITER_DIS', 0, 3),
+                                  ('D_STEPS', 1, 4), ('D_EPOCHS', 1, 2)):
+            if getattr(self, name) is None:
+                setattr(self, name, debug if self.DEBUG else full)
+        if self.TOTAL_BATCH is None:
+            # the MLE baseline has no adversarial phase
+            self.TOTAL_BATCH = 0 if self.GD == 'MLE' else int(self.TOTAL_EPOCHS * int(self.GENERATED_NUM / self.BATCH_SIZE))
+        if self.GD == 'MLE' and self.TOTAL_BATCH > 0:
+            raise ValueError('GD MLE has no adversarial phase, TOTAL_BATCH has to be 0, got {}'.format(self.TOTAL_BATCH))
+        if self.REPLAY_CAPACITY is None:
+            self.REPLAY_CAPACITY = self.GENERATED_NUM
+        if self.METRICS_BACKENDS is None:
+            self.METRICS_BACKENDS = ['jsonl', 'console']
+
+        if self.d_filter_sizes is None or self.c_filter_sizes is None:
+            from helpers import conv_filters
+            if self.d_filter_sizes is None:
+                self.d_filter_sizes, self.d_num_filters = conv_filters(self.SEQ_LEN)
+            if self.c_filter_sizes is None:
+                self.c_filter_sizes, self.c_num_filters = conv_filters(self.SEQ_LEN, odd=True)
+
+    # Config attributes
+    @property
+    def variance_metric(self):
+        """Name of the gradient statistic logged with CHECK_VARIANCE, each is its own series:
+        the variance of the per-sample estimates, of the micro-batch estimates (one per micro-batch),
+        or the second moment of the single batch estimate"""
+        if self.VARIANCE_PER_SAMPLE:
+            return 'variance'
+        if self.MICRO_BATCH_SIZE is not None and self.MICRO_BATCH_SIZE < self.BATCH_SIZE:
+            return 'micro_batch_variance'
+        return 'second_moment'
+
+    @property
+    def token_data(self):
+        """The real data are token ids (space separated, as GenDataIter reads them) rather than the math characters,
+        which only cover VOCAB_SIZE 5 and 6; the arithmetic scores do not apply to them"""
+        return self.VOCAB_SIZE > 6
+
+    @property
+    def g_sequence_len(self):
+        return self.SEQ_LEN
+
+    @property
+    def seq_len(self):
+        return self.SEQ_LEN
+
+    @property
+    def vocab_size(self):
+        return self.VOCAB_SIZE
+
+    @property
+    def batch_size(self):
+        return self.BATCH_SIZE
+
+    @property
+    def generated_num(self):
+        return self.GENERATED_NUM
+
+    def hash(self):
+        """Stable identifier of the run: the fields are resolved, so equivalent configs share it.
+        The scratch files samples are written to and the logging settings do not change the run and are left out"""
+        values = {name: value for name, value in asdict(self).items() if name not in SCRATCH_FILES + LOGGING_FIELDS}
+        text = json.dumps(values, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+    def save(self, path):
+        """All the fields are saved resolved: loading the file reproduces the run, but a field overridden
+        afterwards does not re-derive the others (e.g. TOTAL_BATCH from TOTAL_EPOCHS)"""
+        with open(path, 'w') as f:
+            json.dump(asdict(self), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, **overrides):
+        with open(path) as f:
+            values = json.load(f)
+        values.update(overrides)
+        return cls.from_dict(values)
+
+    @classmethod
+    def from_dict(cls, values):
+        unknown = set(values) - set(f.name for f in fields(cls))
+        if unknown:
+            raise ValueError('Unknown run parameters: {}'.format(', '.join(sorted(unknown))))
+        return cls(**values)
+
+    @classmethod
+    def add_arguments(cls, parser):
+        """--config FILE and one --NAME VALUE override per field (lists comma separated, 'none' for None)"""
+        parser.add_argument('--config', default=None, help='JSON file of run parameters (see config.RunConfig)')
+        group = parser.add_argument_group('run parameters')
+        for f in fields(cls):
+            group.add_argument('--' + f.name, default=None, metavar=_type_name(f.type),
+                               help='default: {}'.format(f.default))
+
+    @classmethod
+    def from_args(cls, opt, **overrides):
+        """RunConfig of the arguments parsed by a parser set up with add_arguments, overrides on top"""
+        values = cls.values_from_args(opt)
+        values.update(overrides)
+        return cls.from_dict(values)
+
+    @classmethod
+    def values_from_args(cls, opt):
+        """Fields set by the arguments (file, then command line), not resolved"""
+        values = {}
+        if opt.config is not None:
+            with open(opt.config) as f:
+                values = json.load(f)
+        for f in fields(cls):
+            text = getattr(opt, f.name)
+            if text is not None:
+                values[f.name] = _parse(f, text)
+        return values
+
+def _field_type(kind):
+    """(base type, optional, list) of a field annotation"""
+    optional = get_origin(kind) is Union
+    if optional:
+        kind = [arg for arg in get_args(kind) if arg is not type(None)][0]
+    if get_origin(kind) is list:
+        return get_args(kind)[0], optional, True
+    return kind, optional, False
+
+def _type_name(kind):
+    base, optional, is_list = _field_type(kind)
+    name = base.__name__ + ('[,...]' if is_list else '')
+    return name + ('|none' if optional else '')
+
+def _coerce(f, value):
+    base, optional, is_list = _field_type(f.type)
+    if value is None:
+        if not optional:
+            raise ValueError('{} can not be None'.format(f.name))
+        return None
+    if is_list:
+        return [base(v) for v in value]
+    if base is bool and not isinstance(value, bool):
+        raise ValueError('{} has to be a boolean, got {!r}'.format(f.name, value))
+    if base is int and float(value) != int(value):
+        raise ValueError('{} has to be an integer, got {!r}'.format(f.name, value))
+    return base(value)
+
+def _parse(f, text):
+    """value of the field f from its command line text"""
+    base, optional, is_list = _field_type(f.type)
+    if optional and text.lower() == 'none':
+        return None
+    if is_list:
+        return [base(v) for v in text.split(',')]
+    if base is bool:
+        if text.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError('{} has to be true or false, got {}'.format(f.name, text))
+        return text.lower() in ('true', '1')
+    return base(text)
+
+def _adaptive_weights(path):
+    """whether path is a generator checkpoint with an adaptive softmax output (adaptive.* parameters)"""
+    if not os.path.exists(path):
+        return False
+    import torch
+    state = torch.load(path, map_location='cpu')
+    return any(name.startswith('adaptive.') for name in state)
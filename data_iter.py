@@ -4,21 +4,30 @@ import os, sys
 import random
 import math
 
-import tqdm
 import numpy as np
 import torch
 
+from helpers import pad_sequences, bucket_batches
 
 class GenDataIter(object):
-    """ Toy data iter to load digits"""
-    def __init__(self, data_file, batch_size):
+    """ Toy data iter to load digits
+
+    Sequences may have different lengths: the shorter ones of a batch are padded and
+    self.lengths holds the lengths of the last batch (None if none is padded). With
+    bucket, every batch holds sequences of one length.
+    """
+    def __init__(self, data_file, batch_size, bucket=False):
         super(GenDataIter, self).__init__()
         self.batch_size = batch_size
+        self.bucket = bucket
         self.data_lis = self.read_file(data_file)
         self.data_num = len(self.data_lis)
         self.indices = range(self.data_num)
         self.num_batches = int(math.floor(float(self.data_num) / self.batch_size))
         self.idx = 0
+        self.lengths = None
+        if bucket:
+            self.batches = bucket_batches([len(d) for d in self.data_lis], batch_size, shuffle=False)
 
     def __len__(self):
         return self.num_batches
@@ -31,17 +40,27 @@ class GenDataIter(object):
     
     def reset(self):
         self.idx = 0
-        random.shuffle(self.data_lis)
+        if self.bucket:
+            self.batches = bucket_batches([len(d) for d in self.data_lis], self.batch_size)
+        else:
+            random.shuffle(self.data_lis)
 
     def next(self):
-        if self.idx >= self.data_num:
-            raise StopIteration
-        index = self.indices[self.idx:self.idx+self.batch_size]
-        d = [self.data_lis[i] for i in index]
-        d = torch.LongTensor(np.asarray(d, dtype='int64'))
-        data = torch.cat([torch.zeros(self.batch_size, 1).long(), d], dim=1)
-        target = torch.cat([d, torch.zeros(self.batch_size, 1).long()], dim=1)
-        self.idx += self.batch_size
+        if self.bucket:
+            if self.idx >= len(self.batches):
+                raise StopIteration
+            index = self.batches[self.idx]
+            self.idx += 1
+        else:
+            if self.idx >= self.data_num:
+                raise StopIteration
+            index = self.indices[self.idx:self.idx+self.batch_size]
+            self.idx += self.batch_size
+        d, lengths = pad_sequences([self.data_lis[i] for i in index])
+        data = torch.cat([torch.zeros(d.size(0), 1).long(), d], dim=1)
+        target = torch.cat([d, torch.zeros(d.size(0), 1).long()], dim=1)
+        # the leading / trailing zero is part of every sequence
+        self.lengths = lengths + 1 if lengths.min() < lengths.max() else None
 
         return data, target
 
@@ -56,12 +75,17 @@ class GenDataIter(object):
         return lis
 
 class DisDataIter(object):
-    """ Toy data iter to load digits"""
-    def __init__(self, real_data_file, fake_data_file, batch_size, seq_len):
+    """ Toy data iter to load digits
+
+    Real sequences may be shorter than seq_len, see GenDataIter for the padding and the bucketing.
+    With tokens, the real file holds token ids as the fake one, otherwise math characters.
+    """
+    def __init__(self, real_data_file, fake_data_file, batch_size, seq_len, bucket=False, tokens=False):
         super(DisDataIter, self).__init__()
         self.batch_size = batch_size
         self.seq_len = seq_len
-        real_data_lis = self.read_real_file(real_data_file)
+        self.bucket = bucket
+        real_data_lis = self.read_fake_file(real_data_file) if tokens else self.read_real_file(real_data_file)
         fake_data_lis = self.read_fake_file(fake_data_file)
         self.data = real_data_lis + fake_data_lis
         self.labels = [1 for _ in range(len(real_data_lis))] +\
@@ -72,6 +96,9 @@ class DisDataIter(object):
         self.indices = range(self.data_num)
         self.num_batches = int(math.floor(float(self.data_num)/self.batch_size))
         self.idx = 0
+        self.lengths = None
+        if bucket:
+            self.batches = bucket_batches([len(p[0]) for p in self.pairs], batch_size, shuffle=False)
 
     def __len__(self):
         return self.num_batches
@@ -84,18 +111,27 @@ class DisDataIter(object):
     
     def reset(self):
         self.idx = 0
-        random.shuffle(self.pairs)
+        if self.bucket:
+            self.batches = bucket_batches([len(p[0]) for p in self.pairs], self.batch_size)
+        else:
+            random.shuffle(self.pairs)
 
     def next(self):
-        if self.idx >= self.data_num:
-            raise StopIteration
-        index = self.indices[self.idx:self.idx+self.batch_size]
+        if self.bucket:
+            if self.idx >= len(self.batches):
+                raise StopIteration
+            index = self.batches[self.idx]
+            self.idx += 1
+        else:
+            if self.idx >= self.data_num:
+                raise StopIteration
+            index = self.indices[self.idx:self.idx+self.batch_size]
+            self.idx += self.batch_size
         pairs = [self.pairs[i] for i in index]
-        data = [p[0] for p in pairs]
+        data, lengths = pad_sequences([p[0] for p in pairs])
         label = [p[1] for p in pairs]
-        data = torch.LongTensor(np.asarray(data, dtype='int64'))
         label = torch.LongTensor(np.asarray(label, dtype='int64'))
-        self.idx += self.batch_size
+        self.lengths = lengths if lengths.min() < lengths.max() else None
 
         return data, label
 
@@ -113,12 +149,10 @@ class DisDataIter(object):
             lines = f.readlines()
         lis = []
         for line in lines:
-            l = list(line)[:-1]
+            l = list(line.rstrip('\n'))
             l = [char_to_ix[s] for s in l]
-            # weird fix: sometimes, the generated sequence has length 14 and not 15...
-            if len(l) < self.seq_len:
-                l.append(0)
-            assert len(l) == self.seq_len
+            # shorter sequences are kept as they are and padded per batch (see next)
+            assert 0 < len(l) <= self.seq_len
             lis.append(l)
         return lis
 
@@ -1,14 +1,18 @@
 import random
 import numpy as np
-import torch
 
+from helpers import pad_sequences, bucket_batches
 # from main import BATCH_SIZE, VOCAB_SIZE, g_sequence_len
 
 class DataLoader:
     
-    def __init__(self, file_path, batch_size=16):
+    def __init__(self, file_path, batch_size=16, bucket=False, tokens=False):
         
         self.batch_size = batch_size
+        # with bucket, every batch holds sequences of one length (see helpers.bucket_batches)
+        self.bucket = bucket
+        # with tokens, every line holds space separated token ids (as GenDataIter reads them) instead of math characters
+        self.tokens = tokens
         self.char_to_ix = {
             'x': 0,
             '+': 1,
@@ -21,6 +25,10 @@ class DataLoader:
         self.ix_to_char = {v:k for (k,v) in self.char_to_ix.items()}
         self.readFile(file_path)
         self.idx = 0
+        # lengths of the sequences of the last batch, None if none of them is padded
+        self.lengths = None
+        if bucket:
+            self.batches = bucket_batches([len(line) for line in self.lines], batch_size, shuffle=False)
         
     def __len__(self):
         pass
@@ -33,10 +41,21 @@ class DataLoader:
     
     def reset(self):
         self.idx = 0
-        random.shuffle(self.lines)
+        if self.bucket:
+            self.batches = bucket_batches([len(line) for line in self.lines], self.batch_size)
+        else:
+            random.shuffle(self.lines)
             
     def next(self):
         
+        if self.bucket:
+            if self.idx >= len(self.batches):
+                raise StopIteration
+            batch_lines = [self.lines[i] for i in self.batches[self.idx]]
+            end_index = self.idx * self.batch_size + len(batch_lines)
+            self.idx += 1
+            return self.convert_lines(batch_lines, end_index)
+
         # iterator edge case
         if self.idx >= self.total_lines:
             raise StopIteration
@@ -52,6 +71,10 @@ class DataLoader:
         
         #increment idx (bookeeping for iterator)
         self.idx += self.batch_size
+
+        return self.convert_lines(batch_lines, end_index)
+
+    def convert_lines(self, batch_lines, end_index):
         
         # contains input data to be returned
         all_input_data = []
@@ -61,27 +84,31 @@ class DataLoader:
         for i,line in enumerate(batch_lines):
             # convert char to index (do this for input data and target data)
             # here input data and target data are staggered by one position
-            input_data = [self.char_to_ix[c] for c in line]
+            input_data = list(line) if self.tokens else [self.char_to_ix[c] for c in line]
             # target doesn't contain the first char, add 6 (maps to '\n') to end
             if i == end_index-1:
                 print('break here')
             target_data = input_data[1:]
-            target_data.append(random.choice([1,2,3,4]))
+            # token ids: 0 ends the target, as in GenDataIter
+            target_data.append(0 if self.tokens else random.choice([1,2,3,4]))
 
             # print(f"line {i}. input_data = {input_data}, target_data = {target_data}")
 
             all_input_data.append(input_data)
             all_target_data.append(target_data)
 
-        # convert to torch long tensor (ready to be used by nn.Embedding)
-        all_input_data = torch.from_numpy(np.asarray(all_input_data)).long()
-        all_target_data = torch.from_numpy(np.asarray(all_target_data)).long()
+        # convert to torch long tensor (ready to be used by nn.Embedding), shorter lines are padded
+        all_input_data, lengths = pad_sequences(all_input_data)
+        all_target_data, _ = pad_sequences(all_target_data)
+        self.lengths = lengths if lengths.min() < lengths.max() else None
 
         return all_input_data, all_target_data
     
     def readFile(self, file_path):
         with open(file_path, 'r') as f:
             self.lines = f.read().split('\n')
+        if self.tokens:
+            self.lines = [[int(s) for s in line.split()] for line in self.lines if line.strip()]
         self.total_lines = len(self.lines)
 
     def frequency(self, file_path, vocab_size=5, seq_len=15):
@@ -102,9 +129,16 @@ class DataLoader:
         self.total_lines = len(self.lines)
 
 
-    def convert_to_char(self, data):
+    def convert_to_char(self, data, lengths=None):
+        # lengths: the padding of each row is dropped
         string_arr = []
-        for each_tensor in data:
-            string = ''.join([self.ix_to_char[i] for i in each_tensor.data.numpy()])
+        for j, each_tensor in enumerate(data):
+            tokens = each_tensor.data.numpy()
+            if lengths is not None:
+                tokens = tokens[:int(lengths[j])]
+            if self.tokens:
+                string = ' '.join([str(i) for i in tokens])
+            else:
+                string = ''.join([self.ix_to_char[i] for i in tokens])
             string_arr.append(string)
         return string_arr
\ No newline at end of file
@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+'''
+Data-parallel adversarial training over torch.distributed (gloo backend).
+
+Every rank samples its own shard of the batch (BATCH_SIZE // world_size),
+computes the rewards and the generator, discriminator and c_phi_hat gradients,
+and all-reduces (averages) them before each optimizer step, so the replicas stay
+synchronised. The variance statistics are reduced through their moments.
+Rank 0 evaluates, prints and checkpoints. The run parameters are the ones of
+main.py (RunConfig, --config FILE and --NAME VALUE overrides); the options of
+main.py which the worker does not implement are rejected.
+
+$ python data_parallel.py --world_size 4 --GD RELAX --TOTAL_BATCH 10
+'''
+
+import os
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from utils import get_data_goodness_score, get_data_freq, generate_samples
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from rollout import Rollout
+from data_loader import DataLoader
+from loss import VarianceLoss
+from adversarial import generator_step, variance_step, discriminator_step
+from config import RunConfig
+
+
+def average_gradients(model):
+    world_size = float(dist.get_world_size())
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad.data, op=dist.ReduceOp.SUM)
+            param.grad.data /= world_size
+
+def sum_moments(moments):
+    normal_term, square_term, bs = moments
+    bs = torch.Tensor([bs])
+    for t in (normal_term, square_term, bs):
+        dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return normal_term, square_term, int(bs.item())
+
+def broadcast_parameters(model):
+    for param in model.parameters():
+        dist.broadcast(param.data, src=0)
+
+# options of main which the worker does not implement
+UNSUPPORTED = ('MLE', 'CHECKPOINT_SEGMENT', 'ADAPTIVE_CUTOFFS', 'EMBED_INPUTS', 'BUCKET_BY_LENGTH', 'MICRO_BATCH_SIZE',
+               'COMPARE_ESTIMATORS', 'LEARN_RELAXATION', 'BF16_AUTOCAST', 'COMPILE', 'QUANTIZED_INFERENCE', 'PIPELINE',
+               'STACKED', 'NEGATIVE_REPLAY', 'OFF_POLICY_K', 'REWARD_DISTILL')
+
+
+def check_supported(config):
+    if config.GD not in ('REINFORCE', 'REBAR', 'RELAX'):
+        raise ValueError('The data-parallel steps are REINFORCE, REBAR or RELAX, got {}'.format(config.GD))
+    enabled = [name for name in UNSUPPORTED if getattr(config, name)]
+    if config.CAPTURE_BATCH is not None:
+        enabled.append('CAPTURE_BATCH')
+    if config.token_data:
+        enabled.append('VOCAB_SIZE = {} (token data)'.format(config.VOCAB_SIZE))
+    if enabled:
+        raise ValueError('The data-parallel training does not support {}'.format(', '.join(enabled)))
+
+def check_sync(*models):
+    """Max difference between the parameters of this rank and rank 0"""
+    diff = 0.
+    for model in models:
+        for param in model.parameters():
+            ref = param.data.clone()
+            dist.broadcast(ref, src=0)
+            diff = max(diff, (ref - param.data).abs().max().item())
+    return diff
+
+
+def worker(rank, world_size, opt, cfg, queue=None):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(opt.port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(opt.threads or max(1, (os.cpu_count() or 1) // world_size))
+    assert cfg.BATCH_SIZE % world_size == 0, "BATCH_SIZE must be divisible by the world size"
+    shard = cfg.BATCH_SIZE // world_size
+    GD = cfg.GD
+
+    # Same initialisation on every rank, then per-rank sampling noise
+    torch.manual_seed(cfg.SEED)
+    generator = Generator(cfg.VOCAB_SIZE, cfg.g_emb_dim, cfg.g_hidden_dim, False)
+    generator.load_state_dict(torch.load(cfg.weights_path, map_location=lambda storage, loc: storage))
+    discriminator = LSTMDiscriminator(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_lstm_hidden_dim, False)
+    c_phi_hat = AnnexNetwork(cfg.d_num_class, cfg.VOCAB_SIZE, cfg.d_emb_dim, cfg.c_filter_sizes, cfg.c_num_filters,
+                             cfg.d_dropout, cfg.g_sequence_len)
+    for model in (generator, discriminator, c_phi_hat):
+        broadcast_parameters(model)
+    torch.manual_seed(cfg.SEED + rank)
+    # the real data is shuffled identically on every rank and split by rows
+    random.seed(cfg.SEED)
+    np.random.seed(cfg.SEED)
+
+    gen_data_iter = DataLoader(cfg.POSITIVE_FILE, cfg.BATCH_SIZE)
+    rollout = Rollout(generator, cfg.UPDATE_RATE)
+    gen_gan_optm = optim.Adam(generator.parameters())
+    dis_optimizer = optim.Adam(discriminator.parameters())
+    c_phi_hat_loss = VarianceLoss(*generator.variance_parameter())
+    c_phi_hat_optm = optim.Adam(c_phi_hat.parameters())
+    update_c_phi_hat = lambda grads: variance_step(c_phi_hat_loss, c_phi_hat_optm, grads, reduce_grads=lambda: average_gradients(c_phi_hat),
+                                                   reduce_moments=sum_moments)
+
+    # configuration of the run, tags the checkpoints
+    run_hash = cfg.hash()
+    # the moments are summed over the ranks: without per-sample estimates, every rank is one estimate
+    variance_metric = cfg.variance_metric if cfg.VARIANCE_PER_SAMPLE or world_size == 1 else 'per-rank variance'
+    step_times = []
+    for total_batch in range(cfg.TOTAL_BATCH):
+        start = time.perf_counter()
+        for it in range(cfg.G_STEPS):
+            samples, rewards, true_variance = generator_step(generator, discriminator, c_phi_hat, rollout, gen_gan_optm, GD,
+                                                             shard, cfg.g_sequence_len, cfg.VOCAB_SIZE, cfg.DEFAULT_TEMPERATURE, cfg.DEFAULT_ETA,
+                                                             check_variance=cfg.CHECK_VARIANCE, variance_fn=update_c_phi_hat,
+                                                             per_sample=cfg.VARIANCE_PER_SAMPLE, reduce_grads=lambda: average_gradients(generator))
+            if cfg.CHECK_VARIANCE:
+                if rank == 0:
+                    print('Batch [{}] Estimate of the {} of the gradient at step {}: {}'.format(
+                        total_batch, variance_metric.replace('_', ' '), it, true_variance[0]))
+
+        D_loss = None # no D-step with D_EPOCHS = 0
+        for b in range(cfg.D_EPOCHS):
+            for i, (data, _) in enumerate(gen_data_iter):
+                if opt.d_batches is not None and i >= opt.d_batches:
+                    break
+                # every rank sees the same batch size, so they skip the same batches
+                if data.size(0) < world_size:
+                    continue
+                # equal shards, so that the averaged gradients weight every row alike
+                rows = world_size * (data.size(0) // world_size)
+                data = data[:rows][rank::world_size]
+                lengths = None if gen_data_iter.lengths is None else gen_data_iter.lengths[:rows][rank::world_size]
+                fake = generator.sample(data.size(0), cfg.g_sequence_len)
+                D_loss = discriminator_step(discriminator, dis_optimizer, data, fake, cfg.VOCAB_SIZE, data_lengths=lengths,
+                                            reduce_grads=lambda: average_gradients(discriminator))
+            gen_data_iter.reset()
+        if D_loss is not None:
+            # loss of the last D-step, averaged over the ranks
+            dist.all_reduce(D_loss, op=dist.ReduceOp.SUM)
+            if rank == 0:
+                print('Batch [%d] D Loss: %f' % (total_batch, D_loss.item() / world_size))
+        step_times.append(time.perf_counter() - start)
+
+        if rank == 0 and not opt.no_eval:
+            samples = generate_samples(generator, cfg, cfg.EVAL_FILE)
+            generated_string = DataLoader(cfg.EVAL_FILE, cfg.BATCH_SIZE).convert_to_char(samples)
+            eval_score = get_data_goodness_score(generated_string, cfg.SPACES)
+            kl_score = get_data_freq(generated_string, cfg) if not cfg.SPACES else -1
+            print('Batch [%d] Generation Score: %f' % (total_batch, eval_score))
+            print('Batch [%d] KL Score: %f' % (total_batch, kl_score))
+            if total_batch % 10 == 0 or total_batch == cfg.TOTAL_BATCH - 1:
+                torch.save(generator.state_dict(),
+                           f'checkpoints/{GD}_G_space_{cfg.SPACES}_pretrain_{cfg.PRE_EPOCH_GEN:g}_ddp_{world_size}_batch_{total_batch}_{run_hash}.pth')
+
+    diff = check_sync(generator, discriminator, c_phi_hat)
+    if rank == 0:
+        print('Max parameter difference between ranks: {}'.format(diff))
+        if queue is not None:
+            queue.put({'world_size': world_size, 'step_times': step_times, 'max_param_diff': diff})
+    dist.destroy_process_group()
+
+def launch(world_size, opt, config, queue=None):
+    check_supported(config)
+    mp.spawn(worker, args=(world_size, opt, config, queue), nprocs=world_size, join=True)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Data-parallel adversarial training (gloo)')
+    parser.add_argument('--world_size', type=int, default=2)
+    parser.add_argument('--d_batches', type=int, default=None, help='real batches per D epoch (default: all)')
+    parser.add_argument('--no_eval', action='store_true')
+    parser.add_argument('--threads', type=int, default=None, help='threads per rank (default: cores // world_size)')
+    parser.add_argument('--port', type=int, default=29500)
+    RunConfig.add_arguments(parser)
+    return parser
+
+
+if __name__ == '__main__':
+
+    opt = get_parser().parse_args()
+    launch(opt.world_size, opt, RunConfig.from_args(opt))
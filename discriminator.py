@@ -8,7 +8,9 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from helpers import checkpointed_lstm
 
 
 class Discriminator(nn.Module):
@@ -24,7 +26,7 @@ class Discriminator(nn.Module):
         self.highway = nn.Linear(sum(num_filters), sum(num_filters))
         self.dropout = nn.Dropout(p=dropout)
         self.lin = nn.Linear(sum(num_filters), num_classes)
-        self.softmax = nn.LogSoftmax()
+        self.softmax = nn.LogSoftmax(dim=1)
         self.init_parameters()
     
     def forward(self, x):
@@ -49,16 +51,23 @@ class Discriminator(nn.Module):
 class LSTMDiscriminator(nn.Module):
     """
         Many to one LSTM
+
+        With emb_dim (large vocabularies) the inputs are embedded first: token sequences (batch_size, seq_len)
+        are looked up, one-hot or relaxed inputs (batch_size, seq_len, vocab_size) are soft-embedding products.
+        The discriminator then takes the tokens directly (token_input, see Rollout.score).
     """
-    def __init__(self, num_classes, vocab_size, hidden_dim, use_cuda=False):
+    def __init__(self, num_classes, vocab_size, hidden_dim, use_cuda=False, checkpoint_segment=None, emb_dim=None):
         super(LSTMDiscriminator, self).__init__()
-        # self.emb = nn.Embedding(vocab_size, emb_dim)
+        self.emb = nn.Embedding(vocab_size, emb_dim) if emb_dim else None
+        self.token_input = self.emb is not None
         self.vocab_size = vocab_size
         self.hidden_dim = hidden_dim
         self.use_cuda = use_cuda
-        self.lstm = nn.LSTM(vocab_size, hidden_dim, batch_first=True)
+        # steps per activation-checkpointed LSTM segment (see helpers.checkpointed_lstm)
+        self.checkpoint_segment = checkpoint_segment
+        self.lstm = nn.LSTM(emb_dim or vocab_size, hidden_dim, batch_first=True)
         self.lin = nn.Linear(hidden_dim, num_classes)
-        self.softmax = nn.LogSoftmax()
+        self.softmax = nn.LogSoftmax(dim=1)
         self.init_parameters()
 
     """
@@ -66,10 +75,21 @@ class LSTMDiscriminator(nn.Module):
         x dimensions: (batch_size, seq_len, vocab_size)
 
     """
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         # input x is now batch_size x seq_len x vocab_size
+        # lengths (batch_size): lengths of the sequences if x is padded
         
+        x = self.embed(x)
         h0, c0 = self.init_hidden(x.size(0))
+        if lengths is not None:
+            # the last valid output of every sequence is its final hidden state
+            packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            _, (h, c) = self.lstm(packed, (h0, c0))
+            return self.softmax(self.lin(h[-1]))
+        if self.checkpoint_segment is not None:
+            # only the final state is kept, the outputs of the segments are not stored
+            _, (h, c) = checkpointed_lstm(self.lstm, x, (h0, c0), self.checkpoint_segment)
+            return self.softmax(self.lin(h[-1]))
         output, (h, c) = self.lstm(x, (h0, c0))  # output dim: (batch_size, seq_length, hidden_dim)
         seq_len = output.size()[1]
         batch_size = output.size()[0]
@@ -87,10 +107,17 @@ class LSTMDiscriminator(nn.Module):
         # output = self.lin(output.contiguous())[: , -1 , : ] # only need last lstm block's output
         # return self.softmax(output.contiguous()) # returning dim
 
+    def embed(self, x):
+        if self.emb is None:
+            return x
+        if x.dtype == torch.long:
+            return self.emb(x)
+        return torch.matmul(x, self.emb.weight)
+
     def init_hidden(self, batch_size):
         # noise distribution fed to G
-        h = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
-        c = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
+        h = torch.zeros((1, batch_size, self.hidden_dim))
+        c = torch.zeros((1, batch_size, self.hidden_dim))
         if self.use_cuda:
             h, c = h.cuda(), c.cuda()
         return h, c
@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+'''
+Distillation of the discriminator into a lookup-table reward model.
+
+When vocab_size ** seq_len is small (SEQ_LEN = 3: 125 sequences) the table holds
+the discriminator output of every sequence. Otherwise it is an additive model
+over positional n-grams, fitted on sequences sampled from the current generator:
+
+    log D(x) ~ bias + sum_t table[t, x_t ... x_{t+n-1}]
+'''
+
+import torch
+import torch.optim as optim
+
+from helpers import convert_to_one_hot
+
+
+class DistilledDiscriminator(object):
+    """Table-based stand-in for the discriminator, with a fidelity monitor
+
+    Called with token sequences (batch_size, seq_len), returns log-probabilities
+    (batch_size, 2) as the discriminator. Every check_every calls the output on
+    (at most) check_size sequences is compared to the discriminator; when the mean
+    absolute error of the rewards (probabilities of the class 1) exceeds
+    tolerance, the discriminator is used until the next distillation.
+    """
+    token_input = True
+
+    def __init__(self, discriminator, seq_len, vocab_size, n=3, max_table=4096, calibration_size=5000,
+                 fit_steps=200, tolerance=0.02, check_every=10, check_size=256, cuda=False):
+        self.discriminator = discriminator
+        self.seq_len = seq_len
+        self.vocab_size = vocab_size
+        self.exact = vocab_size ** seq_len <= max_table
+        self.n = seq_len if self.exact else min(n, seq_len)
+        self.calibration_size = calibration_size
+        self.fit_steps = fit_steps
+        self.tolerance = tolerance
+        self.check_every = check_every
+        self.check_size = check_size
+        self.cuda = cuda
+        self.positions = seq_len - self.n + 1
+        self.codes = vocab_size ** torch.arange(self.n - 1, -1, -1)
+        self.table = torch.zeros((self.positions, vocab_size ** self.n))
+        self.bias = torch.zeros(1)
+        self.calls = 0
+        self.fallback = True # until the first distillation
+        self.errors = [] # (calls, error) of every fidelity check
+
+    def ngram_index(self, x):
+        """
+            Index of the n-gram starting at every position.
+            x dims: (batch_size, seq_len)
+            returns dims: (batch_size, positions)
+        """
+        x = x.cpu()
+        windows = x.unfold(1, self.n, 1) # batch_size x positions x n
+        return (windows * self.codes).sum(2)
+
+    def teacher(self, x):
+        """log D(x) of the class 1 of token sequences, dims: (batch_size)"""
+        with torch.no_grad():
+            return self.discriminator(convert_to_one_hot(x, self.vocab_size, self.cuda)).cpu()[:, 1]
+
+    def distill(self, generator):
+        """Refits the table to the current discriminator, returns the mean absolute reward error on check_size new generator samples"""
+        if self.exact:
+            # every sequence, in the order of their index
+            x = torch.arange(self.vocab_size ** self.seq_len).view(-1, 1) // self.codes % self.vocab_size
+            if self.cuda:
+                x = x.cuda()
+            self.table = self.teacher(x).view(1, -1).clone()
+            self.bias.zero_()
+        else:
+            with torch.no_grad():
+                x = generator.sample(self.calibration_size, self.seq_len)
+            target = self.teacher(x)
+            idx = self.ngram_index(x)
+            table = torch.zeros_like(self.table, requires_grad=True)
+            bias = target.mean().view(1).clone().requires_grad_()
+            optimizer = optim.Adam([table, bias], lr=0.1)
+            rows = torch.arange(self.positions).view(1, -1)
+            for _ in range(self.fit_steps):
+                pred = bias + table[rows, idx].sum(1)
+                loss = ((pred - target) ** 2).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            self.table, self.bias = table.detach(), bias.detach()
+        self.fallback = False
+        with torch.no_grad():
+            x = generator.sample(self.check_size, self.seq_len) # held out (in exact mode the table is the teacher on every sequence)
+        error = self.error(x)
+        self.errors.append((self.calls, error))
+        return error
+
+    def log_prob(self, x):
+        """Distilled log D(x) of the class 1, dims: (batch_size)"""
+        rows = torch.arange(self.positions).view(1, -1)
+        return (self.bias + self.table[rows, self.ngram_index(x)].sum(1)).clamp(max=0)
+
+    def error(self, x):
+        x = x[:self.check_size]
+        return (torch.exp(self.log_prob(x)) - torch.exp(self.teacher(x))).abs().mean().item()
+
+    def __call__(self, x):
+        """
+            x dims: (batch_size, seq_len) token sequences
+            returns log-probabilities dims: (batch_size, 2)
+        """
+        self.calls += 1
+        if not self.fallback and self.check_every > 0 and self.calls % self.check_every == 0:
+            error = self.error(x)
+            self.errors.append((self.calls, error))
+            if error > self.tolerance:
+                self.fallback = True
+        if self.fallback:
+            with torch.no_grad():
+                return self.discriminator(convert_to_one_hot(x, self.vocab_size, self.cuda))
+        log_p1 = self.log_prob(x)
+        pred = torch.stack([torch.log1p(-torch.exp(log_p1).clamp(max=1 - 1e-6)), log_p1], 1)
+        if self.cuda:
+            pred = pred.cuda()
+        return pred
@@ -9,31 +9,90 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from helpers import checkpointed_lstm
 
 class Generator(nn.Module):
-    """Generator """
-    def __init__(self, num_emb, emb_dim, hidden_dim, use_cuda):
+    """Generator
+
+    With adaptive_cutoffs (large vocabularies) the output layer is an adaptive softmax
+    (nn.AdaptiveLogSoftmaxWithLoss): the tokens below the first cutoff, which should be the most frequent
+    ones, are in the head and the others in tail clusters of reduced dimension. Sampling and the
+    log-probabilities of given targets (target_log_prob) then only evaluate the head and the clusters needed.
+    """
+    def __init__(self, num_emb, emb_dim, hidden_dim, use_cuda, checkpoint_segment=None, adaptive_cutoffs=None):
         super(Generator, self).__init__()
         self.num_emb = num_emb
         self.emb_dim = emb_dim
         self.hidden_dim = hidden_dim
         self.use_cuda = use_cuda
+        # steps per activation-checkpointed LSTM segment in forward (see helpers.checkpointed_lstm)
+        self.checkpoint_segment = checkpoint_segment
         self.emb = nn.Embedding(num_emb, emb_dim)
         self.lstm = nn.LSTM(emb_dim, hidden_dim, batch_first=True)
-        self.lin = nn.Linear(hidden_dim, num_emb)
-        self.softmax = nn.LogSoftmax()
+        self.adaptive = None
+        if adaptive_cutoffs:
+            self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(hidden_dim, num_emb, list(adaptive_cutoffs), div_value=4.)
+        else:
+            self.lin = nn.Linear(hidden_dim, num_emb)
+        self.softmax = nn.LogSoftmax(dim=1)
         self.init_params()
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         """
         Args:
             x: (batch_size, seq_len), sequence of tokens generated by generator
+            lengths: (batch_size), lengths of the sequences if x is padded. The LSTM then runs on the packed
+                sequences (without activation checkpointing) and the predictions at the padded positions are to be
+                masked out
+        """
+        if lengths is None:
+            return self.forward_window(x)[0]
+        return self.log_prob(self.hidden_states(x, lengths)[0])
+
+    def forward_window(self, x, hidden=None):
+        """
+        Forward pass over a window of the sequences, e.g. for truncated backpropagation through time
+        Args:
+            x: (batch_size, window_len)
+            hidden: (h, c) at the start of the window, zeros if None
+        returns the predictions (batch_size * window_len, num_emb) and (h, c) at the end of the window
+        """
+        output, hidden = self.hidden_states(x, hidden=hidden)
+        return self.log_prob(output), hidden
+
+    def hidden_states(self, x, lengths=None, hidden=None):
+        """
+        LSTM outputs (batch_size, seq_len, hidden_dim) and final (h, c) for the tokens x (batch_size, seq_len)
         """
         emb = self.emb(x)
-        h0, c0 = self.init_hidden(x.size(0))
-        output, (h, c) = self.lstm(emb, (h0, c0))
-        pred = self.softmax(self.lin(output.contiguous().view(-1, self.hidden_dim)))
-        return pred        
+        if hidden is None:
+            hidden = self.init_hidden(x.size(0))
+        if lengths is None:
+            return checkpointed_lstm(self.lstm, emb, hidden, self.checkpoint_segment)
+        packed = pack_padded_sequence(emb, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        output, hidden = self.lstm(packed, hidden)
+        output, _ = pad_packed_sequence(output, batch_first=True, total_length=x.size(1))
+        return output, hidden
+
+    def log_prob(self, output):
+        """Log-probabilities of every token (batch_size * seq_len, num_emb) from the LSTM outputs"""
+        output = output.contiguous().view(-1, self.hidden_dim)
+        if self.adaptive is not None:
+            return self.adaptive.log_prob(output)
+        return self.softmax(self.lin(output))
+
+    def target_log_prob(self, x, target, lengths=None):
+        """
+        Log-probabilities of the targets (batch_size, seq_len) after the inputs x (batch_size, seq_len).
+        With the adaptive softmax only the head and the clusters of the targets are evaluated.
+        """
+        output, _ = self.hidden_states(x, lengths)
+        output = output.contiguous().view(-1, self.hidden_dim)
+        if self.adaptive is not None:
+            return self.adaptive(output, target.contiguous().view(-1)).output.view(target.size())
+        return self.softmax(self.lin(output)).gather(1, target.contiguous().view(-1, 1)).view(target.size())
 
     def step(self, x, h, c):
         """
@@ -44,17 +103,50 @@ class Generator(nn.Module):
         """
         emb = self.emb(x)
         output, (h, c) = self.lstm(emb, (h, c))
-        pred = F.softmax(self.lin(output.view(-1, self.hidden_dim)))
+        output = output.view(-1, self.hidden_dim)
+        if self.adaptive is not None:
+            pred = torch.exp(self.adaptive.log_prob(output))
+        else:
+            pred = F.softmax(self.lin(output), dim=1)
         return pred, h, c
 
+    def next_token(self, x, h, c):
+        """
+        Samples the next tokens (batch_size, 1) after x (batch_size, 1), returns them with the new h and c.
+        With the adaptive softmax, a head entry is sampled first, then a token of the cluster for the rows
+        which drew a cluster.
+        """
+        if self.adaptive is None:
+            pred, h, c = self.step(x, h, c)
+            return pred.multinomial(1), h, c
+        output, (h, c) = self.lstm(self.emb(x), (h, c))
+        output = output.view(-1, self.hidden_dim)
+        shortlist = self.adaptive.shortlist_size
+        head = F.softmax(self.adaptive.head(output), dim=1).multinomial(1)
+        token = head.clone()
+        for i, tail in enumerate(self.adaptive.tail):
+            rows = torch.nonzero(head.view(-1) == shortlist + i).view(-1)
+            if len(rows) > 0:
+                in_cluster = F.softmax(tail(output[rows]), dim=1).multinomial(1)
+                token[rows] = self.adaptive.cutoffs[i] + in_cluster
+        return token, h, c
 
     def init_hidden(self, batch_size):
-        h = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
-        c = Variable(torch.zeros((1, batch_size, self.hidden_dim)))
+        h = torch.zeros((1, batch_size, self.hidden_dim))
+        c = torch.zeros((1, batch_size, self.hidden_dim))
         if self.use_cuda:
             h, c = h.cuda(), c.cuda()
         return h, c
     
+    def variance_parameter(self):
+        """
+        Parameter whose gradient variance is monitored (CHECK_VARIANCE, see loss.VarianceLoss):
+        the bias of the output layer, or without one (adaptive softmax), the row of the token 0 in the head weight.
+        returns its position in parameters() and the row (None for the whole parameter)
+        """
+        param, row = (self.lin.bias, None) if self.adaptive is None else (self.adaptive.head.weight, 0)
+        return [p is param for p in self.parameters()].index(True), row
+
     def init_params(self):
         for param in self.parameters():
             param.data.uniform_(-0.05, 0.05)
@@ -71,19 +163,17 @@ class Generator(nn.Module):
         samples = []
         if sampleFromZero:
             for i in range(seq_len):
-                output, h, c = self.step(x, h, c)
-                x = output.multinomial(1)
+                x, h, c = self.next_token(x, h, c)
                 samples.append(x)
         else:
             given_len = x.size(1)
-            lis = x.chunk(x.size(1), dim=1)
-            for i in range(given_len):
-                output, h, c = self.step(lis[i], h, c)
-                samples.append(lis[i])
-            x = output.multinomial(1)
+            samples.extend(x.chunk(given_len, dim=1))
+            if given_len > 1:
+                # only the state after the given tokens is needed
+                _, (h, c) = self.lstm(self.emb(x[:, :-1]), (h, c))
+            x, h, c = self.next_token(x[:, -1:], h, c)
             for i in range(given_len, seq_len):
                 samples.append(x)
-                output, h, c = self.step(x, h, c)
-                x = output.multinomial(1)
+                x, h, c = self.next_token(x, h, c)
         output = torch.cat(samples, dim=1)
         return output
@@ -4,7 +4,6 @@ import random
 import math
 
 import argparse
-import tqdm
 
 import numpy as np
 
@@ -12,8 +11,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.autograd import Variable
 from torch.distributions import Categorical
+from torch.utils.checkpoint import checkpoint
 
 def convert_to_one_hot(data, vocab_size, cuda):
     """
@@ -23,20 +22,99 @@ def convert_to_one_hot(data, vocab_size, cuda):
     batch_size = data.size(0)
     seq_len = data.size(1)
 
-    samples = Variable(torch.Tensor(batch_size, seq_len, vocab_size))
-    one_hot = Variable(torch.zeros((batch_size, vocab_size)).long())
-
-    if(cuda):
-        # data = data.cuda()
+    samples = torch.zeros((batch_size, seq_len, vocab_size))
+    if cuda:
         samples = samples.cuda()
-        one_hot = one_hot.cuda()
+        data = data.cuda()
+    samples.scatter_(2, data.contiguous().view(batch_size, seq_len, 1), 1.0)
+
+    return samples
+
+def cpu_autocast(enabled=True):
+    """
+        CPU bfloat16 autocast context for forward passes (a no-op when disabled).
+        Parameters, gradients and optimizer states stay in fp32.
+    """
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+def pad_sequences(seqs, pad=0):
+    """
+        seqs: list of lists of tokens, possibly of different lengths
+        returns the padded tokens (num_seqs, max_len) and the lengths (num_seqs)
+    """
+    lengths = torch.LongTensor([len(s) for s in seqs])
+    padded = torch.full((len(seqs), int(lengths.max())), pad, dtype=torch.long)
+    for i, s in enumerate(seqs):
+        padded[i, :len(s)] = torch.LongTensor(s)
+
+    return padded, lengths
+
+def length_mask(lengths, max_len):
+    """
+        lengths dims: (batch_size)
+        returns dims: (batch_size, max_len), True at the positions within the sequences
+    """
+    return torch.arange(max_len, device=lengths.device).view(1, -1) < lengths.view(-1, 1)
+
+def bucket_batches(lengths, batch_size, shuffle=True):
+    """
+        Batches of indices of sequences of the same length (so that no padding is needed),
+        the last batch of every length may be smaller.
+        lengths: list of the lengths of the sequences
+        returns a list of lists of indices
+    """
+    buckets = {}
+    for i, l in enumerate(lengths):
+        buckets.setdefault(l, []).append(i)
+    batches = []
+    for l in sorted(buckets):
+        idx = buckets[l]
+        if shuffle:
+            random.shuffle(idx)
+        batches.extend(idx[i:i + batch_size] for i in range(0, len(idx), batch_size))
+    if shuffle:
+        random.shuffle(batches)
+
+    return batches
+
+def checkpointed_lstm(lstm, x, hidden, segment_len=None):
+    """
+        Runs a batch_first LSTM over x (batch_size, seq_len, input_dim) segment by segment of segment_len steps.
+        Only the inputs and the states at the segment boundaries are stored, the activations of every segment are
+        recomputed in the backward pass. A plain LSTM call if segment_len is None or no gradient is recorded.
+        returns the outputs (batch_size, seq_len, hidden_dim) and the final (h, c)
+    """
+    if segment_len is None or not torch.is_grad_enabled() or x.size(1) <= segment_len:
+        return lstm(x, hidden)
+    outputs = []
+    for segment in torch.split(x, segment_len, dim=1):
+        output, hidden = checkpoint(lstm, segment, hidden, use_reentrant=False)
+        outputs.append(output)
+
+    return torch.cat(outputs, 1), hidden
+
+def conv_filters(seq_len, odd=False):
+    """
+        Filter sizes and numbers of filters of the CNN discriminator (or, with odd, of the annex network) for a
+        sequence length: every width up to 10 (the odd ones with odd), then widths doubling from 15, then the whole
+        sequence. Gives the former hand-picked lists for SEQ_LEN = 3 and 15.
+        returns (filter_sizes, num_filters)
+    """
+    sizes = [f for f in range(1, min(seq_len, 10) + 1) if not odd or f % 2 == 1]
+    f = 15
+    while f < seq_len:
+        sizes.append(f)
+        f *= 2
+    if seq_len > 10:
+        sizes.append(seq_len)
 
-    for i in range(batch_size):
-        x = data[i].view(-1,1)
-        one_hot = Variable(torch.zeros((seq_len, vocab_size)).long())
-        if cuda:
-            one_hot = one_hot.cuda()
-            x = x.cuda()
-        samples[i] = one_hot.scatter_(1, x, 1.0)
+    def num_filters(f):
+        if f == 1:
+            return 100
+        if f <= (7 if odd else 5):
+            return 200
+        if f <= 10 or odd:
+            return 100
+        return 160
 
-    return samples
\ No newline at end of file
+    return sizes, [num_filters(f) for f in sizes]
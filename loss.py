@@ -6,7 +6,6 @@ import copy
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
-import numpy as np 
 
 import utils
 
@@ -63,33 +62,35 @@ class GANLoss(nn.Module):
             target : (N, ), torch Variable
             reward : (N, ), torch Variable
         """
-        N = target.size(0)
-        C = prob.size(1)
-        one_hot = torch.zeros((N, C))
-        if cuda:
-            one_hot = one_hot.cuda()
-        one_hot.scatter_(1, target.data.view((-1,1)), 1)
-        one_hot = one_hot.type(torch.ByteTensor)
-        one_hot = Variable(one_hot)
-        if cuda:
-            one_hot = one_hot.cuda()
-        loss = torch.masked_select(prob, one_hot)
+        loss = prob.gather(1, target.view((-1,1))).view(-1)
         loss = loss * reward
         loss =  -torch.sum(loss)
 
         return loss
     
+    def forward_off_policy(self, prob, target, reward, log_ratio, truncation=1.0):
+        """
+        Policy gradient loss on samples drawn from an older (behaviour) generator,
+        reweighted by the truncated importance ratio min(truncation, p_current / p_behaviour).
+        Args:
+            prob: (N, C), log-probabilities under the current generator
+            target : (N, )
+            reward : (N, )
+            log_ratio : (N, ), log p_current - log p_behaviour of the sequence of each token
+        """
+        ratio = torch.exp(log_ratio.detach()).clamp(max=truncation)
+        return self.forward_reinforce(prob, target, (reward * ratio).detach())
+
     def forward_reward(self, i, samples, prob, rewards, BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda=False):
         """
         Returns what is used to get the gradient contribution of the i-th term of the batch.
 
         """
-        conditional_proba = Variable(torch.zeros(BATCH_SIZE, VOCAB_SIZE))
+        conditional_proba = torch.zeros(BATCH_SIZE, VOCAB_SIZE)
         if cuda:
             conditional_proba = conditional_proba.cuda()
-        for j in range(BATCH_SIZE):
-            conditional_proba[j, int(samples[j, i])] = 1
-            conditional_proba[j, :] = - (rewards[j]/BATCH_SIZE * conditional_proba[j, :]) 
+        conditional_proba.scatter_(1, samples[:, i].contiguous().view(-1, 1), 1)
+        conditional_proba = - (rewards.detach().view(-1, 1)/BATCH_SIZE * conditional_proba)
 
         return conditional_proba
 
@@ -98,14 +99,12 @@ class GANLoss(nn.Module):
         Returns a list of gradient contribution of every term in the batch
 
         """
-        conditional_proba = Variable(torch.zeros(BATCH_SIZE, g_sequence_len, VOCAB_SIZE))
+        conditional_proba = torch.zeros(BATCH_SIZE, g_sequence_len, VOCAB_SIZE)
         batch_grads = []
         if cuda:
             conditional_proba = conditional_proba.cuda()
-        for j in range(BATCH_SIZE):
-            for i in range(g_sequence_len):
-                conditional_proba[j, i, int(samples[j, i])] = 1
-            conditional_proba[j, :, :] = - (rewards[j] * conditional_proba[j, :, :])
+        conditional_proba.scatter_(2, samples.contiguous().view(BATCH_SIZE, g_sequence_len, 1), 1)
+        conditional_proba = - (rewards.detach().view(-1, 1, 1) * conditional_proba)
         for j in range(BATCH_SIZE):
             j_grads = []
             # since we want to isolate each contribution, we have to zero the generator's gradients here. 
@@ -119,23 +118,30 @@ class GANLoss(nn.Module):
 
 class VarianceLoss(nn.Module):
 
-    """Loss for the control variate annex network"""
+    """Loss for the control variate annex network
 
-    def __init__(self):
+    The variance statistics (moments, variance) are those of the gradient of one parameter of the generator:
+    the one at position param of its parameters, or only its row row (see Generator.variance_parameter).
+    """
+
+    def __init__(self, param=-1, row=None):
         super(VarianceLoss, self).__init__()
+        self.param = param
+        self.row = row
 
     def forward(self, grad, cuda = False):
         """
-        Used to get the gradient of the variance. 
+        Mean squared norm of the gradient estimates, whose gradient w.r.t. the control variate
+        is that of the variance (the mean of the estimates does not depend on it).
+        The gradients have to be built with create_graph (see adversarial.estimator_grads).
 
         """
         bs = len(grad)
-        ref = 0
+        total_loss = 0
         for j in range(bs):
             for i in range(len(grad[j])):
-                ref += torch.sum(grad[j][i]**2).item()
-        total_loss = np.array([ref/bs])
-        total_loss = Variable(torch.Tensor(total_loss), requires_grad=True)
+                total_loss = total_loss + torch.sum(grad[j][i]**2)
+        total_loss = torch.as_tensor(total_loss / bs).view(1)
         if cuda:
             total_loss = total_loss.cuda()
 
@@ -146,22 +152,38 @@ class VarianceLoss(nn.Module):
         Used to get the variance of one single parameter. 
         In this case, we take look at the last layer, then take the variance of the first parameter of this last layer in main.py
 
+        """
+        return self.variance(self.moments(grad, cuda))
+
+    def moments(self, grad, cuda=False):
+        """
+        Sums over the batch of the gradients of the monitored parameter and of their squares, and the batch size.
+        These can be summed across processes before calling variance.
+
         """
         bs = len(grad)
-        n_layers = len(grad[0])
-        square_term = torch.zeros((grad[0][n_layers-1].size()))
-        normal_term = torch.zeros((grad[0][n_layers-1].size()))
+        selected = lambda g: g[self.param] if self.row is None else g[self.param][self.row]
+        square_term = torch.zeros((selected(grad[0]).size()))
+        normal_term = torch.zeros((selected(grad[0]).size()))
         if cuda:
             square_term = square_term.cuda()
             normal_term = normal_term.cuda()
         for j in range(bs):
-            square_term = torch.add(square_term, grad[j][n_layers-1]**2)
-            normal_term = torch.add(normal_term, grad[j][n_layers-1])
-        square_term /= bs
-        normal_term /= bs
-        normal_term = normal_term ** 2
+            square_term = torch.add(square_term, selected(grad[j]).detach().float()**2)
+            normal_term = torch.add(normal_term, selected(grad[j]).detach().float())
 
-        return square_term - normal_term
+        return normal_term, square_term, bs
 
+    def variance(self, moments):
+        """
+        Variance from the (possibly reduced) moments.
+        With a single estimate (bs == 1) this is its second moment.
 
+        """
+        normal_term, square_term, bs = moments
+        square_term = square_term / bs
+        if bs == 1:
+            return square_term
+        normal_term = (normal_term / bs) ** 2
 
+        return square_term - normal_term
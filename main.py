@@ -1,12 +1,11 @@
 # -*- coding:utf-8 -*-
 
 import os
+import time
 import random
 import math
 import argparse
-import tqdm
 import numpy as np
-import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -14,127 +13,81 @@ from torch.autograd import Variable
 
 from generator import Generator
 from discriminator import LSTMDiscriminator
-from annex_network import AnnexNetwork, LSTMAnnexNetwork
+from annex_network import AnnexNetwork, LSTMAnnexNetwork, RelaxationParameters
 from rollout import Rollout
 from data_iter import GenDataIter, DisDataIter
 from data_loader import DataLoader
+from quantized import QuantizedInference
+from replay_buffer import NegativeReplayBuffer, OffPolicyBuffer
+from distill import DistilledDiscriminator
+from config import RunConfig
+from sink import open_sink
+from profiling import Profiler, span
+from replay import StepCapture, check_supported
 
 from utils import *
 from loss import *
 from helpers import *
+from adversarial import CompiledStep, ControlVariateUpdate, generator_loss, generator_step, discriminator_loss, discriminator_step
+from adversarial import compare_estimators, reference_gradient
+import pipeline
+import stacked
 
 
-isDebug = True
-
 # ================== Parameter Definition =================
-
-# BASIC TRAINING PARAMETERS
-THC_CACHING_ALLOCATOR = 0
-SEED = 88
-random.seed(SEED)
-np.random.seed(SEED)
-torch.manual_seed(SEED)
-
-BATCH_SIZE = 128
-
-# DATA
-GENERATED_NUM = 10000
-SPACES = False # What kind of data do you want to work on?
-SEQ_LEN = 3 # 15 for SPACES = True, 3 or 15 for SPACES = False
-if SPACES:
-    POSITIVE_FILE = 'data/math_equation_data.txt'
-else:
-    POSITIVE_FILE = 'data/math_equation_data_no_spaces.txt'    
-if SEQ_LEN == 3:
-    POSITIVE_FILE = 'data/math_equation_data_3.txt'
-NEGATIVE_FILE = 'gene.data' if SEQ_LEN == 15 else 'gene_3.data'
-EVAL_FILE = 'eval.data' if SEQ_LEN == 15  else 'eval_3.data'
-if SPACES:
-    VOCAB_SIZE = 6
-else:
-    VOCAB_SIZE = 5
-
-# PRE-TRAINING
-# Loading weights currently not supported if SPACES = True
-MLE = False # If True, do pre-training, otherwise, load weights
-if SEQ_LEN == 3:
-    weights_path = "checkpoints/MLE_space_False_length_3_preTrainG_epoch_0_official.pth"
-else:
-    weights_path = "checkpoints/MLE_space_False_length_15_preTrainG_epoch_2_official.pth"
-PRE_EPOCH_GEN = 3 if isDebug else 120 # can be a decimal number
-PRE_EPOCH_DIS = 0 if isDebug else 5
-PRE_ITER_DIS = 0 if isDebug else 3
-
-# ADVERSARIAL TRAINING
-#################################
-#GD = "RELAX"
-GD = "REINFORCE" # "MLE" or REINFORCE" or "REBAR" or "RELAX"
-if GD == "MLE":
-    TOTAL_EPOCHS = 0
-CHECK_VARIANCE = True
-if GD == "RELAX":
-    CHECK_VARIANCE = True
-UPDATE_RATE = 0.8
-TOTAL_EPOCHS = 3 # can be a decimal number
-TOTAL_BATCH = int(TOTAL_EPOCHS * int(GENERATED_NUM/BATCH_SIZE))
-G_STEPS = 1 if isDebug else 1
-D_STEPS = 1 if isDebug else 4
-D_EPOCHS = 1 if isDebug else 2
-
-# GENERATOR
-g_emb_dim = 32
-g_hidden_dim = 32
-g_sequence_len = SEQ_LEN
-
-# DISCRIMINATOR
-d_emb_dim = 64
-if SEQ_LEN == 3:
-    d_filter_sizes = [1, 2, 3]
-    d_num_filters = [100, 200, 200]
-else:
-    d_filter_sizes = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 15]
-    d_num_filters = [100, 200, 200, 200, 200, 100, 100, 100, 100, 100, 160]
-d_dropout = 0.75
-d_num_class = 2
-d_lstm_hidden_dim = 32
-
-# ANNEX NETWORK
-c_lstm_hidden_dim = 32
-if SEQ_LEN == 3:
-    c_filter_sizes = [1, 3]
-    c_num_filters = [100, 200]
-else: 
-    c_filter_sizes = [1, 3, 5, 7, 9, 15]
-    c_num_filters = [100, 200, 200, 200, 100, 100]
-    
-# OTHER HYPER-PARAMETERS
-DEFAULT_ETA = 1 #for REBAR only. Note: Naive value, in paper they estimate value
-DEFAULT_TEMPERATURE = 1
+# The parameters of a run are the fields of config.RunConfig: defaults there, overridden by a JSON file (--config)
+# and on the command line (e.g. --SEQ_LEN 15 --GD RELAX), see RunConfig.add_arguments.
 
 
-def main(opt):
+def main(opt, config):
 
     cuda = opt.cuda; visualize = opt.visualize
     print(f"cuda = {cuda}, visualize = {opt.visualize}")
+    random.seed(config.SEED)
+    np.random.seed(config.SEED)
+    torch.manual_seed(config.SEED)
+
+    # the checkpoints and metric records of the run are tagged with the hash of its configuration
+    run_hash = config.hash()
+    run_dir = os.path.join('runs', run_hash)
+    os.makedirs(run_dir, exist_ok=True)
+    config.save(os.path.join(run_dir, 'config.json'))
+    print('Run {}: {}'.format(run_hash, os.path.join(run_dir, 'config.json')))
+    if config.STACKED:
+        # the one-replica stacked run of the seed (stacked.train), its results are not those of the plain run of the seed
+        if cuda:
+            raise ValueError('The stacked replicas are CPU only')
+        stacked.train(config, [config.SEED])
+        return
+    if config.PIPELINE:
+        pipeline.check_supported(config)
+    if config.CAPTURE_BATCH is not None:
+        check_supported(config)
+    # metrics and generated strings are written by background threads (sink.py)
+    visdom_titles = None
     if visualize:
-        if PRE_EPOCH_GEN > 0: pretrain_G_score_logger = VisdomPlotLogger('line', opts={'title': 'Pre-train G Goodness Score'})
-        if PRE_EPOCH_DIS > 0: pretrain_D_loss_logger = VisdomPlotLogger('line', opts={'title': 'Pre-train D Loss'})
-        adversarial_G_score_logger = VisdomPlotLogger('line', opts={'title': f'Adversarial G {GD} Goodness Score',
-                                                      'Y': '{0, 13}', 'X': '{0, TOTAL_BATCH}' })
-        if CHECK_VARIANCE: G_variance_logger = VisdomPlotLogger('line', opts={'title': f'Adversarial G {GD} Variance'})
-        G_text_logger = VisdomTextLogger(update_type='APPEND')
-        adversarial_D_loss_logger = VisdomPlotLogger('line', opts={'title': 'Adversarial Batch D Loss'})
+        visdom_titles = {('mle', 'goodness'): 'Pre-train G Goodness Score', ('pretrain_d', 'loss'): 'Pre-train D Loss',
+                         ('adversarial', 'goodness'): f'Adversarial G {config.GD} Goodness Score',
+                         ('adversarial', config.variance_metric): f'Adversarial G {config.GD} ' + config.variance_metric.replace('_', ' ').capitalize(),
+                         ('adversarial', 'eta'): f'Adversarial G {config.GD} eta',
+                         ('adversarial', 'temperature'): f'Adversarial G {config.GD} temperature',
+                         ('adversarial', 'd_loss'): 'Adversarial Batch D Loss'}
+    sink = open_sink(config, run_dir, visdom_titles)
 
     # Define Networks
-    generator = Generator(VOCAB_SIZE, g_emb_dim, g_hidden_dim, cuda)
+    generator = Generator(config.VOCAB_SIZE, config.g_emb_dim, config.g_hidden_dim, cuda, checkpoint_segment=config.CHECKPOINT_SEGMENT,
+                          adaptive_cutoffs=config.ADAPTIVE_CUTOFFS)
     n_gen = Variable(torch.Tensor([get_n_params(generator)]))
     use_cuda = False
     if cuda:
         n_gen = n_gen.cuda()
         use_cuda = True
     print('Number of parameters in the generator: {}'.format(n_gen))
-    discriminator = LSTMDiscriminator(d_num_class, VOCAB_SIZE, d_lstm_hidden_dim, use_cuda)
-    c_phi_hat = AnnexNetwork(d_num_class, VOCAB_SIZE, d_emb_dim, c_filter_sizes, c_num_filters, d_dropout, BATCH_SIZE, g_sequence_len)
+    discriminator = LSTMDiscriminator(config.d_num_class, config.VOCAB_SIZE, config.d_lstm_hidden_dim, use_cuda,
+                                      checkpoint_segment=config.CHECKPOINT_SEGMENT,
+                                      emb_dim=config.d_emb_dim if config.EMBED_INPUTS else None)
+    c_phi_hat = AnnexNetwork(config.d_num_class, config.VOCAB_SIZE, config.d_emb_dim, config.c_filter_sizes, config.c_num_filters,
+                             config.d_dropout, config.g_sequence_len, embed_inputs=config.EMBED_INPUTS)
     if cuda:
         generator = generator.cuda()
         discriminator = discriminator.cuda()
@@ -144,66 +97,85 @@ def main(opt):
     print('Generating data ...')
     
     # Load data from file
-    gen_data_iter = DataLoader(POSITIVE_FILE, BATCH_SIZE)
+    gen_data_iter = DataLoader(config.POSITIVE_FILE, config.BATCH_SIZE, bucket=config.BUCKET_BY_LENGTH, tokens=config.token_data)
 
     gen_criterion = nn.NLLLoss(size_average=False)
     gen_optimizer = optim.Adam(generator.parameters())
     if cuda:
         gen_criterion = gen_criterion.cuda()
 
+    # Token data (config.token_data): the arithmetic scores do not apply, the sequences of EVAL_FILE are scored on their ids
+    if config.token_data:
+        real_freq = get_token_freq(gen_data_iter.lines, config.VOCAB_SIZE)
+
+    def evaluate_tokens(samples, phase, step, label, **values):
+        eval_iter = DataLoader(config.EVAL_FILE, config.BATCH_SIZE, tokens=True)
+        sink.text(phase, step, eval_iter.convert_to_char(samples))
+        kl_score, distinct = get_token_scores(eval_iter.lines, real_freq, config.VOCAB_SIZE)
+        print('%s [%d] Token KL Score: %f, distinct sequences: %f' % (label, step, kl_score, distinct))
+        sink.log(phase, step, token_kl=kl_score, distinct=distinct, **values)
+
     # Pretrain Generator using MLE        
     pre_train_scores = []
-    if MLE:    
+    if config.MLE:    
         print('Pretrain with MLE ...')
-        for epoch in range(int(np.ceil(PRE_EPOCH_GEN))):
-            loss = train_epoch(generator, gen_data_iter, gen_criterion, gen_optimizer, PRE_EPOCH_GEN, epoch, cuda)
+        for epoch in range(int(np.ceil(config.PRE_EPOCH_GEN))):
+            loss = train_epoch(generator, gen_data_iter, gen_criterion, gen_optimizer, config.PRE_EPOCH_GEN, epoch, config, cuda,
+                               bptt=config.MLE_BPTT)
             print('Epoch [%d] Model Loss: %f'% (epoch, loss))
-            samples = generate_samples(generator, BATCH_SIZE, GENERATED_NUM, EVAL_FILE)
-            eval_iter = DataLoader(EVAL_FILE, BATCH_SIZE)
-            generated_string = eval_iter.convert_to_char(samples)
-            print(generated_string)
-            eval_score = get_data_goodness_score(generated_string, SPACES)
-            if SPACES == False:
-                kl_score = get_data_freq(generated_string)
+            samples = generate_samples(generator, config, config.EVAL_FILE)
+            if config.token_data:
+                evaluate_tokens(samples, 'mle', epoch, 'Epoch', loss=loss)
             else:
-                kl_score = -1
-            freq_score = get_char_freq(generated_string, SPACES)
-            pre_train_scores.append(eval_score)
-            print('Epoch [%d] Generation Score: %f' % (epoch, eval_score))
-            print('Epoch [%d] KL Score: %f' % (epoch, kl_score))
-            print('Epoch [{}] Character distribution: {}'.format(epoch, list(freq_score)))
-            
-            torch.save(generator.state_dict(), f"checkpoints/MLE_space_{SPACES}_length_{SEQ_LEN}_preTrainG_epoch_{epoch}.pth")
+                eval_iter = DataLoader(config.EVAL_FILE, config.BATCH_SIZE)
+                generated_string = eval_iter.convert_to_char(samples)
+                sink.text('mle', epoch, generated_string)
+                eval_score = get_data_goodness_score(generated_string, config.SPACES)
+                if config.SPACES == False:
+                    kl_score = get_data_freq(generated_string, config)
+                else:
+                    kl_score = -1
+                freq_score = get_char_freq(generated_string, config.SPACES)
+                pre_train_scores.append(eval_score)
+                print('Epoch [%d] Generation Score: %f' % (epoch, eval_score))
+                print('Epoch [%d] KL Score: %f' % (epoch, kl_score))
+                print('Epoch [{}] Character distribution: {}'.format(epoch, list(freq_score)))
+                sink.log('mle', epoch, loss=loss, goodness=eval_score, kl=kl_score,
+                         char_freq=list(freq_score))
             
-            if visualize:
-                pretrain_G_score_logger.log(epoch, eval_score)
+            torch.save(generator.state_dict(),
+                       f"checkpoints/MLE_space_{config.SPACES}_length_{config.SEQ_LEN}_preTrainG_epoch_{epoch}_{run_hash}.pth")
     else:
-        generator.load_state_dict(torch.load(weights_path))
+        generator.load_state_dict(torch.load(config.weights_path, map_location=None if cuda else lambda storage, loc: storage))
 
     # Finishing training with MLE  
-    if GD == "MLE":   
-        for epoch in range(3*int(GENERATED_NUM/BATCH_SIZE)):
-            loss = train_epoch_batch(generator, gen_data_iter, gen_criterion, gen_optimizer, PRE_EPOCH_GEN, epoch, int(GENERATED_NUM/BATCH_SIZE), cuda)
+    if config.GD == "MLE":   
+        for epoch in range(3*int(config.GENERATED_NUM/config.BATCH_SIZE)):
+            loss = train_epoch_batch(generator, gen_data_iter, gen_criterion, gen_optimizer, config.PRE_EPOCH_GEN, epoch,
+                                     int(config.GENERATED_NUM/config.BATCH_SIZE), cuda)
             print('Epoch [%d] Model Loss: %f'% (epoch, loss))
-            samples = generate_samples(generator, BATCH_SIZE, GENERATED_NUM, EVAL_FILE)
-            eval_iter = DataLoader(EVAL_FILE, BATCH_SIZE)
-            generated_string = eval_iter.convert_to_char(samples)
-            print(generated_string)
-            eval_score = get_data_goodness_score(generated_string, SPACES)
-            if SPACES == False:
-                kl_score = get_data_freq(generated_string)
+            samples = generate_samples(generator, config, config.EVAL_FILE)
+            if config.token_data:
+                evaluate_tokens(samples, 'mle', epoch, 'Epoch', loss=loss)
             else:
-                kl_score = -1
-            freq_score = get_char_freq(generated_string, SPACES)
-            pre_train_scores.append(eval_score)
-            print('Epoch [%d] Generation Score: %f' % (epoch, eval_score))
-            print('Epoch [%d] KL Score: %f' % (epoch, kl_score))
-            print('Epoch [{}] Character distribution: {}'.format(epoch, list(freq_score)))
-            
-            torch.save(generator.state_dict(), f"checkpoints/MLE_space_{SPACES}_length_{SEQ_LEN}_preTrainG_epoch_{epoch}.pth")
+                eval_iter = DataLoader(config.EVAL_FILE, config.BATCH_SIZE)
+                generated_string = eval_iter.convert_to_char(samples)
+                sink.text('mle', epoch, generated_string)
+                eval_score = get_data_goodness_score(generated_string, config.SPACES)
+                if config.SPACES == False:
+                    kl_score = get_data_freq(generated_string, config)
+                else:
+                    kl_score = -1
+                freq_score = get_char_freq(generated_string, config.SPACES)
+                pre_train_scores.append(eval_score)
+                print('Epoch [%d] Generation Score: %f' % (epoch, eval_score))
+                print('Epoch [%d] KL Score: %f' % (epoch, kl_score))
+                print('Epoch [{}] Character distribution: {}'.format(epoch, list(freq_score)))
+                sink.log('mle', epoch, loss=loss, goodness=eval_score, kl=kl_score,
+                         char_freq=list(freq_score))
             
-            if visualize:
-                pretrain_G_score_logger.log(epoch, eval_score)
+            torch.save(generator.state_dict(),
+                       f"checkpoints/MLE_space_{config.SPACES}_length_{config.SEQ_LEN}_preTrainG_epoch_{epoch}_{run_hash}.pth")
 
     # Pretrain Discriminator
     dis_criterion = nn.NLLLoss(size_average=False)
@@ -211,231 +183,224 @@ def main(opt):
     if opt.cuda:
         dis_criterion = dis_criterion.cuda()
     print('Pretrain Discriminator ...')
-    for epoch in range(PRE_EPOCH_DIS):
-        samples = generate_samples(generator, BATCH_SIZE, GENERATED_NUM, NEGATIVE_FILE)
-        dis_data_iter = DisDataIter(POSITIVE_FILE, NEGATIVE_FILE, BATCH_SIZE, SEQ_LEN)
-        for _ in range(PRE_ITER_DIS):
-            loss = train_epoch(discriminator, dis_data_iter, dis_criterion, dis_optimizer, 1, 1, cuda)
+    for epoch in range(config.PRE_EPOCH_DIS):
+        samples = generate_samples(generator, config, config.NEGATIVE_FILE)
+        dis_data_iter = DisDataIter(config.POSITIVE_FILE, config.NEGATIVE_FILE, config.BATCH_SIZE, config.SEQ_LEN, bucket=config.BUCKET_BY_LENGTH,
+                                    tokens=config.token_data)
+        for _ in range(config.PRE_ITER_DIS):
+            loss = train_epoch(discriminator, dis_data_iter, dis_criterion, dis_optimizer, 1, 1, config, cuda)
             print('Epoch [%d], loss: %f' % (epoch, loss))
-            if visualize:
-                pretrain_D_loss_logger.log(epoch, loss)
+            sink.log('pretrain_d', epoch, loss=loss)
 
     # Adversarial Training 
-    rollout = Rollout(generator, UPDATE_RATE)
+    rollout = Rollout(generator, config.UPDATE_RATE)
+    if config.QUANTIZED_INFERENCE:
+        assert not cuda, "Quantized inference is CPU only"
+        quantized = QuantizedInference(generator, discriminator)
+    eval_generator = generator
+    reward_discriminator = discriminator
+    if config.NEGATIVE_REPLAY:
+        negatives = NegativeReplayBuffer(config.REPLAY_CAPACITY, config.g_sequence_len, config.REPLAY_REFRESH, config.REPLAY_MAX_AGE, cuda)
+    off_policy = OffPolicyBuffer(config.OFF_POLICY_K) if config.OFF_POLICY_K > 0 else None
+    if config.REWARD_DISTILL:
+        reward_discriminator = DistilledDiscriminator(discriminator, config.g_sequence_len, config.VOCAB_SIZE, n=config.DISTILL_NGRAM,
+                                                      fit_steps=config.DISTILL_FIT_STEPS, tolerance=config.DISTILL_TOLERANCE,
+                                                      check_every=config.DISTILL_CHECK_EVERY, check_size=config.DISTILL_CHECK_SIZE, cuda=cuda)
     print('#####################################################')
     print('Start Adversarial Training...\n')
     
-    gen_gan_loss = GANLoss()
     gen_gan_optm = optim.Adam(generator.parameters())
-    if cuda:
-        gen_gan_loss = gen_gan_loss.cuda()
-    gen_criterion = nn.NLLLoss(size_average=False)
-    if cuda:
-        gen_criterion = gen_criterion.cuda()
+    gen_loss_fn = CompiledStep(generator_loss, config.COMPILE and not config.CHECK_VARIANCE)
     
-    dis_criterion = nn.NLLLoss(size_average=False)
-    dis_criterion_bce = nn.BCELoss()
     dis_optimizer = optim.Adam(discriminator.parameters())
-    if cuda:
-        dis_criterion = dis_criterion.cuda()
+    dis_loss_fn = CompiledStep(discriminator_loss, config.COMPILE)
     
-    c_phi_hat_loss = VarianceLoss()
+    c_phi_hat_loss = VarianceLoss(*generator.variance_parameter())
     if cuda:
         c_phi_hat_loss = c_phi_hat_loss.cuda()
     c_phi_hat_optm = optim.Adam(c_phi_hat.parameters())
+    relaxation = None
+    if config.LEARN_RELAXATION:
+        assert config.CHECK_VARIANCE, "eta and the temperature are learnt from the variance of the gradient"
+        relaxation = RelaxationParameters(config.DEFAULT_ETA, config.DEFAULT_TEMPERATURE)
+        if cuda:
+            relaxation = relaxation.cuda()
+        c_phi_hat_optm.add_param_group({'params': relaxation.parameters(), 'lr': config.RELAXATION_LR})
+    # 3.i - called by generator_step before the generator update
+    update_c_phi_hat = ControlVariateUpdate(c_phi_hat_loss, c_phi_hat_optm, cuda=cuda)
 
     gen_scores = pre_train_scores
-    
-    for total_batch in range(TOTAL_BATCH):
-        # Train the generator for one step
-        for it in range(G_STEPS):
-            samples = generator.sample(BATCH_SIZE, g_sequence_len)
-            # samples has size (BS, sequence_len)
-            # Construct the input to the generator, add zeros before samples and delete the last column
-            zeros = torch.zeros((BATCH_SIZE, 1)).type(torch.LongTensor)
-            if samples.is_cuda:
-                zeros = zeros.cuda()
-            inputs = Variable(torch.cat([zeros, samples.data], dim = 1)[:, :-1].contiguous())
-            targets = Variable(samples.data).contiguous().view((-1,))
-            if opt.cuda:
-                inputs=inputs.cuda()
-                targets=targets.cuda()
-            # Calculate the reward
-            rewards = rollout.get_reward(samples, discriminator, VOCAB_SIZE, cuda)
-            rewards = Variable(torch.Tensor(rewards))
-            if cuda:
-                rewards = torch.exp(rewards.cuda()).contiguous().view((-1,))
-            rewards = torch.exp(rewards)
-            # rewards has size (BS)
-            prob = generator.forward(inputs)
-            # prob has size (BS*sequence_len, VOCAB_SIZE)
-            # 3.a
-            theta_prime = g_output_prob(prob)
-            # theta_prime has size (BS*sequence_len, VOCAB_SIZE)
-            # 3.e and f
-            c_phi_z_ori, c_phi_z_tilde_ori = c_phi_out(GD, c_phi_hat, theta_prime, discriminator, temperature=DEFAULT_TEMPERATURE, eta=DEFAULT_ETA, cuda=cuda)
-            c_phi_z_ori = torch.exp(c_phi_z_ori)
-            c_phi_z_tilde_ori = torch.exp(c_phi_z_tilde_ori)
-            c_phi_z = torch.sum(c_phi_z_ori[:,1])/BATCH_SIZE
-            c_phi_z_tilde = -torch.sum(c_phi_z_tilde_ori[:,1])/BATCH_SIZE
-            if opt.cuda:
-                c_phi_z = c_phi_z.cuda()
-                c_phi_z_tilde = c_phi_z_tilde.cuda()
-                c_phi_hat = c_phi_hat.cuda()
-            # 3.i
-            grads = []
-            first_term_grads = []
-            # 3.h optimization step
-            # first, empty the gradient buffers
-            gen_gan_optm.zero_grad()
-            # first, re arrange prob
-            new_prob = prob.view((BATCH_SIZE, g_sequence_len, VOCAB_SIZE))
-            # 3.g new gradient loss for relax 
-            batch_i_grads_1 = gen_gan_loss.forward_reward_grads(samples, new_prob, rewards, generator, BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda)
-            batch_i_grads_2 = gen_gan_loss.forward_reward_grads(samples, new_prob, c_phi_z_tilde_ori[:,1], generator, BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda)
-            # batch_i_grads_1 and batch_i_grads_2 should be of length BATCH SIZE of arrays of all the gradients
-            # # 3.i
-            batch_grads = batch_i_grads_1
-            if GD != "REINFORCE":
-                for i in range(len(batch_i_grads_1)):
-                    for j in range(len(batch_i_grads_1[i])):
-                        batch_grads[i][j] = torch.add(batch_grads[i][j], (-1)*batch_i_grads_2[i][j])
-            # batch_grads should be of length BATCH SIZE
-            grads.append(batch_grads)
-            # NOW, TRAIN THE GENERATOR
-            generator.zero_grad()
-            for i in range(g_sequence_len):
-                # 3.g new gradient loss for relax 
-                cond_prob = gen_gan_loss.forward_reward(i, samples, new_prob, rewards, BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda)
-                c_term = gen_gan_loss.forward_reward(i, samples, new_prob, c_phi_z_tilde_ori[:,1], BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda)
-                if GD != "REINFORCE":
-                    cond_prob = torch.add(cond_prob, (-1)*c_term)
-                new_prob[:, i, :].backward(cond_prob, retain_graph=True)
-            # 3.h - still training the generator, with the last two terms of the RELAX equation
-            if GD != "REINFORCE":
-                c_phi_z.backward(retain_graph=True)
-                c_phi_z_tilde.backward(retain_graph=True)
-            gen_gan_optm.step()
-            # 3.i
-            if CHECK_VARIANCE:
-                # c_phi_z term
-                partial_grads = []
-                for j in range(BATCH_SIZE):
-                    generator.zero_grad()
-                    ##############################################################
-                    c_phi_z_ori[j,1].backward(retain_graph=True)
-                    #c_phi_z_ori[j,1].backward()
-                    j_grads = []
-                    for p in generator.parameters():
-                        j_grads.append(p.grad.clone())
-                    partial_grads.append(j_grads)
-                grads.append(partial_grads)
-                # c_phi_z_tilde term
-                partial_grads = []
-                for j in range(BATCH_SIZE):
-                    generator.zero_grad()
-                    ##############################################################
-                    c_phi_z_tilde_ori[j,1].backward(retain_graph=True)
-                    #c_phi_z_tilde_ori[j,1].backward()
-                    j_grads = []
-                    for p in generator.parameters():
-                        j_grads.append(-1*p.grad.clone())
-                    partial_grads.append(j_grads)
-                grads.append(partial_grads)
-                # Uncomment the below code if you want to check gradients
-                """
-                print('1st contribution to the gradient')
-                print(grads[0][0][6])
-                print('2nd contribution to the gradient')
-                print(grads[1][0][6])
-                print('3rd contribution to the gradient')
-                print(grads[2][0][6])
-                """
-                #grads should be of length 3
-                #grads[0] should be of length BATCH SIZE
-                # 3.j
-                all_grads = grads[0]
-                if GD != "REINFORCE":
-                    for i in range(len(grads[0])):
-                        for j in range(len(grads[0][i])):
-                            all_grads[i][j] = torch.add(torch.add(all_grads[i][j], grads[1][i][j]), grads[2][i][j])
-                # all_grads should be of length BATCH_SIZE
-                c_phi_hat_optm.zero_grad()
-                var_loss = c_phi_hat_loss.forward(all_grads, cuda)  #/n_gen
-                true_variance = c_phi_hat_loss.forward_variance(all_grads, cuda)
-                var_loss.backward()
-                c_phi_hat_optm.step()
-                print('Batch [{}] Estimate of the variance of the gradient at step {}: {}'.format(total_batch, it, true_variance[0]))
-                if visualize:
-                    G_variance_logger.log((total_batch + it), true_variance[0])
-
-        # Evaluate the quality of the Generator outputs
-        if total_batch % 1 == 0 or total_batch == TOTAL_BATCH - 1:
-                samples = generate_samples(generator, BATCH_SIZE, GENERATED_NUM, EVAL_FILE)
-                eval_iter = DataLoader(EVAL_FILE, BATCH_SIZE)
-                generated_string = eval_iter.convert_to_char(samples)
-                print(generated_string)
-                eval_score = get_data_goodness_score(generated_string, SPACES)
-                if SPACES == False:
-                    kl_score = get_data_freq(generated_string)
+
+    # Evaluate the quality of the Generator outputs
+    def evaluate(total_batch):
+        nonlocal eval_generator
+        if config.QUANTIZED_INFERENCE and total_batch % config.QUANTIZE_EVERY == 0:
+            eval_generator = quantized.refresh_generator()
+        samples = generate_samples(eval_generator, config, config.EVAL_FILE)
+        if config.token_data:
+            evaluate_tokens(samples, 'adversarial', total_batch, 'Batch')
+        else:
+            eval_iter = DataLoader(config.EVAL_FILE, config.BATCH_SIZE)
+            generated_string = eval_iter.convert_to_char(samples)
+            sink.text('adversarial', total_batch, generated_string)
+            eval_score = get_data_goodness_score(generated_string, config.SPACES)
+            if config.SPACES == False:
+                kl_score = get_data_freq(generated_string, config)
+            else:
+                kl_score = -1
+            freq_score = get_char_freq(generated_string, config.SPACES)
+            gen_scores.append(eval_score)
+            print('Batch [%d] Generation Score: %f' % (total_batch, eval_score))
+            print('Batch [%d] KL Score: %f' % (total_batch, kl_score))
+            print('Epoch [{}] Character distribution: {}'.format(total_batch, list(freq_score)))
+            sink.log('adversarial', total_batch, goodness=eval_score, kl=kl_score,
+                     char_freq=list(freq_score))
+
+        #Checkpoint & Visualize
+        if total_batch % 10 == 0 or total_batch == config.TOTAL_BATCH -1:
+            torch.save(generator.state_dict(),
+                       f'checkpoints/{config.GD}_G_space_{config.SPACES}_pretrain_{config.PRE_EPOCH_GEN:g}_batch_{total_batch}_{run_hash}.pth')
+
+    # timing spans of the phases of the adversarial batches (profiling.py)
+    profiler = None
+    if config.PROFILE or config.PROFILE_TORCH:
+        profiler = Profiler(config.PROFILE_MEMORY, config.PROFILE_TORCH, run_dir).start()
+
+    if config.PIPELINE:
+        assert not cuda, "The pipelined mode is CPU only"
+        d_steps_per_version = config.D_EPOCHS * int(np.ceil(gen_data_iter.total_lines / config.BATCH_SIZE))
+        history = pipeline.train(generator, discriminator, c_phi_hat, config.GD, config.TOTAL_BATCH, config.POSITIVE_FILE, config.BATCH_SIZE,
+                                 config.g_sequence_len, config.VOCAB_SIZE, config.DEFAULT_TEMPERATURE, config.DEFAULT_ETA, config.UPDATE_RATE,
+                                 num_actors=config.PIPELINE_ACTORS, max_staleness=config.MAX_STALENESS, capacity=config.RING_CAPACITY,
+                                 d_steps_per_version=d_steps_per_version, check_variance=config.CHECK_VARIANCE,
+                                 per_sample=config.VARIANCE_PER_SAMPLE,
+                                 threads=max(1, os.cpu_count() // (config.PIPELINE_ACTORS + 2)), seed=config.SEED, eval_fn=evaluate,
+                                 tokens=config.token_data)
+        for total_batch, h in enumerate(history):
+            print('Batch [{}] G step: {:.3f}s, sample lag: {}, D steps: {} ({} reused batches), D loss: {:.4f}'.format(
+                total_batch, h['time'], h['lag'], h['d_steps'], h['reused'], h['d_loss']))
+            sink.log('adversarial', total_batch, g_step_time=h['time'], d_loss=h['d_loss'],
+                     **({config.variance_metric: h['variance']} if config.CHECK_VARIANCE else {}))
+            if config.CHECK_VARIANCE:
+                print('Batch [{}] Estimate of the {} of the gradient: {}'.format(
+                    total_batch, config.variance_metric.replace('_', ' '), h['variance']))
+    else:
+        for total_batch in range(config.TOTAL_BATCH):
+            if profiler is not None:
+                profiler.step(total_batch)
+            # state of the first G step and D step of the batch, for replay.py
+            capture = None
+            if total_batch == config.CAPTURE_BATCH:
+                capture = StepCapture(os.path.join(run_dir, 'capture_{}.pt'.format(total_batch)), config, total_batch)
+            if config.QUANTIZED_INFERENCE and total_batch % config.QUANTIZE_EVERY == 0:
+                if config.REWARD_DISTILL:
+                    # the quantized D is the teacher of the table
+                    reward_discriminator.discriminator = quantized.refresh_discriminator()
                 else:
-                    kl_score = -1
-                freq_score = get_char_freq(generated_string, SPACES)
-                gen_scores.append(eval_score)
-                print('Batch [%d] Generation Score: %f' % (total_batch, eval_score))
-                print('Batch [%d] KL Score: %f' % (total_batch, kl_score))
-                print('Epoch [{}] Character distribution: {}'.format(total_batch, list(freq_score)))
-
-                #Checkpoint & Visualize
-                if total_batch % 10 == 0 or total_batch == TOTAL_BATCH -1:
-                    torch.save(generator.state_dict(), f'checkpoints/{GD}_G_space_{SPACES}_pretrain_{PRE_EPOCH_GEN}_batch_{total_batch}.pth')
-                if visualize:
-                    [G_text_logger.log(line) for line in generated_string]
-                    adversarial_G_score_logger.log(total_batch, eval_score)
-
-        # Train the discriminator
-        batch_G_loss = 0.0
-
-        for b in range(D_EPOCHS):
-
-            for data, _ in gen_data_iter:
-
-                data = Variable(data)
-                real_data = convert_to_one_hot(data, VOCAB_SIZE, cuda)
-                real_target = Variable(torch.ones((data.size(0), 1)))
-                samples = generator.sample(data.size(0), g_sequence_len) # bs x seq_len
-                fake_data = convert_to_one_hot(samples, VOCAB_SIZE, cuda) # bs x seq_len x vocab_size
-                fake_target = Variable(torch.zeros((data.size(0), 1)))
-                
-                if cuda:
-                    real_target = real_target.cuda()
-                    fake_target = fake_target.cuda()
-                    real_data = real_data.cuda()
-                    fake_data = fake_data.cuda()
-                #######################################################
-                #real_pred = torch.exp(discriminator(real_data)[:, 1])
-                real_pred = torch.exp(discriminator(real_data)[:, :-1])
-                #fake_pred = torch.exp(discriminator(fake_data)[:, 1])
-                fake_pred = torch.exp(discriminator(fake_data)[:, :-1])
-
-                D_real_loss = dis_criterion_bce(real_pred, real_target)
-                D_fake_loss = dis_criterion_bce(fake_pred, fake_target)
-                D_loss = D_real_loss + D_fake_loss
-                dis_optimizer.zero_grad()
-                D_loss.backward()
-                dis_optimizer.step()
-
-            gen_data_iter.reset()
-
-            #print('Batch [{}] Discriminator Loss at step and epoch {}: {}'.format(total_batch, b, D_loss.data[0]))
-
-        if visualize:
-            adversarial_D_loss_logger.log(total_batch, D_loss.data[0])
-
-    if not visualize:
+                    reward_discriminator = quantized.refresh_discriminator()
+            if config.REWARD_DISTILL and total_batch % config.DISTILL_EVERY == 0:
+                error = reward_discriminator.distill(generator)
+                print('Batch [{}] Distilled reward error: {}'.format(total_batch, error))
+            # Train the generator for one step
+            for it in range(config.G_STEPS):
+                g_start = time.perf_counter()
+                temperature, eta = config.DEFAULT_TEMPERATURE, config.DEFAULT_ETA
+                if config.LEARN_RELAXATION:
+                    temperature, eta = relaxation.temperature, relaxation.eta
+                if config.COMPARE_ESTIMATORS:
+                    reference = reference_gradient(generator, discriminator, rollout, config.BATCH_SIZE, config.g_sequence_len, config.VOCAB_SIZE,
+                                                   config.REFERENCE_BATCHES, cuda)
+                    stats, true_variance = compare_estimators(generator, discriminator, c_phi_hat, rollout, gen_gan_optm, config.GD,
+                                                              config.BATCH_SIZE, config.g_sequence_len, config.VOCAB_SIZE, temperature, eta,
+                                                              reference=reference, variance_fn=update_c_phi_hat if config.CHECK_VARIANCE else None,
+                                                              reward_discriminator=reward_discriminator, cuda=cuda)
+                    for estimator, (variance, cosine) in stats.items():
+                        print('Batch [{}] {} variance: {}, cosine similarity to the reference gradient: {}'.format(
+                            total_batch, estimator, variance, cosine))
+                else:
+                    g_samples = None
+                    if capture is not None and it == 0:
+                        # drawn here as generator_step would, the run is the same with or without the capture
+                        g_samples = generator.sample(config.BATCH_SIZE, config.g_sequence_len)
+                        capture.g_step(generator, discriminator, c_phi_hat, relaxation, rollout, gen_gan_optm, c_phi_hat_optm, g_samples)
+                    with span('g_step'):
+                        samples, rewards, true_variance = generator_step(generator, discriminator, c_phi_hat, rollout, gen_gan_optm, config.GD,
+                                                                         config.BATCH_SIZE, config.g_sequence_len, config.VOCAB_SIZE, temperature, eta,
+                                                                         loss_fn=gen_loss_fn, reward_discriminator=reward_discriminator, samples=g_samples,
+                                                                         check_variance=config.CHECK_VARIANCE, variance_fn=update_c_phi_hat,
+                                                                         per_sample=config.VARIANCE_PER_SAMPLE, off_policy=off_policy,
+                                                                         truncation=config.IS_TRUNCATION, micro_batch_size=config.MICRO_BATCH_SIZE,
+                                                                         bf16=config.BF16_AUTOCAST, cuda=cuda)
+                    if capture is not None and it == 0:
+                        capture.g_done(generator)
+                sink.log('adversarial', total_batch, g_step_time=time.perf_counter() - g_start)
+                if config.CHECK_VARIANCE:
+                    print('Batch [{}] Estimate of the {} of the gradient at step {}: {}'.format(
+                        total_batch, config.variance_metric.replace('_', ' '), it, true_variance[0]))
+                    sink.log('adversarial', total_batch, **{config.variance_metric: true_variance[0].item()})
+                if config.LEARN_RELAXATION:
+                    print('Batch [{}] eta: {}, temperature: {}'.format(total_batch, relaxation.eta.item(), relaxation.temperature.item()))
+                    sink.log('adversarial', total_batch, eta=relaxation.eta.item(),
+                             temperature=relaxation.temperature.item())
+
+            # Evaluate the quality of the Generator outputs
+            with span('evaluate'):
+                evaluate(total_batch)
+
+            # Train the discriminator
+            batch_G_loss = 0.0
+            if config.NEGATIVE_REPLAY:
+                negatives.refresh(generator, total_batch)
+
+            d_start = time.perf_counter()
+            D_loss = None # no D-step with D_EPOCHS = 0
+            for b in range(config.D_EPOCHS):
+
+                for data, _ in gen_data_iter:
+
+                    with span('d_sample'):
+                        if config.NEGATIVE_REPLAY:
+                            samples = negatives.sample(data.size(0))
+                        else:
+                            samples = generator.sample(data.size(0), config.g_sequence_len) # bs x seq_len
+                    if capture is not None and 'd' not in capture.state:
+                        capture.d_step(discriminator, dis_optimizer, data, samples, gen_data_iter.lengths)
+                    with span('d_step'):
+                        D_loss = discriminator_step(discriminator, dis_optimizer, data, samples, config.VOCAB_SIZE,
+                                                    loss_fn=dis_loss_fn, micro_batch_size=config.MICRO_BATCH_SIZE,
+                                                    data_lengths=gen_data_iter.lengths, bf16=config.BF16_AUTOCAST, cuda=cuda)
+                    if capture is not None and 'checksum' not in capture.state['d']:
+                        capture.d_done(discriminator)
+
+                gen_data_iter.reset()
+
+                #print('Batch [{}] Discriminator Loss at step and epoch {}: {}'.format(total_batch, b, D_loss.data[0]))
+            if capture is not None and 'd' not in capture.state:
+                # no D-step (D_EPOCHS = 0): the G step only
+                capture.save()
+
+            sink.log('adversarial', total_batch, d_step_time=time.perf_counter() - d_start,
+                     **({'d_loss': D_loss.item()} if D_loss is not None else {}))
+
+    if profiler is not None:
+        profiler.stop()
+        for batch, totals in profiler.per_batch().items():
+            sink.log('profile', batch, **totals)
+        profiler.chrome_trace(os.path.join(run_dir, 'trace.json'))
+        print(profiler.summary())
+
+    sink.close()
+    # queryable with the other runs, see results.py
+    from results import ResultsStore
+    store = ResultsStore()
+    store.sync()
+    store.close()
+
+    if not visualize and gen_scores:
+        import matplotlib.pyplot as plt
         plt.plot(gen_scores)
         plt.ylim((0, 13))
-        plt.title('{}_after_{}_epochs_of_pretraining'.format(GD, PRE_EPOCH_GEN))
+        plt.title('{}_after_{:g}_epochs_of_pretraining'.format(config.GD, config.PRE_EPOCH_GEN))
         plt.show()
 
 
@@ -444,7 +409,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Training Parameter')
     parser.add_argument('--visualize', action='store_true', help='Enables Visdom')
     parser.add_argument('--cuda', action='store', default=None, type=int)
+    RunConfig.add_arguments(parser)
     opt = parser.parse_args()
+    config = RunConfig.from_args(opt)
     if opt.cuda is not None and opt.cuda >= 0:
         if torch.cuda.is_available():
             torch.cuda.set_device(opt.cuda)
@@ -452,17 +419,18 @@ if __name__ == '__main__':
         else:
             opt.cuda = False
 
-    try:
-        from eval.helper import *
-        from eval.BLEU_score import *
-        from visdom import Visdom
-        import torchnet as tnt
-        from torchnet.engine import Engine
-        from torchnet.logger import VisdomPlotLogger, VisdomTextLogger, VisdomLogger
-        canVisualize = True
-    except ImportError as ie:
-        eprint("Could not import vizualization imports. ")
-        canVisualize = False
+    canVisualize = False
+    if opt.visualize:
+        try:
+            from eval.helper import *
+            from eval.BLEU_score import *
+            from visdom import Visdom
+            import torchnet as tnt
+            from torchnet.engine import Engine
+            from torchnet.logger import VisdomLogger
+            canVisualize = True
+        except ImportError as ie:
+            eprint("Could not import vizualization imports. ")
 
     opt.visualize = True if (opt.visualize and canVisualize) else False
-    main(opt)
+    main(opt, config)
@@ -0,0 +1,247 @@
+# -*- coding:utf-8 -*-
+'''
+Pipelined (asynchronous actor-learner) adversarial training, CPU only.
+
+    actors         sample batches from the latest generator snapshot into SampleRing
+    D learner      trains the discriminator on real batches vs ring batches
+    G learner      (calling process) trains the generator on ring batches and
+                   publishes a new snapshot after every step
+
+The generator snapshot, the ring and the discriminator live in shared memory.
+The G learner reads the discriminator for its rewards while the D learner
+updates it in place (Hogwild style). A ring batch sampled from snapshot
+version v is only used while v >= current version - max_staleness.
+The actors sample enough batches per version for the D-steps of the version,
+and wait while the ring is full of batches the D learner has not read yet.
+'''
+
+import time
+import copy
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from rollout import Rollout
+from data_loader import DataLoader
+from loss import VarianceLoss
+from adversarial import generator_step, variance_step, discriminator_step
+
+# shared objects are created in the context the workers are started with
+ctx = mp.get_context('spawn')
+
+# options of main.main the pipelined mode does not implement
+UNSUPPORTED = ('LEARN_RELAXATION', 'MICRO_BATCH_SIZE', 'BF16_AUTOCAST', 'COMPILE', 'BUCKET_BY_LENGTH', 'NEGATIVE_REPLAY',
+               'OFF_POLICY_K', 'COMPARE_ESTIMATORS', 'REWARD_DISTILL', 'QUANTIZED_INFERENCE')
+
+
+def check_supported(config):
+    enabled = [name for name in UNSUPPORTED if getattr(config, name)]
+    if config.CAPTURE_BATCH is not None:
+        enabled.append('CAPTURE_BATCH')
+    if config.G_STEPS != 1:
+        enabled.append('G_STEPS = {}'.format(config.G_STEPS))  # one G step per generator version
+    if enabled:
+        raise ValueError('The pipelined mode does not support {}'.format(', '.join(enabled)))
+
+
+class SampleRing(object):
+    """Fixed-size ring of sample batches in shared memory
+
+    Every slot holds one (batch_size, seq_len) batch and the generator version it
+    was sampled from. Writes overwrite the oldest slot. read is the position of
+    the D learner, the actors do not overwrite the batches it has not read.
+    """
+    def __init__(self, capacity, batch_size, seq_len):
+        self.capacity = capacity
+        self.samples = torch.zeros((capacity, batch_size, seq_len)).long().share_memory_()
+        self.versions = torch.full((capacity,), -1, dtype=torch.long).share_memory_()
+        self.head = ctx.Value('l', 0) # number of batches ever written
+        self.read = ctx.Value('l', 0) # cursor of the D learner
+        self.lock = ctx.Lock()
+
+    def put(self, samples, version):
+        with self.lock:
+            slot = self.head.value % self.capacity
+            self.samples[slot].copy_(samples)
+            self.versions[slot] = version
+            self.head.value += 1
+
+    def full(self):
+        """True if every slot holds a batch the D learner has not read"""
+        with self.lock:
+            return self.head.value - self.read.value >= self.capacity
+
+    def get(self, cursor, min_version):
+        """
+            Oldest batch written at or after position cursor whose version is >= min_version.
+            returns (samples, version, next cursor), samples is None if there is no such batch
+        """
+        with self.lock:
+            head = self.head.value
+            for position in range(max(cursor, head - self.capacity), head):
+                slot = position % self.capacity
+                version = self.versions[slot].item()
+                if version >= min_version:
+                    return self.samples[slot].clone(), version, position + 1
+            # versions only grow, the batches before head are never admissible again
+            return None, None, head
+
+    def latest(self, min_version):
+        """returns the most recent batch whose version is >= min_version and its version, or (None, None)"""
+        with self.lock:
+            head = self.head.value
+            if head == 0:
+                return None, None
+            slot = (head - 1) % self.capacity
+            version = self.versions[slot].item()
+            if version < min_version:
+                return None, None
+            return self.samples[slot].clone(), version
+
+
+class GeneratorSnapshot(object):
+    """Copy of the generator in shared memory, published by the G learner"""
+    def __init__(self, generator):
+        self.model = copy.deepcopy(generator).cpu()
+        self.model.share_memory()
+        self.version = ctx.Value('l', 0)
+        self.lock = ctx.Lock()
+
+    def publish(self, generator):
+        with self.lock:
+            self.model.load_state_dict(generator.state_dict())
+            self.version.value += 1
+
+    def load(self, model):
+        """copies the snapshot into model, returns its version"""
+        with self.lock:
+            model.load_state_dict(self.model.state_dict())
+            return self.version.value
+
+
+def actor(rank, snapshot, ring, stop, batch_size, seq_len, per_version, threads, seed):
+    """Samples from the latest snapshot, at most per_version batches per snapshot version and only while the ring is not full"""
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed + rank)
+    generator = copy.deepcopy(snapshot.model)
+    version, produced = -1, 0
+    while not stop.is_set():
+        if snapshot.version.value != version:
+            version, produced = snapshot.load(generator), 0
+        if produced >= per_version or ring.full():
+            time.sleep(1e-3)
+            continue
+        with torch.no_grad():
+            samples = generator.sample(batch_size, seq_len)
+        ring.put(samples, version)
+        produced += 1
+
+def discriminator_learner(discriminator, snapshot, ring, stop, stats, real_file, batch_size, vocab_size,
+                          max_staleness, steps_per_version, threads, seed, tokens=False):
+    """
+        Trains the shared discriminator on real batches vs ring batches, at most
+        steps_per_version steps per generator version. Falls back to the latest
+        admissible batch when no unread batch is available.
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    data_iter = DataLoader(real_file, batch_size, tokens=tokens)
+    optimizer = optim.Adam(discriminator.parameters())
+    cursor, steps = 0, 0
+    while not stop.is_set():
+        version = snapshot.version.value
+        if steps >= steps_per_version * (version + 1):
+            time.sleep(1e-3)
+            continue
+        min_version = version - max_staleness
+        fake, _, cursor = ring.get(cursor, min_version)
+        ring.read.value = cursor
+        if fake is None:
+            fake, _ = ring.latest(min_version)
+            if fake is None:
+                time.sleep(1e-3)
+                continue
+            with stats.get_lock():
+                stats[1] += 1
+        try:
+            data, _ = next(data_iter)
+        except StopIteration:
+            data_iter.reset()
+            data, _ = next(data_iter)
+        D_loss = discriminator_step(discriminator, optimizer, data, fake[:data.size(0)], vocab_size,
+                                    data_lengths=data_iter.lengths)
+        steps += 1
+        with stats.get_lock():
+            stats[0] += 1
+            stats[2] = D_loss.item()
+
+
+def train(generator, discriminator, c_phi_hat, GD, total_batches, real_file, batch_size, seq_len, vocab_size,
+          temperature, eta, update_rate, num_actors=2, max_staleness=2, capacity=16, d_steps_per_version=None,
+          check_variance=False, per_sample=True, threads=1, seed=0, eval_fn=None, tokens=False):
+    """
+        Pipelined adversarial training of generator and discriminator (modified in place).
+        d_steps_per_version defaults to one pass over the real data, as one D epoch of main.main.
+        The actors share the sampling of the D batches and of the G batch of every version.
+        eval_fn(total_batch) is called by the G learner after every generator step.
+        tokens: real_file holds token ids (see DataLoader)
+        returns the per-batch statistics: time, sample version lag, D steps, reused D batches, D loss, variance
+    """
+    if d_steps_per_version is None:
+        d_steps_per_version = int(np.ceil(DataLoader(real_file, batch_size, tokens=tokens).total_lines / batch_size))
+    discriminator.share_memory()
+    snapshot = GeneratorSnapshot(generator)
+    ring = SampleRing(capacity, batch_size, seq_len)
+    stop = ctx.Event()
+    stats = ctx.Array('d', 3) # D steps, reused D batches, last D loss
+
+    per_version = int(np.ceil((d_steps_per_version + 1) / num_actors))
+    processes = [ctx.Process(target=actor, args=(rank, snapshot, ring, stop, batch_size, seq_len, per_version, threads, seed))
+                 for rank in range(num_actors)]
+    processes.append(ctx.Process(target=discriminator_learner,
+                                 args=(discriminator, snapshot, ring, stop, stats, real_file, batch_size, vocab_size,
+                                       max_staleness, d_steps_per_version, threads, seed, tokens)))
+    for p in processes:
+        p.start()
+
+    rollout = Rollout(generator, update_rate)
+    gen_gan_optm = optim.Adam(generator.parameters())
+    c_phi_hat_loss = VarianceLoss(*generator.variance_parameter())
+    c_phi_hat_optm = optim.Adam(c_phi_hat.parameters())
+    update_c_phi_hat = lambda grads: variance_step(c_phi_hat_loss, c_phi_hat_optm, grads)
+    history = []
+    cursor = 0
+    try:
+        for total_batch in range(total_batches):
+            start = time.perf_counter()
+            version = snapshot.version.value
+            samples = None
+            while samples is None:
+                samples, sample_version, cursor = ring.get(cursor, version - max_staleness)
+                if samples is None:
+                    if not all(p.is_alive() for p in processes):
+                        raise RuntimeError('a pipeline worker exited')
+                    time.sleep(1e-3)
+            _, _, true_variance = generator_step(generator, discriminator, c_phi_hat, rollout, gen_gan_optm, GD,
+                                                 batch_size, seq_len, vocab_size, temperature, eta, samples=samples,
+                                                 check_variance=check_variance, variance_fn=update_c_phi_hat, per_sample=per_sample)
+            if check_variance:
+                true_variance = float(true_variance[0])
+            snapshot.publish(generator)
+            with stats.get_lock():
+                d_steps, reused, d_loss = stats[:]
+            history.append(dict(time=time.perf_counter() - start, lag=version - sample_version, d_steps=int(d_steps),
+                                reused=int(reused), d_loss=d_loss, variance=true_variance))
+            if eval_fn is not None:
+                eval_fn(total_batch)
+    finally:
+        stop.set()
+        for p in processes:
+            p.join()
+
+    return history
@@ -0,0 +1,208 @@
+# -*- coding:utf-8 -*-
+'''
+Timing spans of the phases of a run.
+
+The steps are instrumented with named spans (with span('reward'): ...). While a
+Profiler is started, every span records its wall time, CPU time of the process,
+resident memory (RSS) and peak RSS deltas and, with memory=True, the Python
+allocations (tracemalloc). Otherwise span() returns a shared no-op context
+manager, the instrumentation then costs one global lookup per span.
+
+Profiler.step(batch) starts the span 'batch' of an adversarial batch: the spans
+are aggregated per batch (per_batch) and over the run (summary), and exported
+as a Chrome trace (chrome://tracing, https://ui.perfetto.dev). torch_batches
+runs torch.profiler over a window of batches, the spans then also appear as
+record_function ranges in its trace.
+
+$ python main.py --PROFILE true --PROFILE_TORCH 5
+'''
+
+import os
+import json
+import time
+import resource
+import threading
+
+
+_active = None
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name):
+    """context manager timing name if a Profiler is started"""
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+def _rss():
+    """resident memory in bytes (Linux), 0 elsewhere"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def _peak_rss():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Span(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record_function = None
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.torch_profile is not None:
+            from torch.autograd.profiler import record_function
+            self.record_function = record_function(self.name)
+            self.record_function.__enter__()
+        self.depth = len(profiler.stack)
+        profiler.stack.append(self.name)
+        self.py_alloc = profiler.traced_memory() if profiler.memory else 0
+        self.rss = _rss()
+        self.peak_rss = _peak_rss()
+        self.cpu = time.process_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        cpu = time.process_time_ns()
+        profiler = self.profiler
+        profiler.stack.pop()
+        profiler.events.append((self.name, profiler.batch, self.depth, threading.get_ident(),
+                                self.start, end - self.start, cpu - self.cpu, _rss() - self.rss, _peak_rss() - self.peak_rss,
+                                profiler.traced_memory() - self.py_alloc if profiler.memory else 0))
+        if self.record_function is not None:
+            self.record_function.__exit__(*exc)
+        return False
+
+
+class Profiler(object):
+    """Spans of a run, between start() and stop()
+
+    memory: trace the Python allocations (tracemalloc, slows down the run)
+    torch_batches: (first, last) batch of a torch.profiler window, its trace and table are written to trace_dir
+                   (the trace of a RELAX batch with CHECK_VARIANCE is a few hundred MB, a single batch is usually enough)
+    """
+    def __init__(self, memory=False, torch_batches=None, trace_dir='.'):
+        self.memory = memory
+        self.torch_batches = (min(torch_batches), max(torch_batches)) if torch_batches else None
+        self.trace_dir = trace_dir
+        # name, batch, depth, thread, start [ns], wall [ns], cpu [ns], rss [B], peak rss [B], python allocations [B]
+        self.events = []
+        self.stack = []
+        self.batch = None
+        self.batch_span = None
+        self.torch_profile = None
+
+    def traced_memory(self):
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[0]
+
+    def start(self):
+        global _active
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        _active = self
+        return self
+
+    def stop(self):
+        global _active
+        self._end_batch()
+        self._stop_torch()
+        _active = None
+        if self.memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def step(self, batch):
+        """ends the span of the current batch and starts the one of batch"""
+        self._end_batch()
+        if self.torch_batches is not None:
+            if batch == self.torch_batches[0]:
+                import torch.profiler
+                self.torch_profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                            record_shapes=False, profile_memory=False)
+                self.torch_profile.__enter__()
+            elif batch == self.torch_batches[1] + 1:
+                self._stop_torch()
+        self.batch = batch
+        self.batch_span = _Span(self, 'batch').__enter__()
+
+    def _end_batch(self):
+        if self.batch_span is not None:
+            self.batch_span.__exit__(None, None, None)
+            self.batch_span = None
+
+    def _stop_torch(self):
+        if self.torch_profile is None:
+            return
+        self.torch_profile.__exit__(None, None, None)
+        name = 'torch_trace_{}-{}'.format(*self.torch_batches)
+        self.torch_profile.export_chrome_trace(os.path.join(self.trace_dir, name + '.json'))
+        with open(os.path.join(self.trace_dir, name + '.txt'), 'w') as f:
+            f.write(self.torch_profile.key_averages().table(sort_by='self_cpu_time_total', row_limit=40))
+        self.torch_profile = None
+
+    def per_batch(self):
+        """{batch: {name: wall time [s]}}, the spans of a name summed over the batch"""
+        batches = {}
+        for name, batch, _, _, _, wall, *_ in self.events:
+            if batch is not None:
+                totals = batches.setdefault(batch, {})
+                totals[name] = totals.get(name, 0.) + wall * 1e-9
+        return batches
+
+    def totals(self):
+        """{name: [calls, wall, cpu, rss, peak rss, python allocations]} over the run, in first call order"""
+        totals = {}
+        for name, _, _, _, _, wall, cpu, rss, peak_rss, py_alloc in self.events:
+            t = totals.setdefault(name, [0, 0, 0, 0, 0, 0])
+            for i, value in enumerate((1, wall, cpu, rss, peak_rss, py_alloc)):
+                t[i] += value
+        return totals
+
+    def summary(self):
+        """table of the spans: calls, wall time (total, mean, share of the batches), CPU time and memory deltas"""
+        totals = self.totals()
+        batch_wall = totals['batch'][1] if 'batch' in totals else sum(t[1] for t in totals.values())
+        lines = ['{:<18}{:>8}{:>12}{:>12}{:>9}{:>12}{:>12}{:>12}{:>12}'.format(
+            'span', 'calls', 'wall [s]', 'mean [ms]', '% batch', 'cpu [s]', 'rss [MB]', 'peak [MB]', 'py [MB]')]
+        for name, (calls, wall, cpu, rss, peak_rss, py_alloc) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<18}{:>8}{:>12.3f}{:>12.3f}{:>9.1f}{:>12.3f}{:>12.2f}{:>12.2f}{:>12.2f}'.format(
+                name, calls, wall * 1e-9, wall * 1e-6 / calls, 100. * wall / max(batch_wall, 1), cpu * 1e-9,
+                rss / 2 ** 20, peak_rss / 2 ** 20, py_alloc / 2 ** 20))
+        return '\n'.join(lines)
+
+    def chrome_trace(self, path):
+        """writes the spans as complete events of the Chrome trace format"""
+        pid = os.getpid()
+        events = []
+        for name, batch, depth, thread, start, wall, cpu, rss, peak_rss, py_alloc in self.events:
+            events.append({'name': name, 'cat': 'span', 'ph': 'X', 'pid': pid, 'tid': thread,
+                           'ts': start / 1e3, 'dur': wall / 1e3,
+                           'args': {'batch': batch, 'cpu_ms': cpu / 1e6, 'rss_kb': rss // 1024, 'peak_rss_kb': peak_rss // 1024,
+                                    'py_alloc_kb': py_alloc // 1024}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
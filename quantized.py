@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+import torch
+import torch.nn as nn
+
+
+class QuantizedInference(object):
+    """Dynamically quantized (int8) inference copies of the Generator and the LSTMDiscriminator
+
+    Only the LSTM and Linear layers are quantized (the embedding stays in fp32).
+    The copies live on the CPU, carry no gradients and are rebuilt from the
+    training weights whenever refresh_generator / refresh_discriminator is called
+    (they are None until the first refresh).
+    """
+    def __init__(self, generator, discriminator, dtype=torch.qint8):
+        self.ori_generator = generator
+        self.ori_discriminator = discriminator
+        self.dtype = dtype
+        self.generator = None
+        self.discriminator = None
+
+    def quantize(self, model):
+        model = copy.deepcopy(model).cpu().eval()
+        model.use_cuda = False
+        for param in model.parameters():
+            param.requires_grad = False
+        return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=self.dtype)
+
+    def refresh_generator(self):
+        self.generator = self.quantize(self.ori_generator)
+        return self.generator
+
+    def refresh_discriminator(self):
+        self.discriminator = self.quantize(self.ori_discriminator)
+        return self.discriminator
+
+    def refresh(self):
+        self.refresh_generator()
+        self.refresh_discriminator()
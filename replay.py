@@ -0,0 +1,239 @@
+# -*- coding:utf-8 -*-
+'''
+Capture of one adversarial batch of main.main, and its deterministic replay.
+
+With CAPTURE_BATCH, main.main records what the first generator step and the
+first discriminator step of that adversarial batch depend on, and saves it to
+runs/{hash}/capture_{batch}.pt:
+    G step: the generator, discriminator, c_phi_hat, relaxation parameters and
+            roll-out model, the optimizer states, the samples of the step and the
+            RNG states (random, numpy, torch) the step starts from
+    D step: the discriminator and its optimizer state, the real and generated
+            batch and the RNG states (no D step with D_EPOCHS = 0)
+and the checksums of the generator and of the discriminator after these steps.
+
+replay.py restores that state before every repetition and runs the step again:
+every repetition does the same work and ends with the same parameters, checked
+against the checksums of the run (bit-identical with the same torch build and
+thread count). The repetitions are timed, and can be profiled with the spans of
+profiling.py (summary table and Chrome trace) and torch.profiler.
+
+$ python main.py --GD RELAX --CAPTURE_BATCH 5
+$ python replay.py runs/{hash}/capture_5.pt --step g --repeat 10 --profile --torch_profile
+'''
+
+import os
+import copy
+import time
+import random
+import hashlib
+import argparse
+from dataclasses import asdict
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork, RelaxationParameters
+from rollout import Rollout
+from loss import VarianceLoss
+from adversarial import CompiledStep, ControlVariateUpdate, generator_loss, generator_step, discriminator_loss, discriminator_step
+from profiling import Profiler
+from config import RunConfig
+
+# options whose state is not captured (quantized copies, distilled table, off-policy buffer) or not a generator_step
+UNSUPPORTED = ('PIPELINE', 'QUANTIZED_INFERENCE', 'REWARD_DISTILL', 'COMPARE_ESTIMATORS')
+
+
+def check_supported(config):
+    enabled = [name for name in UNSUPPORTED if getattr(config, name)]
+    if config.OFF_POLICY_K > 0:
+        enabled.append('OFF_POLICY_K')
+    if config.GD == 'MLE':
+        enabled.append('GD = MLE')
+    if config.G_STEPS < 1:
+        enabled.append('G_STEPS = {}'.format(config.G_STEPS))
+    if enabled:
+        raise ValueError('Capture and replay do not support {}'.format(', '.join(enabled)))
+    if config.CAPTURE_BATCH is not None and not 0 <= config.CAPTURE_BATCH < config.TOTAL_BATCH:
+        raise ValueError('CAPTURE_BATCH has to be an adversarial batch, 0 to TOTAL_BATCH - 1 = {}, got {}'.format(
+            config.TOTAL_BATCH - 1, config.CAPTURE_BATCH))
+
+def rng_state():
+    return dict(random=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+
+def cpu_state(module_or_optimizer):
+    """copy of a state dict, tensors on the CPU"""
+    state = module_or_optimizer.state_dict()
+    return copy.deepcopy(_to_cpu(state))
+
+def _to_cpu(value):
+    if torch.is_tensor(value):
+        return value.detach().cpu()
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+def checksum(module):
+    """SHA-1 of the parameters of module"""
+    h = hashlib.sha1()
+    for p in module.parameters():
+        h.update(p.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class StepCapture(object):
+    """State of the first G step and D step of an adversarial batch of main.main, filled in while the batch runs"""
+    def __init__(self, path, config, total_batch):
+        self.path = path
+        self.state = dict(config=asdict(config), total_batch=total_batch)
+
+    def g_step(self, generator, discriminator, c_phi_hat, relaxation, rollout, gen_optm, c_phi_hat_optm, samples):
+        """before generator_step(samples=samples), the samples drawn as generator_step would"""
+        self.state['g'] = dict(generator=cpu_state(generator), discriminator=cpu_state(discriminator),
+                               c_phi_hat=cpu_state(c_phi_hat), relaxation=None if relaxation is None else cpu_state(relaxation),
+                               rollout=cpu_state(rollout.own_model), gen_optm=cpu_state(gen_optm),
+                               c_phi_hat_optm=cpu_state(c_phi_hat_optm), samples=samples.cpu(), rng=rng_state())
+
+    def g_done(self, generator):
+        self.state['g']['checksum'] = checksum(generator)
+
+    def d_step(self, discriminator, dis_optm, data, samples, lengths):
+        """before discriminator_step"""
+        self.state['d'] = dict(discriminator=cpu_state(discriminator), dis_optm=cpu_state(dis_optm), data=data.cpu(),
+                               samples=samples.cpu(), lengths=None if lengths is None else lengths.cpu(), rng=rng_state())
+
+    def d_done(self, discriminator):
+        self.state['d']['checksum'] = checksum(discriminator)
+        self.save()
+
+    def save(self):
+        torch.save(self.state, self.path)
+        print('Batch [{}] captured: {}'.format(self.state['total_batch'], self.path))
+
+
+class Replay(object):
+    """The models and optimizers of a run (CPU), restored from a capture before every step"""
+    def __init__(self, state):
+        self.state = state
+        self.config = config = RunConfig.from_dict(state['config'])
+        check_supported(config)
+        self.generator = Generator(config.VOCAB_SIZE, config.g_emb_dim, config.g_hidden_dim, False,
+                                   checkpoint_segment=config.CHECKPOINT_SEGMENT, adaptive_cutoffs=config.ADAPTIVE_CUTOFFS)
+        self.discriminator = LSTMDiscriminator(config.d_num_class, config.VOCAB_SIZE, config.d_lstm_hidden_dim, False,
+                                               checkpoint_segment=config.CHECKPOINT_SEGMENT,
+                                               emb_dim=config.d_emb_dim if config.EMBED_INPUTS else None)
+        self.c_phi_hat = AnnexNetwork(config.d_num_class, config.VOCAB_SIZE, config.d_emb_dim, config.c_filter_sizes,
+                                      config.c_num_filters, config.d_dropout, config.g_sequence_len, embed_inputs=config.EMBED_INPUTS)
+        self.rollout = Rollout(self.generator, config.UPDATE_RATE)
+        self.gen_optm = optim.Adam(self.generator.parameters())
+        self.dis_optm = optim.Adam(self.discriminator.parameters())
+        self.c_phi_hat_optm = optim.Adam(self.c_phi_hat.parameters())
+        self.relaxation = None
+        if config.LEARN_RELAXATION:
+            self.relaxation = RelaxationParameters(config.DEFAULT_ETA, config.DEFAULT_TEMPERATURE)
+            self.c_phi_hat_optm.add_param_group({'params': self.relaxation.parameters(), 'lr': config.RELAXATION_LR})
+        self.update_c_phi_hat = ControlVariateUpdate(VarianceLoss(*self.generator.variance_parameter()), self.c_phi_hat_optm)
+        self.gen_loss_fn = CompiledStep(generator_loss, config.COMPILE and not config.CHECK_VARIANCE)
+        self.dis_loss_fn = CompiledStep(discriminator_loss, config.COMPILE)
+
+    def restore_g(self):
+        g = self.state['g']
+        self.generator.load_state_dict(g['generator'])
+        self.discriminator.load_state_dict(g['discriminator'])
+        self.c_phi_hat.load_state_dict(g['c_phi_hat'])
+        if self.relaxation is not None:
+            self.relaxation.load_state_dict(g['relaxation'])
+        self.rollout.own_model.load_state_dict(g['rollout'])
+        # the optimizers update their state in place
+        self.gen_optm.load_state_dict(copy.deepcopy(g['gen_optm']))
+        self.c_phi_hat_optm.load_state_dict(copy.deepcopy(g['c_phi_hat_optm']))
+        set_rng_state(g['rng'])
+
+    def g_step(self):
+        config = self.config
+        temperature, eta = config.DEFAULT_TEMPERATURE, config.DEFAULT_ETA
+        if self.relaxation is not None:
+            temperature, eta = self.relaxation.temperature, self.relaxation.eta
+        generator_step(self.generator, self.discriminator, self.c_phi_hat, self.rollout, self.gen_optm, config.GD,
+                       config.BATCH_SIZE, config.g_sequence_len, config.VOCAB_SIZE, temperature, eta,
+                       loss_fn=self.gen_loss_fn, samples=self.state['g']['samples'], check_variance=config.CHECK_VARIANCE,
+                       variance_fn=self.update_c_phi_hat, per_sample=config.VARIANCE_PER_SAMPLE,
+                       micro_batch_size=config.MICRO_BATCH_SIZE, bf16=config.BF16_AUTOCAST)
+        return checksum(self.generator)
+
+    def restore_d(self):
+        d = self.state['d']
+        self.discriminator.load_state_dict(d['discriminator'])
+        self.dis_optm.load_state_dict(copy.deepcopy(d['dis_optm']))
+        set_rng_state(d['rng'])
+
+    def d_step(self):
+        config, d = self.config, self.state['d']
+        discriminator_step(self.discriminator, self.dis_optm, d['data'], d['samples'], config.VOCAB_SIZE, loss_fn=self.dis_loss_fn,
+                           micro_batch_size=config.MICRO_BATCH_SIZE, data_lengths=d['lengths'], bf16=config.BF16_AUTOCAST)
+        return checksum(self.discriminator)
+
+
+def replay(opt):
+    torch.set_num_threads(opt.threads)
+    state = torch.load(opt.capture, map_location='cpu', weights_only=False)
+    if opt.step not in state:
+        raise ValueError('{} holds no {} step (D_EPOCHS = 0)'.format(opt.capture, opt.step.upper()))
+    r = Replay(state)
+    restore, step = (r.restore_g, r.g_step) if opt.step == 'g' else (r.restore_d, r.d_step)
+    expected = state[opt.step]['checksum']
+    print('Batch [{}] {} step of {} (GD = {}, SEQ_LEN = {}, BATCH_SIZE = {}, CHECK_VARIANCE = {}), {} threads'.format(
+        state['total_batch'], opt.step.upper(), os.path.basename(opt.capture), r.config.GD, r.config.SEQ_LEN,
+        r.config.BATCH_SIZE, r.config.CHECK_VARIANCE, opt.threads))
+
+    profiler = None
+    out = opt.out or os.path.dirname(opt.capture) or '.'
+    times, checksums = [], []
+    for rep in range(opt.warmup + opt.repeat):
+        if rep == opt.warmup and (opt.profile or opt.torch_profile):
+            torch_batches = (opt.warmup, opt.warmup + opt.repeat - 1) if opt.torch_profile else None
+            profiler = Profiler(opt.profile_memory, torch_batches, out).start()
+        restore()
+        if profiler is not None:
+            profiler.step(rep)
+        start = time.perf_counter()
+        checksums.append(step())
+        if rep >= opt.warmup:
+            times.append(time.perf_counter() - start)
+    if profiler is not None:
+        profiler.stop()
+
+    print('{} repetitions: mean {:.2f} ms, median {:.2f} ms, min {:.2f} ms'.format(
+        opt.repeat, 1e3 * np.mean(times), 1e3 * np.median(times), 1e3 * np.min(times)))
+    print('Deterministic: {}, same parameters as the run: {}'.format(
+        len(set(checksums)) == 1, checksums[0] == expected))
+    if profiler is not None:
+        print(profiler.summary())
+        path = os.path.join(out, 'replay_{}_{}.json'.format(opt.step, state['total_batch']))
+        profiler.chrome_trace(path)
+        print('Trace: {}'.format(path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replay of a captured adversarial step')
+    parser.add_argument('capture', help='runs/{hash}/capture_{batch}.pt, written by main.py with CAPTURE_BATCH')
+    parser.add_argument('--step', default='g', choices=['g', 'd'], help='generator or discriminator step')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1, help='repetitions before the timed ones')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--profile', action='store_true', help='spans of profiling.py: summary table and Chrome trace')
+    parser.add_argument('--profile_memory', action='store_true', help='Python allocations of the spans (tracemalloc)')
+    parser.add_argument('--torch_profile', action='store_true', help='torch.profiler over the timed repetitions')
+    parser.add_argument('--out', default=None, help='directory of the traces, default: the one of the capture')
+    replay(parser.parse_args())
@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+'''
+Replay buffers of generated sequences.
+'''
+
+from collections import deque
+
+import torch
+
+
+class NegativeReplayBuffer(object):
+    """Bounded buffer of generated negatives for the discriminator
+
+    At every refresh the entries older than max_age steps are evicted and
+    refresh_fraction of the capacity (plus the evicted slots) is resampled from
+    the generator in one batch, replacing the oldest entries first. The
+    discriminator then draws its fakes from the buffer.
+    """
+    def __init__(self, capacity, seq_len, refresh_fraction=0.1, max_age=10, cuda=False):
+        self.capacity = capacity
+        self.refresh_fraction = refresh_fraction
+        self.max_age = max_age
+        self.samples = torch.zeros((capacity, seq_len)).long()
+        self.steps = torch.full((capacity,), -1, dtype=torch.long) # step at which each entry was sampled, -1 if empty
+        self.cuda = cuda
+        if cuda:
+            self.samples = self.samples.cuda()
+        self.sampled = 0 # number of sequences sampled from the generator
+
+    def __len__(self):
+        return int((self.steps >= 0).sum())
+
+    def refresh(self, generator, step):
+        """Evicts the entries older than max_age and resamples the oldest entries, returns the number of new sequences"""
+        stale = (self.steps < 0) | (self.steps < step - self.max_age)
+        num = max(int(stale.sum()), int(self.refresh_fraction * self.capacity))
+        num = min(num, self.capacity)
+        if num == 0:
+            return 0
+        # empty and stale entries come first, then the oldest ones
+        order = torch.argsort(torch.where(stale, torch.full_like(self.steps, -2), self.steps))
+        idx = order[:num]
+        with torch.no_grad():
+            new = generator.sample(num, self.samples.size(1)).data
+        self.samples[idx.to(self.samples.device)] = new
+        self.steps[idx] = step
+        self.sampled += num
+        return num
+
+    def sample(self, batch_size):
+        """returns batch_size random entries (batch_size, seq_len)"""
+        filled = torch.nonzero(self.steps >= 0).view(-1)
+        idx = filled[torch.randint(len(filled), (batch_size,))]
+        return self.samples[idx.to(self.samples.device)]
+
+    def mean_age(self, step):
+        filled = self.steps >= 0
+        return (step - self.steps[filled]).float().mean().item()
+
+
+class OffPolicyBuffer(object):
+    """Last K generator batches with their behaviour log-probabilities and rewards
+
+    Used to reuse past samples in the generator step with importance weights.
+    """
+    def __init__(self, K):
+        self.batches = deque(maxlen=K)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def add(self, samples, log_prob, rewards):
+        """
+            samples dims: (batch_size, seq_len), log_prob (sequence log-probabilities) and rewards dims: (batch_size)
+        """
+        self.batches.append((samples.detach(), log_prob.detach(), rewards.detach()))
@@ -0,0 +1,294 @@
+# -*- coding:utf-8 -*-
+'''
+SQLite store of the metrics of the runs, and the charts rendered from it.
+
+Every run appends its records to runs/{hash}/metrics.jsonl (utils.log_metrics),
+emptied when the run starts. ResultsStore.sync() adds the records appended since
+the last sync to the store (runs/results.db), one row per metric keyed by config
+hash, phase and step, and the configuration of the run. A file which is not the
+one of the last sync (another inode or first record: the run was started again)
+replaces the records of its run. The queries sync first, so the store always
+holds the runs found in runs/, including the running ones.
+
+The charts (score_seq{SEQ_LEN}.png and log_var_seq{SEQ_LEN}.png, one line per
+estimator averaged over the matching runs) are rendered from the store without
+training; a chart whose runs have no new records is not rendered again.
+
+$ python results.py runs --where GD=RELAX SEQ_LEN=3
+$ python results.py series goodness --where SEQ_LEN=15
+$ python results.py charts --out charts --where SPACES=false
+'''
+
+import os
+import json
+import glob
+import hashlib
+import sqlite3
+import argparse
+
+import numpy as np
+
+from config import RunConfig
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (config_hash TEXT PRIMARY KEY, config TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS metrics (config_hash TEXT NOT NULL, phase TEXT NOT NULL, step INTEGER NOT NULL,
+                                    name TEXT NOT NULL, value REAL, data TEXT, time REAL);
+CREATE INDEX IF NOT EXISTS metrics_series ON metrics (name, phase, config_hash, step);
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, offset INTEGER NOT NULL, identity TEXT);
+CREATE TABLE IF NOT EXISTS charts (path TEXT PRIMARY KEY, fingerprint TEXT NOT NULL);
+'''
+
+# fields of the records which are not metrics
+RECORD_KEYS = ('config_hash', 'phase', 'step', 'time')
+
+ESTIMATORS = ('REINFORCE', 'REBAR', 'RELAX')
+COLORS = {'REINFORCE': '#0070c0', 'REBAR': '#548235', 'RELAX': '#ff0000'}
+
+
+class ResultsStore(object):
+    """Metrics of the runs of runs_dir in an SQLite database (runs_dir/results.db by default)
+
+    where filters of the queries are {RunConfig field: value}, compared to the resolved configuration of the runs.
+    """
+    def __init__(self, path=None, runs_dir='runs'):
+        self.runs_dir = runs_dir
+        self.path = path or os.path.join(runs_dir, 'results.db')
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # sweep workers may sync concurrently
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.executescript(SCHEMA)
+        if 'identity' not in [column[1] for column in self.db.execute('PRAGMA table_info(sources)')]:
+            # store of an earlier version: its files are read again once
+            with self.db:
+                self.db.execute('ALTER TABLE sources ADD COLUMN identity TEXT')
+
+    def close(self):
+        self.db.close()
+
+    def sync(self):
+        """Adds the records appended to runs_dir/*/metrics.jsonl since the last sync, returns their number"""
+        added = 0
+        for path in sorted(glob.glob(os.path.join(self.runs_dir, '*', 'metrics.jsonl'))):
+            run_dir = os.path.dirname(path)
+            config_hash = os.path.basename(run_dir)
+            row = self.db.execute('SELECT offset, identity FROM sources WHERE path = ?', (path,)).fetchone()
+            offset, synced_identity = row if row else (0, None)
+            identity = file_identity(path)
+            if identity is None:
+                # no complete record yet: a run started again has no records so far
+                if offset > 0:
+                    with self.db:
+                        self.db.execute('DELETE FROM metrics WHERE config_hash = ?', (config_hash,))
+                        self.db.execute('DELETE FROM sources WHERE path = ?', (path,))
+                continue
+            size = os.path.getsize(path)
+            if size == offset and identity == synced_identity:
+                continue
+            with self.db:
+                if offset > 0 and (size < offset or identity != synced_identity):
+                    # the run was started again (main.py, or sweep.py after an interruption)
+                    self.db.execute('DELETE FROM metrics WHERE config_hash = ?', (config_hash,))
+                    offset = 0
+                config_file = os.path.join(run_dir, 'config.json')
+                if os.path.exists(config_file):
+                    with open(config_file) as f:
+                        self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)', (config_hash, json.dumps(json.load(f), sort_keys=True)))
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    text = f.read()
+                # a line being written is left for the next sync
+                complete = text[:text.rfind(b'\n') + 1]
+                rows = []
+                for line in complete.decode('utf-8').splitlines():
+                    if line.strip():
+                        rows.extend(metric_rows(json.loads(line)))
+                self.db.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (path, offset + len(complete), identity))
+            added += len(rows)
+        return added
+
+    def runs(self, sync=True, **where):
+        """configurations (with their config_hash) of the runs matching where"""
+        if sync:
+            self.sync()
+        clauses, args = where_clause(where)
+        rows = self.db.execute('SELECT config_hash, config FROM runs' + clauses + ' ORDER BY config_hash', args).fetchall()
+        return [dict(json.loads(config), config_hash=config_hash) for config_hash, config in rows]
+
+    def records(self, config_hash, phase=None, name=None, sync=True):
+        """(phase, step, name, value, time) of the metrics of a run, value decoded for the non-scalar metrics"""
+        if sync:
+            self.sync()
+        query = 'SELECT phase, step, name, value, data, time FROM metrics WHERE config_hash = ?'
+        args = [config_hash]
+        for column, value in (('phase', phase), ('name', name)):
+            if value is not None:
+                query += ' AND {} = ?'.format(column)
+                args.append(value)
+        rows = self.db.execute(query + ' ORDER BY rowid', args).fetchall()
+        return [(p, s, n, json.loads(data) if data is not None else value, t) for p, s, n, value, data, t in rows]
+
+    def series(self, name, phase='adversarial', sync=True, **where):
+        """{config_hash: (steps, values)} of a scalar metric of the runs matching where, the values of a step
+        (e.g. one per G step) averaged"""
+        if sync:
+            self.sync()
+        clauses, args = where_clause(where)
+        query = ('SELECT m.config_hash, m.step, AVG(m.value) FROM metrics m JOIN runs USING (config_hash)'
+                 ' WHERE m.name = ? AND m.phase = ? AND m.value IS NOT NULL'
+                 + clauses.replace(' WHERE ', ' AND ', 1) + ' GROUP BY m.config_hash, m.step ORDER BY m.config_hash, m.step')
+        series = {}
+        for config_hash, step, value in self.db.execute(query, [name, phase] + args):
+            steps, values = series.setdefault(config_hash, ([], []))
+            steps.append(step)
+            values.append(value)
+        return {h: (np.array(steps), np.array(values)) for h, (steps, values) in series.items()}
+
+    def mean_series(self, name, phase='adversarial', sync=True, **where):
+        """(steps, mean, number of runs) of a metric over the runs matching where, on the steps they share"""
+        series = self.series(name, phase, sync, **where)
+        if not series:
+            return np.array([]), np.array([]), 0
+        steps = sorted(set.intersection(*(set(s.tolist()) for s, _ in series.values())))
+        values = np.array([[dict(zip(s.tolist(), v))[step] for step in steps] for s, v in series.values()])
+        return np.array(steps), values.mean(0), len(series)
+
+    def fingerprint(self, name, phase='adversarial', **where):
+        """changes when a run matching where gets new records of the metric"""
+        clauses, args = where_clause(where)
+        query = ('SELECT m.config_hash, COUNT(*), MAX(m.rowid) FROM metrics m JOIN runs USING (config_hash)'
+                 ' WHERE m.name = ? AND m.phase = ?' + clauses.replace(' WHERE ', ' AND ', 1) + ' GROUP BY m.config_hash ORDER BY m.config_hash')
+        rows = self.db.execute(query, [name, phase] + args).fetchall()
+        return hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+
+    def chart_changed(self, path, fingerprint):
+        row = self.db.execute('SELECT fingerprint FROM charts WHERE path = ?', (path,)).fetchone()
+        return row is None or row[0] != fingerprint or not os.path.exists(path)
+
+    def chart_rendered(self, path, fingerprint):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO charts VALUES (?, ?)', (path, fingerprint))
+
+
+def file_identity(path):
+    """inode and hash of the first record of a metrics file, None while it has no complete record"""
+    with open(path, 'rb') as f:
+        first = f.readline()
+        inode = os.fstat(f.fileno()).st_ino
+    if not first.endswith(b'\n'):
+        return None
+    return '{}:{}'.format(inode, hashlib.sha1(first).hexdigest())
+
+def metric_rows(record):
+    """rows of the metrics table of a record of utils.log_metrics"""
+    rows = []
+    for name, value in record.items():
+        if name in RECORD_KEYS or value is None:
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            rows.append((record['config_hash'], record['phase'], record['step'], name, float(value), None, record.get('time')))
+        else:
+            rows.append((record['config_hash'], record['phase'], record['step'], name, None, json.dumps(value), record.get('time')))
+    return rows
+
+def where_clause(where):
+    """SQL condition on the configuration of the runs, values of the fields compared as JSON"""
+    if not where:
+        return '', []
+    clauses = ['json_extract(runs.config, ?) = json_extract(?, \'$\')'] * len(where)
+    args = []
+    for name, value in where.items():
+        args.extend(['$.' + name, json.dumps(value)])
+    return ' WHERE ' + ' AND '.join(clauses), args
+
+def parse_where(items):
+    """NAME=VALUE items of the command line, typed as the RunConfig fields"""
+    where = {}
+    for item in items or []:
+        name, text = item.split('=', 1)
+        parser = argparse.ArgumentParser()
+        RunConfig.add_arguments(parser)
+        opt = parser.parse_args(['--' + name, text])
+        where.update(RunConfig.values_from_args(opt))
+    return where
+
+
+def render_charts(store, out='charts', force=False, **where):
+    """
+        Renders score_seq{SEQ_LEN}.png and log_var_seq{SEQ_LEN}.png of the runs matching where into out,
+        the charts whose runs got no new records since they were rendered are skipped
+        returns the paths of the rendered charts
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(out, exist_ok=True)
+    rendered = []
+    seq_lens = sorted({run['SEQ_LEN'] for run in store.runs(**where) if run['GD'] in ESTIMATORS})
+    for seq_len in seq_lens:
+        for name, filename, ylabel, transform in (
+                ('goodness', 'score_seq{}.png', 'Score', None),
+                ('variance', 'log_var_seq{}.png', 'Log Variance of Gradient Estimators', np.log10)):
+            path = os.path.join(out, filename.format(seq_len))
+            fingerprint = store.fingerprint(name, SEQ_LEN=seq_len, **where)
+            if not force and not store.chart_changed(path, fingerprint):
+                continue
+            fig, ax = plt.subplots(figsize=(11, 6.5))
+            plotted = False
+            for GD in ESTIMATORS:
+                steps, values, n = store.mean_series(name, sync=False, SEQ_LEN=seq_len, GD=GD, **where)
+                if n == 0:
+                    continue
+                if transform is not None:
+                    values = transform(values)
+                ax.plot(steps + 1, values, color=COLORS[GD], label=GD if n == 1 else '{} ({} runs)'.format(GD, n))
+                plotted = True
+            if not plotted:
+                plt.close(fig)
+                continue
+            ax.set_title('Sequence Length = {}'.format(seq_len), fontsize=16, fontweight='bold', pad=36)
+            ax.set_xlabel('Batches', fontweight='bold')
+            ax.set_ylabel(ylabel, fontweight='bold')
+            if transform is not None:
+                ax.axhline(0, color='#bfbfbf', linewidth=1)
+            ax.legend(loc='lower center', bbox_to_anchor=(0.5, 1.0), ncol=len(ESTIMATORS), frameon=False)
+            for side in ('top', 'right'):
+                ax.spines[side].set_visible(False)
+            fig.savefig(path, dpi=100, bbox_inches='tight')
+            plt.close(fig)
+            store.chart_rendered(path, fingerprint)
+            rendered.append(path)
+    return rendered
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Results store of the runs')
+    parser.add_argument('command', choices=['sync', 'runs', 'series', 'charts'])
+    parser.add_argument('metric', nargs='?', default='goodness', help='metric of the series command')
+    parser.add_argument('--where', nargs='*', default=None, help='NAME=VALUE filters on the run parameters')
+    parser.add_argument('--phase', default='adversarial')
+    parser.add_argument('--runs_dir', default='runs')
+    parser.add_argument('--db', default=None, help='default: RUNS_DIR/results.db')
+    parser.add_argument('--out', default='charts', help='directory of the charts')
+    parser.add_argument('--force', action='store_true', help='render all the charts')
+    opt = parser.parse_args()
+
+    store = ResultsStore(opt.db, opt.runs_dir)
+    where = parse_where(opt.where)
+    if opt.command == 'sync':
+        print('{} new records'.format(store.sync()))
+    elif opt.command == 'runs':
+        for run in store.runs(**where):
+            print('{}  GD={} SEQ_LEN={} SPACES={} SEED={} TOTAL_BATCH={}'.format(
+                run['config_hash'], run['GD'], run['SEQ_LEN'], run['SPACES'], run['SEED'], run['TOTAL_BATCH']))
+    elif opt.command == 'series':
+        for config_hash, (steps, values) in store.series(opt.metric, opt.phase, **where).items():
+            print('{}  {}'.format(config_hash, ' '.join('{}:{:.6g}'.format(s, v) for s, v in zip(steps, values))))
+    else:
+        rendered = render_charts(store, opt.out, opt.force, **where)
+        print('Rendered: {}'.format(', '.join(rendered) if rendered else 'nothing (no new records)'))
+    store.close()
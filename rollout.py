@@ -5,7 +5,6 @@ import random
 import math
 import copy
 
-import tqdm
 
 import numpy as np
 
@@ -22,6 +21,15 @@ class Rollout(object):
         self.own_model = copy.deepcopy(model)
         self.update_rate = update_rate
 
+    def score(self, x, discriminator, VOCAB_SIZE, cuda):
+        """
+        Log-probabilities of the discriminator for token sequences x (batch_size, seq_len).
+        Reward models with token_input = True (e.g. distill.DistilledDiscriminator) are given the tokens directly.
+        """
+        if getattr(discriminator, 'token_input', False):
+            return discriminator(x)
+        return discriminator(convert_to_one_hot(x, VOCAB_SIZE, cuda))
+
     def get_reward(self, x, discriminator, VOCAB_SIZE, cuda):
         """
         Args:
@@ -33,19 +41,20 @@ class Rollout(object):
         seq_len = x.size(1)
 
         # samples = self.own_model.sample(batch_size, seq_len, x)
-        one_hot_samples = convert_to_one_hot(x, VOCAB_SIZE, cuda)
-        pred = discriminator(one_hot_samples)
+        pred = self.score(x, discriminator, VOCAB_SIZE, cuda)
         pred = pred.cpu().data[:,1].numpy()
         
         return pred
     
-    def get_reward_mc(self, x, num, discriminator):
+    def get_reward_mc(self, x, num, discriminator, VOCAB_SIZE=None, cuda=False):
         """
         Args:
             x : (batch_size, seq_len) input data
             num : roll-out number
             discriminator : discrimanator model
+            VOCAB_SIZE : defaults to discriminator.vocab_size
         """
+        VOCAB_SIZE = VOCAB_SIZE or getattr(discriminator, 'vocab_size', None)
         rewards = []
         batch_size = x.size(0)
         seq_len = x.size(1)
@@ -53,14 +62,14 @@ class Rollout(object):
             for l in range(1, seq_len):
                 data = x[:, 0:l]
                 samples = self.own_model.sample(batch_size, seq_len, data)
-                pred = discriminator(samples)
+                pred = self.score(samples, discriminator, VOCAB_SIZE, cuda)
                 pred = pred.cpu().data[:,1].numpy()
                 if i == 0:
                     rewards.append(pred)
                 else:
                     rewards[l-1] += pred
             # for the last token
-            pred = discriminator(x)
+            pred = self.score(x, discriminator, VOCAB_SIZE, cuda)
             pred = pred.cpu().data[:, 1].numpy()
             if i == 0:
                 rewards.append(pred)
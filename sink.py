@@ -0,0 +1,223 @@
+# -*- coding:utf-8 -*-
+'''
+Non-blocking sink of the metric records and text samples of a run.
+
+MetricsSink.log and MetricsSink.text only put the event on the queue of every
+backend and return: each backend is written by its own background thread, which
+takes the events queued since its last write in one go (one file write, one
+Visdom request per plot). Text samples are sampled (TEXT_SAMPLES lines every
+TEXT_EVERY evaluations) before they are queued.
+
+Backends:
+    JsonlBackend        the records of utils.log_metrics (runs/{hash}/metrics.jsonl), text to a file
+    ConsoleBackend      prints the text samples
+    TensorBoardBackend  scalars and text as TensorBoard events (needs the tensorboard package)
+    VisdomBackend       plots of selected metrics and the text samples (needs visdom and torchnet)
+
+The file and console backends keep every event. The queue of a lossy backend
+(Visdom) is bounded: when the server cannot keep up, new events are dropped
+instead of slowing down training. A backend which fails is disabled with a
+message on stderr, the run goes on.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+
+
+class JsonlBackend(object):
+    """Metric records as JSON lines (the format of utils.log_metrics), text samples as lines of text_path.
+    The files are emptied first: they hold the last run of the configuration"""
+    lossless = True
+
+    def __init__(self, path, text_path=None):
+        self.path = path
+        self.text_path = text_path
+        for p in (path, text_path):
+            if p is not None:
+                open(p, 'w').close()
+
+    def write(self, events):
+        records = [json.dumps(record) + '\n' for kind, record in events if kind == 'record']
+        if records:
+            with open(self.path, 'a') as f:
+                f.write(''.join(records))
+        texts = [text for kind, text in events if kind == 'text']
+        if texts and self.text_path is not None:
+            with open(self.text_path, 'a') as f:
+                for text in texts:
+                    f.write(''.join('[{} {}] {}\n'.format(text['phase'], text['step'], line) for line in text['lines']))
+
+    def close(self):
+        pass
+
+class ConsoleBackend(object):
+    """Text samples on stdout"""
+    lossless = True
+
+    def write(self, events):
+        for kind, text in events:
+            if kind == 'text':
+                print('Batch [{}] Samples: {}'.format(text['step'], text['lines']) if text['phase'] == 'adversarial' else
+                      'Epoch [{}] Samples: {}'.format(text['step'], text['lines']))
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+class TensorBoardBackend(object):
+    """Scalar metrics as 'phase/name' scalars, text samples as 'phase/samples' text"""
+    lossless = True
+
+    def __init__(self, logdir):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(logdir)
+
+    def write(self, events):
+        for kind, event in events:
+            if kind == 'record':
+                for name, value in event.items():
+                    if name not in ('config_hash', 'phase', 'step', 'time') and isinstance(value, (int, float)):
+                        self.writer.add_scalar('{}/{}'.format(event['phase'], name), value, event['step'], walltime=event['time'])
+            else:
+                self.writer.add_text('{}/samples'.format(event['phase']), '  \n'.join(event['lines']), event['step'])
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+class VisdomBackend(object):
+    """One line plot per (phase, metric) of titles, {(phase, name): title}, text samples appended to a text window"""
+    lossless = False
+
+    def __init__(self, titles):
+        from torchnet.logger import VisdomPlotLogger, VisdomTextLogger
+        self.plots = {key: VisdomPlotLogger('line', opts={'title': title}) for key, title in titles.items()}
+        self.text_logger = VisdomTextLogger(update_type='APPEND')
+
+    def write(self, events):
+        for kind, event in events:
+            if kind == 'record':
+                for name, value in event.items():
+                    plot = self.plots.get((event['phase'], name))
+                    if plot is not None:
+                        plot.log(event['step'], value)
+            else:
+                self.text_logger.log('<br>'.join(event['lines']))
+
+    def close(self):
+        pass
+
+
+class _Writer(threading.Thread):
+    """Background thread writing the events queued for one backend"""
+    def __init__(self, backend, capacity, max_events):
+        super(_Writer, self).__init__(name='sink-{}'.format(type(backend).__name__), daemon=True)
+        self.backend = backend
+        self.queue = queue.Queue(0 if backend.lossless else capacity)
+        self.max_events = max_events
+        self.dropped = 0
+        self.failed = False
+
+    def put(self, event):
+        if self.failed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        done = False
+        while not done:
+            events = [self.queue.get()]
+            while len(events) < self.max_events:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if events[-1] is None:
+                done = True
+                events.pop()
+            if events and not self.failed:
+                try:
+                    self.backend.write(events)
+                except Exception as e:
+                    self.failed = True
+                    print('{} disabled: {!r}'.format(type(self.backend).__name__, e), file=sys.stderr)
+        try:
+            self.backend.close()
+        except Exception:
+            pass
+
+
+class MetricsSink(object):
+    """Buffered metric records and sampled text samples of a run, written by one background thread per backend
+
+    config_hash: tag of the records (config.RunConfig.hash)
+    backends: JsonlBackend, ConsoleBackend, TensorBoardBackend, VisdomBackend instances
+    text_samples, text_every: text() keeps the first text_samples lines of every text_every-th step
+    capacity: events held by the queue of a lossy backend, the next ones are dropped when it is full
+    """
+    def __init__(self, config_hash, backends, text_samples=8, text_every=1, capacity=1024, max_events=256):
+        self.config_hash = config_hash
+        self.text_samples = text_samples
+        self.text_every = text_every
+        self.writers = [_Writer(backend, capacity, max_events) for backend in backends]
+        for writer in self.writers:
+            writer.start()
+        self.closed = False
+        # records are not lost when the run ends with an exception
+        atexit.register(self.close)
+
+    def log(self, phase, step, **values):
+        """queues one metric record, as utils.log_metrics writes it"""
+        record = dict(config_hash=self.config_hash, phase=phase, step=step, time=time.time(), **values)
+        for writer in self.writers:
+            writer.put(('record', record))
+
+    def text(self, phase, step, lines):
+        """queues text_samples of the lines if step is logged"""
+        if self.text_samples <= 0 or step % self.text_every != 0:
+            return
+        text = dict(phase=phase, step=step, lines=list(lines[:self.text_samples]))
+        for writer in self.writers:
+            writer.put(('text', text))
+
+    def dropped(self):
+        """number of events dropped by the lossy backends"""
+        return sum(writer.dropped for writer in self.writers)
+
+    def close(self):
+        """writes the queued events and stops the threads"""
+        if self.closed:
+            return
+        self.closed = True
+        for writer in self.writers:
+            writer.queue.put(None)  # lossy queues included: blocks until there is room
+        for writer in self.writers:
+            writer.join()
+        atexit.unregister(self.close)
+
+
+def open_sink(config, run_dir, visdom_titles=None):
+    """MetricsSink of a run: the backends of config.METRICS_BACKENDS in run_dir, Visdom plots of visdom_titles if given.
+    A backend whose package is missing is left out"""
+    backends = []
+    for name in config.METRICS_BACKENDS:
+        if name == 'jsonl':
+            backends.append(JsonlBackend(os.path.join(run_dir, 'metrics.jsonl'), os.path.join(run_dir, 'samples.txt')))
+        elif name == 'console':
+            backends.append(ConsoleBackend())
+        elif name == 'tensorboard':
+            try:
+                backends.append(TensorBoardBackend(os.path.join(run_dir, 'tensorboard')))
+            except ImportError as e:
+                print('Could not import TensorBoard ({}), metrics not written as TensorBoard events'.format(e), file=sys.stderr)
+    if visdom_titles is not None:
+        backends.append(VisdomBackend(visdom_titles))
+    return MetricsSink(config.hash(), backends, config.TEXT_SAMPLES, config.TEXT_EVERY)
@@ -0,0 +1,518 @@
+# -*- coding:utf-8 -*-
+'''
+K replicas of the adversarial training (generator, LSTM discriminator, annex
+network) trained in lockstep, e.g. the seeds of the score and variance charts.
+
+The parameters of the replicas are stacked along a leading replica dimension and
+every layer runs once for all of them (batched matrix products for the LSTMs and
+the linear layers and the convolutions of the annex network). Replica k only
+reads slice k and the losses are summed over the replicas, so the gradient of
+slice k is that of replica k alone; Adam being elementwise, one optimizer over
+the stacked parameters keeps independent moments per replica. Every replica draws
+its sampling, relaxation and dropout noise from its own torch.Generator and
+shuffles its own copy of the real data with its own Python random state, all
+seeded with its seed, and the batched products of slice k do not depend on the
+other replicas, so replica k gives the same results as a stacked run of its seed
+alone (--seeds k). The models are initialised as by main for that seed and G
+starts from the pre-trained weights (weights_path).
+
+The guarantee is between stacked runs only: a replica does not reproduce the
+plain main.py run of its seed. main draws all its noise from the global random
+streams in another order, and its nn.LSTM layers round differently from the
+batched products here. Each replica is therefore recorded as the run of the
+configuration with that SEED and STACKED = True, a hash of its own
+(runs/{hash}/metrics.jsonl and checkpoints tagged with it). main.py runs such a
+configuration through train with its seed alone, which is the one-replica
+stacked run, not the plain run of the seed.
+
+The speed-up over K separate replicas is well below K: benchmarks.stacked_replicas
+measured about 2.3x at K = 4 and 1.7x at K = 8 with several threads, and 2.0x
+and 2.6x with one thread.
+
+$ python stacked.py --seeds 88 89 90 91 --GD RELAX --TOTAL_BATCH 10
+'''
+
+import os
+import time
+import random
+import argparse
+import contextlib
+from dataclasses import replace
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+from utils import get_data_goodness_score, get_data_freq, get_char_freq, log_metrics
+from generator import Generator
+from discriminator import LSTMDiscriminator
+from annex_network import AnnexNetwork
+from data_loader import DataLoader
+from helpers import convert_to_one_hot
+from loss import VarianceLoss
+from adversarial import ControlVariateUpdate
+from config import RunConfig
+
+
+# options of main which the stacked replicas do not implement
+UNSUPPORTED = ('MLE', 'ADAPTIVE_CUTOFFS', 'EMBED_INPUTS', 'BUCKET_BY_LENGTH', 'MICRO_BATCH_SIZE', 'COMPARE_ESTIMATORS',
+               'LEARN_RELAXATION', 'BF16_AUTOCAST', 'COMPILE', 'QUANTIZED_INFERENCE', 'PIPELINE', 'NEGATIVE_REPLAY',
+               'OFF_POLICY_K', 'REWARD_DISTILL')
+
+
+def stacked_lstm(x, hidden, weight_ih, weight_hh, bias_ih, bias_hh):
+    """
+        Single-layer LSTMs (gates i, f, g, o as nn.LSTM) of stacked weights over x (K, batch_size, seq_len, input_dim)
+        from hidden (h, c), both (K, batch_size, hidden_dim)
+        returns the outputs (K, batch_size, seq_len, hidden_dim) and the final (h, c)
+    """
+    K, batch_size, seq_len, input_dim = x.size()
+    h, c = hidden
+    hidden_dim = h.size(2)
+    # the input projections of all the steps at once (a broadcast matmul is much slower than the flat bmm)
+    inputs = linear(x.reshape(K, -1, input_dim), weight_ih, bias_ih + bias_hh).view(K, batch_size, seq_len, -1)
+    weight_hh = weight_hh.transpose(1, 2)
+    outputs = []
+    for t in range(seq_len):
+        gates = torch.baddbmm(inputs[:, :, t], h, weight_hh)
+        ifo = torch.sigmoid(gates)
+        g = torch.tanh(gates[:, :, 2 * hidden_dim:3 * hidden_dim])
+        c = torch.addcmul(ifo[:, :, hidden_dim:2 * hidden_dim] * c, ifo[:, :, :hidden_dim], g)
+        h = ifo[:, :, 3 * hidden_dim:] * torch.tanh(c)
+        outputs.append(h)
+
+    return torch.stack(outputs, 2), (h, c)
+
+def lstm_params(prefix):
+    return {'{}_{}'.format(prefix, name): '{}.{}_l0'.format(prefix, name)
+            for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')}
+
+def linear(x, weight, bias):
+    """x (K, n, in_features) by stacked weights (K, out_features, in_features) and biases (K, out_features)"""
+    return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+
+class Stacked(nn.Module):
+    """Replicas of a module with stacked parameters
+
+    Parameter name of the stack holds parameter params[name] of every replica along its first dimension,
+    in the order of params. rngs: one torch.Generator per replica for the noise of the forward passes.
+    """
+    def __init__(self, modules, params, rngs=None):
+        super(Stacked, self).__init__()
+        self.replicas = len(modules)
+        self.params = params
+        self.rngs = rngs
+        for name, source in params.items():
+            self.register_parameter(name, nn.Parameter(torch.stack([m.get_parameter(source).detach().clone() for m in modules])))
+
+    def replica_state_dict(self, k):
+        """state dict of replica k for the module it was stacked from"""
+        return {source: getattr(self, name)[k].detach().clone() for name, source in self.params.items()}
+
+    def init_hidden(self, batch_size):
+        h = torch.zeros((self.replicas, batch_size, self.hidden_dim))
+        c = torch.zeros((self.replicas, batch_size, self.hidden_dim))
+        return h, c
+
+    def lstm(self, x, hidden):
+        return stacked_lstm(x, hidden, self.lstm_weight_ih, self.lstm_weight_hh, self.lstm_bias_ih, self.lstm_bias_hh)
+
+
+class StackedGenerator(Stacked):
+    """Stacked Generator replicas (full softmax output), token sequences are (K, batch_size, seq_len)"""
+    def __init__(self, generators, rngs):
+        if any(g.adaptive is not None for g in generators):
+            raise ValueError('Generators with an adaptive softmax cannot be stacked')
+        params = {'emb_weight': 'emb.weight'}
+        params.update(lstm_params('lstm'))
+        params.update({'lin_weight': 'lin.weight', 'lin_bias': 'lin.bias'})  # last: the variance is that of lin.bias
+        super(StackedGenerator, self).__init__(generators, params, rngs)
+        self.num_emb = generators[0].num_emb
+        self.hidden_dim = generators[0].hidden_dim
+
+    def embed(self, x):
+        # rows of replica k are at k * num_emb in the flattened tables
+        offsets = torch.arange(self.replicas).view(-1, 1, 1) * self.num_emb
+        return F.embedding(x + offsets, self.emb_weight.view(-1, self.emb_weight.size(2)))
+
+    def forward(self, x):
+        """log-probabilities (K, batch_size * seq_len, num_emb) after the tokens x (K, batch_size, seq_len)"""
+        output, _ = self.lstm(self.embed(x), self.init_hidden(x.size(1)))
+        output = output.reshape(self.replicas, -1, self.hidden_dim)
+        return F.log_softmax(linear(output, self.lin_weight, self.lin_bias), dim=2)
+
+    def sample(self, batch_size, seq_len):
+        """(K, batch_size, seq_len), the tokens of replica k are drawn from rngs[k]"""
+        x = torch.zeros((self.replicas, batch_size, 1), dtype=torch.long)
+        h, c = self.init_hidden(batch_size)
+        samples = []
+        with torch.no_grad():
+            for _ in range(seq_len):
+                output, (h, c) = self.lstm(self.embed(x), (h, c))
+                prob = F.softmax(linear(output.squeeze(2), self.lin_weight, self.lin_bias), dim=2)
+                x = torch.stack([p.multinomial(1, generator=rng) for p, rng in zip(prob, self.rngs)])
+                samples.append(x)
+
+        return torch.cat(samples, 2)
+
+
+class StackedLSTMDiscriminator(Stacked):
+    """Stacked LSTMDiscriminator replicas reading one-hot or relaxed inputs"""
+    def __init__(self, discriminators):
+        if any(d.emb is not None for d in discriminators):
+            raise ValueError('Discriminators embedding their inputs cannot be stacked')
+        params = lstm_params('lstm')
+        params.update({'lin_weight': 'lin.weight', 'lin_bias': 'lin.bias'})
+        super(StackedLSTMDiscriminator, self).__init__(discriminators, params)
+        self.hidden_dim = discriminators[0].hidden_dim
+
+    def forward(self, x):
+        """log-probabilities (K, batch_size, num_classes) of x (K, batch_size, seq_len, vocab_size)"""
+        _, (h, c) = self.lstm(x, self.init_hidden(x.size(1)))
+        return F.log_softmax(linear(h, self.lin_weight, self.lin_bias), dim=2)
+
+
+class StackedAnnexNetwork(Stacked):
+    """Stacked AnnexNetwork replicas
+
+    The filters span the whole vocabulary, so a convolution is a batched linear layer over the unfolded windows of
+    filter_size steps (a grouped convolution would not give every replica the results it has alone).
+    """
+    def __init__(self, annexes, rngs):
+        if any(a.emb is not None for a in annexes):
+            raise ValueError('Annex networks embedding their inputs cannot be stacked')
+        params = {}
+        for i in range(len(annexes[0].convs)):
+            params.update({'conv{}_weight'.format(i): 'convs.{}.weight'.format(i), 'conv{}_bias'.format(i): 'convs.{}.bias'.format(i)})
+        params.update({'highway_weight': 'highway.weight', 'highway_bias': 'highway.bias',
+                       'lin_weight': 'lin.weight', 'lin_bias': 'lin.bias'})
+        super(StackedAnnexNetwork, self).__init__(annexes, params, rngs)
+        self.num_convs = len(annexes[0].convs)
+        self.dropout_p = annexes[0].dropout.p
+        self.g_sequence_len = annexes[0].g_sequence_len
+
+    def forward(self, x):
+        """log-probabilities (K, batch_size, num_classes) of x (K, batch_size * g_sequence_len, vocab_size)"""
+        K, vocab_size = self.replicas, x.size(-1)
+        emb = x.view(K, -1, self.g_sequence_len, vocab_size)  # K * batch_size * seq_len * vocab_size
+        batch_size = emb.size(1)
+        pools = []
+        for i in range(self.num_convs):
+            weight, bias = getattr(self, 'conv{}_weight'.format(i)), getattr(self, 'conv{}_bias'.format(i))
+            n, f = weight.size(1), weight.size(3)
+            windows = emb.unfold(2, f, 1).transpose(3, 4).reshape(K, -1, f * vocab_size)  # K * (batch_size * length) * (f * vocab_size)
+            conv = F.relu(linear(windows, weight.reshape(K, n, -1), bias)).view(K, batch_size, -1, n)
+            pools.append(conv.max(2)[0])  # K * batch_size * num_filter
+        pred = torch.cat(pools, 2)  # K * batch_size * num_filters_sum
+        highway = linear(pred, self.highway_weight, self.highway_bias)
+        pred = torch.sigmoid(highway) * F.relu(highway) + (1. - torch.sigmoid(highway)) * pred
+        return F.log_softmax(linear(self.dropout(pred), self.lin_weight, self.lin_bias), dim=2)
+
+    def dropout(self, x):
+        """the mask of replica k is drawn from rngs[k]"""
+        if not self.training or self.dropout_p == 0:
+            return x
+        keep = torch.stack([torch.rand(x.shape[1:], generator=rng) for rng in self.rngs]) >= self.dropout_p
+        return x * keep / (1. - self.dropout_p)
+
+
+@contextlib.contextmanager
+def python_random(state):
+    """Runs the block with the random module in the state of state (a random.Random), which follows it"""
+    saved = random.getstate()
+    random.setstate(state.getstate())
+    try:
+        yield
+    finally:
+        state.setstate(random.getstate())
+        random.setstate(saved)
+
+def one_hot(samples, vocab_size):
+    """(K, batch_size, seq_len) -> (K, batch_size, seq_len, vocab_size)"""
+    K, batch_size, seq_len = samples.size()
+    return convert_to_one_hot(samples.view(-1, seq_len), vocab_size, False).view(K, batch_size, seq_len, vocab_size)
+
+def generator_inputs(samples):
+    """adversarial.generator_inputs of the samples (K, batch_size, seq_len) of every replica"""
+    zeros = torch.zeros(samples.shape[:2] + (1,), dtype=torch.long)
+    return torch.cat([zeros, samples], dim=2)[:, :, :-1].contiguous()
+
+def c_phi_out(GD, c_phi_hat, theta_prime, discriminator, seq_len, temperature, eta):
+    """
+        utils.c_phi_out of every replica, theta_prime dims: (K, batch_size * seq_len, vocab_size)
+        returns c_phi(z) and c_phi(z_tilde), log-probabilities (K, batch_size, 2)
+    """
+    K, n, vocab_size = theta_prime.size()
+    rngs = c_phi_hat.rngs
+    # 3.b
+    u = torch.stack([torch.log(-torch.log(torch.rand(vocab_size, generator=rng))) for rng in rngs])
+    z = torch.log(theta_prime) - u.unsqueeze(1)
+    # 3.c
+    b = torch.stack([p.multinomial(1, generator=rng) for p, rng in zip(theta_prime.detach(), rngs)])  # K * n * 1
+    # 3.d
+    v = torch.stack([torch.rand(n, vocab_size, generator=rng) for rng in rngs])
+    v_b = v.gather(2, b)
+    z_tilde = -torch.log((-torch.log(v) / theta_prime) - torch.log(v_b))
+    z_tilde = z_tilde.scatter(2, b, -torch.log(-torch.log(v_b)))
+
+    f_lambda_z = F.softmax(z / temperature, dim=2).view(K, -1, seq_len, vocab_size)
+    f_lambda_z_tilde = F.softmax(z_tilde / temperature, dim=2).view(K, -1, seq_len, vocab_size)
+    if GD == 'REBAR':
+        return eta * discriminator(f_lambda_z), eta * discriminator(f_lambda_z_tilde)
+    return c_phi_hat(z) + discriminator(f_lambda_z), c_phi_hat(z_tilde) + discriminator(f_lambda_z_tilde)
+
+def generator_loss(generator, discriminator, c_phi_hat, samples, rewards, GD, temperature, eta):
+    """
+        adversarial.generator_loss summed over the replicas, samples dims: (K, batch_size, seq_len), rewards: (K, batch_size)
+        returns the loss, log-probabilities (K, batch_size, seq_len, vocab_size), c_phi(z) and c_phi(z_tilde)
+        (K, batch_size, 2), None for REINFORCE
+    """
+    K, batch_size, seq_len = samples.size()
+    prob = generator(generator_inputs(samples))
+    log_p = prob.gather(2, samples.view(K, -1, 1)).view(K, batch_size, seq_len)
+    if GD == "REINFORCE":
+        loss = -torch.sum(log_p * rewards.unsqueeze(2)) / batch_size
+        return loss, prob.view((K, batch_size, seq_len, -1)), None, None
+    c_phi_z_ori, c_phi_z_tilde_ori = c_phi_out(GD, c_phi_hat, F.softmax(prob, dim=2), discriminator, seq_len, temperature, eta)
+    c_phi_z_ori = torch.exp(c_phi_z_ori)
+    c_phi_z_tilde_ori = torch.exp(c_phi_z_tilde_ori)
+    weights = (rewards - c_phi_z_tilde_ori[:, :, 1]).detach()
+    loss = -torch.sum(log_p * weights.unsqueeze(2)) / batch_size
+    loss = loss + torch.sum(c_phi_z_ori[:, :, 1]) / batch_size - torch.sum(c_phi_z_tilde_ori[:, :, 1]) / batch_size
+
+    return loss, prob.view((K, batch_size, seq_len, -1)), c_phi_z_ori, c_phi_z_tilde_ori
+
+def estimator_grads(generator, samples, prob, rewards, c_phi_z_ori, c_phi_z_tilde_ori, GD, per_sample=True, create_graph=False):
+    """
+        adversarial.estimator_grads of every replica: estimate j is that of sample j of every replica (slice k of the
+        gradients of the stacked parameters), so one backward pass per sample serves all the replicas
+    """
+    batch_size = samples.size(1)
+    params = list(generator.parameters())
+    log_prob = prob.gather(3, samples.unsqueeze(3)).squeeze(3).sum(2)  # K * batch_size
+    if GD == "REINFORCE":
+        coef, c_diff, create_graph = rewards, None, False
+    else:
+        coef = rewards - c_phi_z_tilde_ori[:, :, 1]
+        c_diff = c_phi_z_ori[:, :, 1] - c_phi_z_tilde_ori[:, :, 1]
+    if not create_graph:
+        coef = coef.detach()
+    if per_sample:
+        terms = [(log_prob[:, j], coef[:, j], None if c_diff is None else c_diff[:, j]) for j in range(batch_size)]
+    else:
+        terms = [(log_prob, coef / batch_size, None if c_diff is None else c_diff.sum(1) / batch_size)]
+
+    all_grads = []
+    for log_p, w, c in terms:
+        outputs, grad_outputs = [log_p], [-w]
+        if c is not None:
+            outputs.append(c)
+            grad_outputs.append(torch.ones_like(c))
+        grads = torch.autograd.grad(outputs, params, grad_outputs=grad_outputs, retain_graph=True,
+                                    create_graph=create_graph, allow_unused=True)
+        all_grads.append([torch.zeros_like(p) if g is None else g for p, g in zip(params, grads)])
+
+    return all_grads
+
+def generator_step(generator, discriminator, c_phi_hat, optimizer, GD, batch_size, seq_len, vocab_size, temperature, eta,
+                   check_variance=False, variance_fn=None, per_sample=True):
+    """
+        adversarial.generator_step of every replica
+        returns the samples (K, batch_size, seq_len), their rewards (K, batch_size) and, if check_variance, the output of
+        variance_fn (the variance of the gradient of lin.bias is (K, vocab_size)) or the gradients
+    """
+    samples = generator.sample(batch_size, seq_len)
+    with torch.no_grad():
+        rewards = torch.exp(discriminator(one_hot(samples, vocab_size))[:, :, 1])
+    params = list(generator.parameters())
+    optimizer.zero_grad()
+    loss, prob, c_phi_z_ori, c_phi_z_tilde_ori = generator_loss(generator, discriminator, c_phi_hat, samples, rewards,
+                                                                GD, temperature, eta)
+    grads = None
+    if check_variance:
+        grads = estimator_grads(generator, samples, prob, rewards, c_phi_z_ori, c_phi_z_tilde_ori, GD,
+                                per_sample=per_sample, create_graph=variance_fn is not None)
+        for i, p in enumerate(params):
+            p.grad = sum(g[i].detach() for g in grads) / len(grads)
+        if variance_fn is not None:
+            grads = variance_fn(grads)
+    else:
+        loss.backward()
+    optimizer.step()
+
+    return samples, rewards, grads
+
+def discriminator_step(discriminator, optimizer, data, fake, vocab_size):
+    """
+        adversarial.discriminator_step of every replica, data, fake dims: (K, batch_size, seq_len)
+        returns the loss of every replica (K)
+    """
+    optimizer.zero_grad()
+    real_pred = torch.exp(discriminator(one_hot(data, vocab_size))[:, :, :-1])
+    fake_pred = torch.exp(discriminator(one_hot(fake, vocab_size))[:, :, :-1])
+    D_real_loss = F.binary_cross_entropy(real_pred, torch.ones_like(real_pred), reduction='none').mean((1, 2))
+    D_fake_loss = F.binary_cross_entropy(fake_pred, torch.zeros_like(fake_pred), reduction='none').mean((1, 2))
+    D_loss = D_real_loss + D_fake_loss
+    D_loss.sum().backward()
+    optimizer.step()
+
+    return D_loss.detach()
+
+def real_batches(loaders, states):
+    """Stacked (K, batch_size, seq_len) batches of the real data, loaders[k] drawing from the Python random state states[k]"""
+    while True:
+        batch = []
+        for loader, state in zip(loaders, states):
+            with python_random(state):
+                try:
+                    data, _ = loader.next()
+                except StopIteration:
+                    return
+            if loader.lengths is not None:
+                raise ValueError('The stacked replicas need real sequences of SEQ_LEN tokens')
+            batch.append(data)
+        yield torch.stack(batch)
+
+def evaluate(generator, config, loader):
+    """
+        Generation Score, KL score and character distribution of every replica. GENERATED_NUM sequences are sampled
+        and the first batch is scored, as by main (utils.generate_samples)
+    """
+    sizes = [config.BATCH_SIZE] * int(config.GENERATED_NUM / config.BATCH_SIZE)
+    if sum(sizes) < config.GENERATED_NUM:
+        sizes.append(config.GENERATED_NUM - sum(sizes))
+    scored = None
+    for size in sizes:
+        samples = generator.sample(size, config.g_sequence_len)
+        if scored is None:
+            scored = samples
+    results = []
+    for samples in scored:
+        generated_string = loader.convert_to_char(samples)
+        eval_score = get_data_goodness_score(generated_string, config.SPACES)
+        kl_score = get_data_freq(generated_string, config) if not config.SPACES else -1
+        results.append((eval_score, kl_score, list(get_char_freq(generated_string, config.SPACES))))
+
+    return results
+
+def build(config, seeds):
+    """the stacked models of the seeds, initialised as by main, and their torch and Python random states"""
+    generators, discriminators, annexes, rngs, states = [], [], [], [], []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        generator = Generator(config.VOCAB_SIZE, config.g_emb_dim, config.g_hidden_dim, False)
+        discriminators.append(LSTMDiscriminator(config.d_num_class, config.VOCAB_SIZE, config.d_lstm_hidden_dim, False))
+        annexes.append(AnnexNetwork(config.d_num_class, config.VOCAB_SIZE, config.d_emb_dim, config.c_filter_sizes,
+                                    config.c_num_filters, config.d_dropout, config.g_sequence_len))
+        generator.load_state_dict(torch.load(config.weights_path, map_location=lambda storage, loc: storage))
+        generators.append(generator)
+        rng = torch.Generator()
+        rng.manual_seed(seed)
+        rngs.append(rng)
+        states.append(random.Random(seed))
+
+    return (StackedGenerator(generators, rngs), StackedLSTMDiscriminator(discriminators),
+            StackedAnnexNetwork(annexes, rngs), states)
+
+def train(config, seeds, d_batches=None):
+    """
+        Adversarial training of the replicas of seeds (main's adversarial loop).
+        d_batches: real batches per D epoch (default: all)
+        returns the duration of every adversarial batch
+    """
+    for name in UNSUPPORTED:
+        if getattr(config, name):
+            raise ValueError('{} is not supported by the stacked replicas'.format(name))
+    if config.GD not in ('REINFORCE', 'REBAR', 'RELAX'):
+        raise ValueError('The stacked replicas are trained by REINFORCE, REBAR or RELAX, got {}'.format(config.GD))
+    if config.token_data:
+        raise ValueError('The stacked replicas are scored on the math characters, VOCAB_SIZE {} (token data) is not supported'.format(config.VOCAB_SIZE))
+    if config.PRE_EPOCH_DIS > 0 and config.PRE_ITER_DIS > 0:
+        raise ValueError('The stacked replicas start from an untrained D, PRE_EPOCH_DIS or PRE_ITER_DIS has to be 0')
+    generator, discriminator, c_phi_hat, states = build(config, seeds)
+
+    # every replica is the run of its seed with STACKED set, as main.py runs it
+    configs = [replace(config, SEED=seed, STACKED=True) for seed in seeds]
+    hashes = [c.hash() for c in configs]
+    metrics_files = []
+    for c, run_hash in zip(configs, hashes):
+        run_dir = os.path.join('runs', run_hash)
+        os.makedirs(run_dir, exist_ok=True)
+        c.save(os.path.join(run_dir, 'config.json'))
+        metrics_files.append(os.path.join(run_dir, 'metrics.jsonl'))
+        # the records of the last run of the configuration only
+        open(metrics_files[-1], 'w').close()
+        print('Run {}: SEED {}'.format(run_hash, c.SEED))
+    loaders = [DataLoader(config.POSITIVE_FILE, config.BATCH_SIZE) for _ in seeds]
+
+    gen_gan_optm = optim.Adam(generator.parameters())
+    dis_optimizer = optim.Adam(discriminator.parameters())
+    update_c_phi_hat = ControlVariateUpdate(VarianceLoss(), optim.Adam(c_phi_hat.parameters()))
+
+    batch_times = []
+    for total_batch in range(config.TOTAL_BATCH):
+        start = time.perf_counter()
+        for it in range(config.G_STEPS):
+            samples, rewards, true_variance = generator_step(generator, discriminator, c_phi_hat, gen_gan_optm, config.GD,
+                                                             config.BATCH_SIZE, config.g_sequence_len, config.VOCAB_SIZE,
+                                                             config.DEFAULT_TEMPERATURE, config.DEFAULT_ETA,
+                                                             check_variance=config.CHECK_VARIANCE, variance_fn=update_c_phi_hat,
+                                                             per_sample=config.VARIANCE_PER_SAMPLE)
+            if config.CHECK_VARIANCE:
+                for k, seed in enumerate(seeds):
+                    print('[SEED {}] Batch [{}] Estimate of the {} of the gradient at step {}: {}'.format(
+                        seed, total_batch, config.variance_metric.replace('_', ' '), it, true_variance[k, 0]))
+                    log_metrics(metrics_files[k], hashes[k], 'adversarial', total_batch,
+                                **{config.variance_metric: true_variance[k, 0].item()})
+
+        # Evaluate the quality of the Generator outputs
+        for k, (eval_score, kl_score, freq_score) in enumerate(evaluate(generator, config, loaders[0])):
+            print('[SEED {}] Batch [{}] Generation Score: {:f}, KL Score: {:f}'.format(seeds[k], total_batch, eval_score, kl_score))
+            log_metrics(metrics_files[k], hashes[k], 'adversarial', total_batch, goodness=eval_score, kl=kl_score,
+                        char_freq=freq_score)
+            if total_batch % 10 == 0 or total_batch == config.TOTAL_BATCH - 1:
+                torch.save(generator.replica_state_dict(k),
+                           f'checkpoints/{config.GD}_G_space_{config.SPACES}_pretrain_{config.PRE_EPOCH_GEN:g}_batch_{total_batch}_{hashes[k]}.pth')
+
+        # Train the discriminator
+        D_loss = None # no D-step with D_EPOCHS = 0
+        for b in range(config.D_EPOCHS):
+            for i, data in enumerate(real_batches(loaders, states)):
+                if d_batches is not None and i >= d_batches:
+                    break
+                fake = generator.sample(data.size(1), config.g_sequence_len)
+                D_loss = discriminator_step(discriminator, dis_optimizer, data, fake, config.VOCAB_SIZE)
+            for loader, state in zip(loaders, states):
+                with python_random(state):
+                    loader.reset()
+        if D_loss is not None:
+            for k in range(len(seeds)):
+                log_metrics(metrics_files[k], hashes[k], 'adversarial', total_batch, d_loss=D_loss[k].item())
+        batch_times.append(time.perf_counter() - start)
+        print('Batch [{}] {} replicas: {:.3f}s'.format(total_batch, len(seeds), batch_times[-1]))
+
+    # queryable with the other runs, see results.py
+    from results import ResultsStore
+    store = ResultsStore()
+    store.sync()
+    store.close()
+
+    return batch_times
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Stacked replicas of the adversarial training, one per seed')
+    parser.add_argument('--seeds', type=int, nargs='+', default=None, help='default: SEED to SEED + replicas - 1')
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--d_batches', type=int, default=None, help='real batches per D epoch (default: all)')
+    parser.add_argument('--threads', type=int, default=None)
+    RunConfig.add_arguments(parser)
+    opt = parser.parse_args()
+    config = RunConfig.from_args(opt)
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    seeds = opt.seeds or [config.SEED + k for k in range(opt.replicas)]
+    train(config, seeds, opt.d_batches)
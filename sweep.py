@@ -0,0 +1,259 @@
+# -*- coding:utf-8 -*-
+'''
+Parallel sweep of main.main over a grid of run parameters.
+
+The grid file holds one 'NAME in (value, value, ...)' line per RunConfig field
+(see 'test cases.txt'), every combination is run once per --seeds seed on top of
+the base parameters (--config FILE and --NAME VALUE overrides, as for main.py).
+Runs are executed by a pool of --workers spawned processes, each limited to
+--threads threads, one process per run. A run whose configuration hash already
+has a completed runs/<hash>/result.json is not run again, so an interrupted
+sweep is resumed by running the same command.
+
+With --halving the grid points are run by successive halving: every rung runs
+the remaining points with TOTAL_BATCH adversarial batches, from --min_batches
+up to the base TOTAL_BATCH multiplied by --eta each rung, and keeps the best
+1/eta of them by their final Generation Score averaged over the seeds. Promoted
+points are run again from the start with the larger budget (a new hash).
+The GD = MLE points are the MLE baseline: they have no adversarial batches
+(TOTAL_BATCH = 0) and are scored on their MLE evaluations. The combinations
+main cannot run are listed and left out.
+
+The final scores of all the runs are collected in one table (--results, CSV).
+
+$ python sweep.py --grid "test cases.txt" --seeds 88 89 --workers 4 --halving --min_batches 4
+'''
+
+import os
+import ast
+import csv
+import sys
+import json
+import time
+import argparse
+import itertools
+import traceback
+import contextlib
+import multiprocessing as mp
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from config import RunConfig
+
+
+RESULTS_COLUMNS = ['hash', 'status', 'TOTAL_BATCH', 'SEED', 'final_goodness', 'best_goodness', 'final_kl',
+                   'evaluations', 'time', 'error']
+
+def read_grid(path):
+    """{NAME: [values]} of a grid file, in file order"""
+    grid = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, values = line.split(' in ', 1)
+            values = ast.literal_eval(values.strip())
+            grid[name.strip()] = list(values) if isinstance(values, (tuple, list)) else [values]
+    return grid
+
+def grid_points(grid):
+    names = list(grid)
+    return [dict(zip(names, combo)) for combo in itertools.product(*grid.values())]
+
+def run_values(base, point, **values):
+    """values of a run of point, the MLE baseline (GD = MLE) has no adversarial batches"""
+    values = dict(base, **point, **values)
+    if values.get('GD', RunConfig.GD) == 'MLE':
+        values['TOTAL_BATCH'] = 0
+    return values
+
+def invalid(values):
+    """why main cannot run the combination, None if it can"""
+    config = RunConfig.from_dict(values)
+    if config.SPACES and config.SEQ_LEN == 3:
+        return 'no data with spaces for SEQ_LEN 3'
+    if config.SPACES and not config.MLE:
+        return 'no pre-trained weights with spaces'
+    return None
+
+def run_dir(config_hash):
+    return os.path.join('runs', config_hash)
+
+def summarize(metrics_file, phase='adversarial'):
+    """final and best Generation Score, final KL of the evaluations of phase in metrics_file"""
+    goodness, kl = [], []
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['phase'] == phase and 'goodness' in record:
+                    goodness.append(record['goodness'])
+                    kl.append(record['kl'])
+    return {'final_goodness': goodness[-1] if goodness else None,
+            'best_goodness': max(goodness) if goodness else None,
+            'final_kl': kl[-1] if kl else None,
+            'evaluations': len(goodness)}
+
+def init_worker(threads):
+    # before torch is imported by the run
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[name] = str(threads)
+    os.environ['MPLBACKEND'] = 'Agg'
+
+def run_one(values, threads):
+    """Runs main.main in this process, its output in runs/<hash>/log.txt; returns the result record"""
+    import torch
+    torch.set_num_threads(threads)
+    from main import main
+
+    config = RunConfig.from_dict(values)
+    config_hash = config.hash()
+    directory = run_dir(config_hash)
+    os.makedirs(directory, exist_ok=True)
+    # concurrent runs must not share the files their samples go through
+    config = replace(config, NEGATIVE_FILE=os.path.join(directory, 'gene.data'),
+                     EVAL_FILE=os.path.join(directory, 'eval.data'))
+    metrics_file = os.path.join(directory, 'metrics.jsonl')
+    if os.path.exists(metrics_file):  # left by an incomplete run
+        os.remove(metrics_file)
+    start = time.perf_counter()
+    status, error = 'done', None
+    with open(os.path.join(directory, 'log.txt'), 'w') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            main(argparse.Namespace(cuda=False, visualize=False), config)
+        except Exception as e:
+            status, error = 'failed', repr(e)
+            traceback.print_exc()
+    result = dict(hash=config_hash, status=status, TOTAL_BATCH=config.TOTAL_BATCH, SEED=config.SEED,
+                  time=time.perf_counter() - start, error=error,
+                  **summarize(metrics_file, 'mle' if config.GD == 'MLE' else 'adversarial'))
+    with open(os.path.join(directory, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+def completed(config_hash):
+    """result record of a completed run with that hash, None if there is none"""
+    path = os.path.join(run_dir(config_hash), 'result.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        result = json.load(f)
+    return result if result['status'] == 'done' else None
+
+def describe(point):
+    return ' '.join('{}={}'.format(name, value) for name, value in point.items())
+
+def run_rung(pool, runs, threads):
+    """results of runs, a list of (grid point, values), in the same order"""
+    results = [None] * len(runs)
+    futures = {}
+    for i, (point, values) in enumerate(runs):
+        config_hash = RunConfig.from_dict(values).hash()
+        result = completed(config_hash)
+        if result is not None:
+            result['status'] = 'skipped'
+            results[i] = result
+            print('[skipped] {} {} SEED={}'.format(config_hash, describe(point), values['SEED']))
+        else:
+            futures[pool.submit(run_one, values, threads)] = i
+    for n, future in enumerate(as_completed(futures), 1):
+        i = futures[future]
+        point, values = runs[i]
+        results[i] = result = future.result()
+        score = result['final_goodness']
+        print('[{}/{}] {} {} {} SEED={}: Generation Score {} ({:.1f} s)'.format(
+            n, len(futures), result['status'], result['hash'], describe(point), values['SEED'],
+            'n/a' if score is None else '{:.6f}'.format(score), result['time']))
+    return results
+
+def score(results):
+    """mean final Generation Score over the seeds, failed runs ranked last"""
+    scores = [r['final_goodness'] for r in results]
+    if any(s is None for s in scores):
+        return -np.inf
+    return float(np.mean(scores))
+
+def sweep(opt):
+    base = RunConfig.values_from_args(opt)
+    points = []
+    for p in grid_points(read_grid(opt.grid)):
+        reason = invalid(run_values(base, p))
+        if reason is None:
+            points.append(p)
+        else:
+            print('[invalid] {}: {}'.format(describe(p), reason))
+    seeds = opt.seeds or [RunConfig.from_dict(base).SEED]
+    # adversarial budget of the base parameters, whatever their GD
+    max_batches = RunConfig.from_dict(dict(base, GD='RELAX')).TOTAL_BATCH
+    budget = min(opt.min_batches, max_batches) if opt.halving else max_batches
+    threads = opt.threads or max(1, (os.cpu_count() or 1) // opt.workers)
+    print('{} grid points x {} seeds, {} workers x {} threads'.format(len(points), len(seeds), opt.workers, threads))
+
+    rows = []
+    ctx = mp.get_context('spawn')
+    with ProcessPoolExecutor(opt.workers, mp_context=ctx, initializer=init_worker, initargs=(threads,),
+                             max_tasks_per_child=1) as pool:
+        while True:
+            print('TOTAL_BATCH = {}: {} grid points'.format(budget, len(points)))
+            runs = [(p, run_values(base, p, SEED=seed, TOTAL_BATCH=budget)) for p in points for seed in seeds]
+            results = run_rung(pool, runs, threads)
+            for (point, _), result in zip(runs, results):
+                rows.append(dict(point, **result))
+            if budget >= max_batches or len(points) <= 1:
+                break
+            by_point = [score(results[i * len(seeds):(i + 1) * len(seeds)]) for i in range(len(points))]
+            keep = max(1, len(points) // opt.eta)
+            order = np.argsort(by_point)[::-1][:keep]
+            points = [points[i] for i in order]
+            budget = min(budget * opt.eta, max_batches)
+
+    write_results(opt.results, rows, list(read_grid(opt.grid)))
+    print_table(rows, list(read_grid(opt.grid)))
+
+def write_results(path, rows, names):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=names + RESULTS_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Results: {}'.format(path))
+
+def print_table(rows, names):
+    """final Generation Score and KL of the last rung of every grid point, mean (std) over the seeds"""
+    last = {}
+    for row in rows:
+        key = tuple(row[name] for name in names)
+        if key not in last or row['TOTAL_BATCH'] > last[key][0]:
+            last[key] = (row['TOTAL_BATCH'], [])
+        if row['TOTAL_BATCH'] == last[key][0]:
+            last[key][1].append(row)
+    width = max([len(name) for name in names] + [10]) + 2
+    print(''.join('{:>{}}'.format(name, width) for name in names) + '{:>13}{:>20}{:>20}'.format('TOTAL_BATCH', 'score', 'KL'))
+    for key, (budget, runs) in sorted(last.items(), key=lambda item: (-item[1][0], -score(item[1][1]))):
+        cells = []
+        for column in ('final_goodness', 'final_kl'):
+            values = [r[column] for r in runs if r[column] is not None]
+            cells.append('{:.4f} ({:.4f})'.format(np.mean(values), np.std(values)) if values else 'failed')
+        print(''.join('{:>{}}'.format(str(value), width) for value in key) + '{:>13}{:>20}{:>20}'.format(budget, *cells))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Parallel sweep over a grid of run parameters')
+    parser.add_argument('--grid', default='test cases.txt', help="file of 'NAME in (values)' lines")
+    parser.add_argument('--seeds', type=int, nargs='+', default=None, help='default: the SEED of the base config')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=None, help='torch threads per run, default: cores / workers')
+    parser.add_argument('--halving', action='store_true', help='successive halving over TOTAL_BATCH')
+    parser.add_argument('--min_batches', type=int, default=1, help='TOTAL_BATCH of the first rung')
+    parser.add_argument('--eta', type=int, default=3, help='halving rate and budget growth per rung')
+    parser.add_argument('--results', default=os.path.join('runs', 'results.csv'))
+    RunConfig.add_arguments(parser)
+    opt = parser.parse_args()
+    if opt.eta < 2:
+        sys.exit('--eta must be at least 2')
+    sweep(opt)
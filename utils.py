@@ -3,10 +3,11 @@ Auxiliary functions used during training.
 '''
 
 import os, sys
+import json
+import time
 import random
 import math
 import argparse
-import tqdm
 import numpy as np
 import torch
 import torch.nn as nn
@@ -14,23 +15,30 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.distributions import Categorical
-import scipy.stats as stat
 
 from generator import Generator
 from discriminator import Discriminator
 from annex_network import AnnexNetwork
 from data_iter import GenDataIter, DisDataIter
-
-from main import GENERATED_NUM, g_sequence_len, BATCH_SIZE, VOCAB_SIZE, SEQ_LEN
+from helpers import length_mask
 
 
 def eprint(*args, **kwargs):
 
     print(*args, file=sys.stderr, **kwargs)
 
+# appends one metric record to a JSON lines file, tagged with the hash of the run configuration (config.RunConfig.hash)
+def log_metrics(path, config_hash, phase, step, **values):
+
+    record = dict(config_hash=config_hash, phase=phase, step=step, time=time.time(), **values)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
 # generates sequences with the generator (LSTM)
-def generate_samples(model, batch_size, generated_num, output_file, cuda=False):
+def generate_samples(model, config, output_file, cuda=False):
+    # config: config.Config, config.generated_num sequences of config.seq_len tokens are sampled by batches of config.batch_size
 
+    batch_size, generated_num, g_sequence_len = config.batch_size, config.generated_num, config.seq_len
     samples = []
     for _ in range(int(generated_num / batch_size)):
         sample = model.sample(batch_size, g_sequence_len).cpu().data.numpy().tolist()
@@ -51,8 +59,59 @@ def generate_samples(model, batch_size, generated_num, output_file, cuda=False):
 
     return gen_samples
 
+# the padded positions of token targets are ignored by the criterion
+def masked_target(target, lengths, criterion):
+    mask = length_mask(lengths, target.size(1)).to(target.device)
+    return target.masked_fill(~mask, criterion.ignore_index)
+
+# forward pass of a pre-training batch
+def masked_forward(model, data, target, lengths, criterion):
+    """
+        lengths dims: (batch_size), None if the batch is not padded
+        returns the predictions, the flattened targets and the number of tokens
+    """
+    words = data.size(0) * data.size(1) if lengths is None else int(lengths.sum())
+    if getattr(model, 'adaptive', None) is not None:
+        # adaptive softmax: only the log-probabilities of the targets are computed, returned as the single column
+        # of pred (target 0, or ignore_index at the padded positions)
+        pred = model.target_log_prob(data, target, lengths).view(-1, 1)
+        target = torch.zeros_like(target)
+        if lengths is not None:
+            target = masked_target(target, lengths, criterion)
+        return pred, target.contiguous().view(-1), words
+    if lengths is None:
+        return model.forward(data), target.contiguous().view(-1), words
+    pred = model.forward(data, lengths)
+    if target.dim() == 2:
+        target = masked_target(target, lengths, criterion)
+    return pred, target.contiguous().view(-1), words
+
+# pre-training step with truncated backpropagation through time: one optimizer step per window of bptt steps,
+# the LSTM state is carried over (detached) from one window to the next
+def truncated_bptt_step(model, data, target, lengths, criterion, optimizer, bptt):
+    """
+        lengths dims: (batch_size), None if the batch is not padded
+        returns the summed loss and the number of tokens
+    """
+    if lengths is not None:
+        target = masked_target(target, lengths, criterion)
+    total_loss, hidden = 0., None
+    for start in range(0, data.size(1), bptt):
+        pred, hidden = model.forward_window(data[:, start:start + bptt], hidden)
+        loss = criterion(pred, target[:, start:start + bptt].contiguous().view(-1))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        hidden = tuple(h.detach() for h in hidden)
+        total_loss += loss.item()
+    words = data.size(0) * data.size(1) if lengths is None else int(lengths.sum())
+
+    return total_loss, words
+
 # pre-training loss
-def train_epoch(model, data_iter, criterion, optimizer, PRE_EPOCH_GEN, epoch, cuda=False):
+def train_epoch(model, data_iter, criterion, optimizer, PRE_EPOCH_GEN, epoch, config, cuda=False, bptt=None):
+    # config: config.Config, a fraction of epoch is a fraction of config.generated_num sequences
+    # bptt: window of the truncated backpropagation through time (generator only), None for the whole sequences
 
     total_loss = 0.
     total_words = 0.
@@ -60,21 +119,25 @@ def train_epoch(model, data_iter, criterion, optimizer, PRE_EPOCH_GEN, epoch, cu
     # allowing for pre-training on less than an epoch
     dec = PRE_EPOCH_GEN - epoch 
     if (dec > 0) and (dec < 1):
-        num_iters = dec * int(GENERATED_NUM / BATCH_SIZE)
+        num_iters = dec * int(config.generated_num / config.batch_size)
     for (data, target) in data_iter:
         data = Variable(data)
         target = Variable(target)
         if cuda:
             data, target = data.cuda(), target.cuda()
-        target = target.contiguous().view(-1)
-        pred = model.forward(data)
-        loss = criterion(pred, target)
-        total_loss += loss.data[0]
-        total_words += data.size(0) * data.size(1)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
         i += 1
+        if bptt is not None:
+            loss, words = truncated_bptt_step(model, data, target, getattr(data_iter, 'lengths', None), criterion, optimizer, bptt)
+            total_loss += loss
+            total_words += words
+        else:
+            pred, target, words = masked_forward(model, data, target, getattr(data_iter, 'lengths', None), criterion)
+            loss = criterion(pred, target)
+            total_loss += loss.item()
+            total_words += words
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
         if (dec > 0) and (dec < 1):
             if i > num_iters:
                 break
@@ -97,11 +160,10 @@ def train_epoch_batch(model, data_iter, criterion, optimizer, PRE_EPOCH_GEN, epo
     target = Variable(target)
     if cuda:
         data, target = data.cuda(), target.cuda()
-    target = target.contiguous().view(-1)
-    pred = model.forward(data)
+    pred, target, words = masked_forward(model, data, target, getattr(data_iter, 'lengths', None), criterion)
     loss = criterion(pred, target)
-    total_loss += loss.data[0]
-    total_words += data.size(0) * data.size(1)
+    total_loss += loss.item()
+    total_words += words
     optimizer.zero_grad()
     loss.backward()
     optimizer.step()
@@ -120,11 +182,10 @@ def eval_epoch(model, data_iter, criterion, cuda=False):
         target = Variable(target, volatile=True)
         if cuda:
             data, target = data.cuda(), target.cuda()
-        target = target.contiguous().view(-1)
-        pred = model.forward(data)
+        pred, target, words = masked_forward(model, data, target, getattr(data_iter, 'lengths', None), criterion)
         loss = criterion(pred, target)
-        total_loss += loss.data[0]
-        total_words += data.size(0) * data.size(1)
+        total_loss += loss.item()
+        total_words += words
     data_iter.reset()
 
     return math.exp(total_loss / total_words)
@@ -152,7 +213,7 @@ def softmax_with_temp(z, temperature, cuda=False):
 # Performs a Gumbel-Softmax reparameterization of the input
 def gumbel_softmax(theta_prime, VOCAB_SIZE, cuda=False):
 
-    u = Variable(torch.log(-torch.log(torch.rand(VOCAB_SIZE))))
+    u = torch.log(-torch.log(torch.rand(VOCAB_SIZE)))
     if cuda:
         u = u.cuda()
         theta_prime = theta_prime.cuda()
@@ -163,43 +224,26 @@ def gumbel_softmax(theta_prime, VOCAB_SIZE, cuda=False):
 # categorical re-sampling exactly as in Backpropagating through the void - Appendix B
 def categorical_re_param(theta_prime, VOCAB_SIZE, b, cuda=False):
 
-    v = Variable(torch.rand(theta_prime.size(0), VOCAB_SIZE))
-    z_tilde = Variable(torch.rand(theta_prime.size(0), VOCAB_SIZE))
+    v = torch.rand(theta_prime.size(0), VOCAB_SIZE)
     if cuda:
         v = v.cuda()
-    #naive implementation
-    for i in range(theta_prime.size(0)):
-        v_b = v[i,int(b[i])]
-        z_tilde[i,:] = -torch.log((-torch.log(v[i,:])/theta_prime[i,:]) - torch.log(v_b))
-        z_tilde[i,int(b[i])]=-torch.log(-torch.log(v[i,int(b[i])]))
-    if cuda:
-        z_tilde.cuda()
+    b = b.contiguous().view(-1, 1)
+    v_b = v.gather(1, b)
+    z_tilde = -torch.log((-torch.log(v)/theta_prime) - torch.log(v_b))
+    z_tilde = z_tilde.scatter(1, b, -torch.log(-torch.log(v_b)))
 
     return z_tilde
 
 # when you have sequences as probability distributions, re-puts them into sequences by doing argmax
-def sample_one_hot(theta_prime, batch_size, seq_len, vocab_size, use_cuda):
+def sample_one_hot(theta_prime, seq_len, vocab_size, use_cuda):
 
     # input theta_prime dims = (batch_size * seq_len) x vocab_size
-    theta_prime = theta_prime.view(batch_size, seq_len, vocab_size)
-    #####################################################################
-    #samples = Variable(torch.Tensor(seq_len, batch_size, vocab_size), requires_grad = True)
-    samples = Variable(torch.Tensor(seq_len, batch_size, vocab_size))
-
-    if(use_cuda):
+    x = theta_prime.contiguous().view(-1, vocab_size).multinomial(1)
+    samples = torch.zeros((x.size(0), vocab_size))
+    if use_cuda:
         samples = samples.cuda()
-
-    theta_prime = theta_prime.view(seq_len, batch_size, vocab_size)
-    for i in range(seq_len):
-        x = theta_prime[i].multinomial(1)
-        #########################################################################
-        #one_hot = Variable(torch.zeros((batch_size, vocab_size)).long(), requires_grad = True)
-        one_hot = Variable(torch.zeros((batch_size, vocab_size)).long())
-        if use_cuda:
-            one_hot = one_hot.cuda()
-        samples[i] = one_hot.scatter_(1, x, 1)
-
-    samples = samples.view(batch_size, seq_len, vocab_size)
+    samples.scatter_(1, x, 1)
+    samples = samples.view(-1, seq_len, vocab_size)
 
     return samples
 
@@ -218,16 +262,17 @@ def prob_to_seq(x, cuda=False):
     return x_refactor
 
 # 3.e and 3.f : Defining c_phi and getting c_phi(z) and c_phi(z_tilde)
-def c_phi_out(GD, c_phi_hat, theta_prime, discriminator, temperature=0.1, eta=None, cuda=False):
+def c_phi_out(GD, c_phi_hat, theta_prime, discriminator, seq_len, temperature=0.1, eta=None, cuda=False):
+    batch_size, vocab_size = theta_prime.size(0) // seq_len, theta_prime.size(1)
     # 3.b
-    z = gumbel_softmax(theta_prime, VOCAB_SIZE, cuda)
+    z = gumbel_softmax(theta_prime, vocab_size, cuda)
     # 3.c
     # value, b = torch.max(torch.transpose(z,0,1),0)
-    b = sample_one_hot(theta_prime, BATCH_SIZE, g_sequence_len, VOCAB_SIZE, cuda)
-    b = b.view(BATCH_SIZE*g_sequence_len, VOCAB_SIZE)
+    b = sample_one_hot(theta_prime, seq_len, vocab_size, cuda)
+    b = b.view(batch_size*seq_len, vocab_size)
     _, b = torch.max(torch.transpose(b, 0, 1), 0)
     # 3.d
-    z_tilde = categorical_re_param(theta_prime, VOCAB_SIZE, b, cuda)
+    z_tilde = categorical_re_param(theta_prime, vocab_size, b, cuda)
     if cuda:
         z_tilde = z_tilde.cuda()
 
@@ -237,8 +282,8 @@ def c_phi_out(GD, c_phi_hat, theta_prime, discriminator, temperature=0.1, eta=No
     f_lambda_z = softmax_with_temp(z, temperature, cuda=cuda)
     f_lambda_z_tilde = softmax_with_temp(z_tilde, temperature, cuda=cuda)
 
-    f_lambda_z = f_lambda_z.view(BATCH_SIZE, g_sequence_len, VOCAB_SIZE)
-    f_lambda_z_tilde = f_lambda_z_tilde.view(BATCH_SIZE, g_sequence_len, VOCAB_SIZE)
+    f_lambda_z = f_lambda_z.view(batch_size, seq_len, vocab_size)
+    f_lambda_z_tilde = f_lambda_z_tilde.view(batch_size, seq_len, vocab_size)
 
     f_lambda_z = f_lambda_z.type(type_)
     f_lambda_z_tilde = f_lambda_z_tilde.type(type_)
@@ -246,11 +291,11 @@ def c_phi_out(GD, c_phi_hat, theta_prime, discriminator, temperature=0.1, eta=No
     if GD == "REINFORCE":
         if cuda:
             ##############################################################################
-            return Variable(torch.zeros((BATCH_SIZE,2)), requires_grad=True).cuda(), Variable(torch.zeros((BATCH_SIZE,2)), requires_grad=True).cuda()
-            #return Variable(torch.zeros((BATCH_SIZE,2))).cuda(), Variable(torch.zeros((BATCH_SIZE,2))).cuda()
+            return torch.zeros((batch_size,2), requires_grad=True).cuda(), torch.zeros((batch_size,2), requires_grad=True).cuda()
+            #return Variable(torch.zeros((batch_size,2))).cuda(), Variable(torch.zeros((batch_size,2))).cuda()
         else:
-            return Variable(torch.zeros((BATCH_SIZE,2)), requires_grad=True), Variable(torch.zeros((BATCH_SIZE,2)), requires_grad=True)
-            #return Variable(torch.zeros((BATCH_SIZE,2))), Variable(torch.zeros((BATCH_SIZE,2)))
+            return torch.zeros((batch_size,2), requires_grad=True), torch.zeros((batch_size,2), requires_grad=True)
+            #return Variable(torch.zeros((batch_size,2))), Variable(torch.zeros((batch_size,2)))
 
     if GD == 'REBAR':
         assert eta is not None
@@ -318,9 +363,12 @@ def get_seq_goodness_score(seq, SPACES=False):
     return score
 
 # get KL divergence between generated and original bigram distributions
-def get_data_freq(all_data, seq_len=SEQ_LEN):
+def get_data_freq(all_data, config):
+    import scipy.stats as stat
 
     # all_data dim: (no_of_sequences, length_of_one_sequence), eeach cell is a string
+    # config: config.Config, the ground truth bigram frequencies are those of sequences of config.seq_len characters
+    seq_len, VOCAB_SIZE = config.seq_len, config.vocab_size
     if seq_len == 3:
         groundtruth = np.load('freq_array_3.npy')
     elif seq_len == 15:
@@ -364,8 +412,22 @@ def get_char_freq(all_data, SPACES):
         for i in range(0,len(seq_input)):
             batchwise[char_to_ix.get(seq_input[i])]+=1
   
-    return batchwise/(len(all_data)*len(all_data[0]))
+    return batchwise/sum(len(seq_input) for seq_input in all_data)
 
+# unigram frequencies of token id sequences (token data, VOCAB_SIZE > 6)
+def get_token_freq(all_data, vocab_size):
+    # all_data: sequences of token ids
+    counts = np.bincount(np.concatenate([np.asarray(seq, dtype='int64') for seq in all_data]), minlength=vocab_size)
+    return counts / counts.sum()
 
+# id-based scores of token id sequences, the arithmetic scores above only apply to the math characters
+def get_token_scores(all_data, groundtruth, vocab_size):
+    # all_data: sequences of token ids, groundtruth: get_token_freq of the real sequences
+    # returns the KL divergence between the generated and the real unigram distributions and the fraction of distinct sequences
+    import scipy.stats as stat
 
+    freq = get_token_freq(all_data, vocab_size)
+    kl = stat.entropy(freq + 1e-10, groundtruth + 1e-10)
+    distinct = len(set(tuple(seq) for seq in all_data)) / len(all_data)
 
+    return kl, distinct